@@ -0,0 +1,106 @@
+"""
+Backfill `status_shard` and `queue_position` on batch registry records
+written before the stack had `status-shard-index`.
+
+Upgrading a stack deployed with the former `status-index` takes three steps,
+as DynamoDB adds or removes one GSI per table update:
+
+1. `cdk deploy -c retire_status_index=false` adds `status-shard-index` next
+   to `status-index`
+2. run this script, until it reports no record left to backfill; records
+   without `status_shard` are missing from the new index, so the runner
+   doesn't see them until then
+3. `cdk deploy` removes `status-index`
+
+Records are updated on the condition that their status hasn't changed since
+they were scanned, so a concurrent runner or monitor is never overwritten;
+the ones skipped that way are picked up by running the script again.
+"""
+import sys
+import argparse
+from time import perf_counter as time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+from shard_and_register import DEFAULT_OWNER, OWNERS_ID, get_stack_output, queue_position, status_shard
+
+# registry items that are not batch records
+SLOT_LEDGER_ID = "__active_slots__"
+SCAN_SEGMENTS = 8
+
+
+def backfill_update(item):
+    """`update_item` arguments adding the missing sharded status keys to a legacy record."""
+    owner = item.get('owner', DEFAULT_OWNER)
+    return {
+        'Key': {'id': item['id']},
+        'UpdateExpression': 'SET #status_shard = :status_shard, #queue_position = :queue_position',
+        'ConditionExpression': '#status = :status',
+        'ExpressionAttributeNames': {
+            '#status': 'status',
+            '#status_shard': 'status_shard',
+            '#queue_position': 'queue_position',
+        },
+        'ExpressionAttributeValues': {
+            ':status': item['status'],
+            ':status_shard': status_shard(item['id'], item['status'], owner),
+            ':queue_position': queue_position(item['created_dt'], int(item.get('priority', 0))),
+        },
+    }
+
+
+def backfill_segment(table, segment, total_segments, dry_run=False):
+    """Scan one segment of the table, returning the counts of records updated and skipped."""
+    updated = skipped = 0
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'FilterExpression': 'attribute_not_exists(#status_shard) OR attribute_not_exists(#queue_position)',
+        'ExpressionAttributeNames': {'#status_shard': 'status_shard', '#queue_position': 'queue_position'},
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            if item['id'] in (OWNERS_ID, SLOT_LEDGER_ID) or 'status' not in item:
+                continue
+            if dry_run:
+                updated += 1
+                continue
+            try:
+                table.update_item(**backfill_update(item))
+                updated += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                skipped += 1
+        if 'LastEvaluatedKey' not in response:
+            return updated, skipped
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def backfill(table_name, segments=SCAN_SEGMENTS, dry_run=False):
+    """Backfill every legacy record with a parallel scan, returning the counts of records updated and skipped."""
+    table = boto3.resource('dynamodb').Table(table_name)
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(lambda segment: backfill_segment(table, segment, segments, dry_run), range(segments)))
+    return sum(updated for updated, _ in results), sum(skipped for _, skipped in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add status_shard and queue_position to legacy batch registry records")
+    parser.add_argument("--stack-name", type=str, default="SolutionStack",
+                        help="Stack to read the table name from when not given")
+    parser.add_argument("--table", type=str, default=None, help="Batch registry table")
+    parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS, help="Parallel scan segments")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the records to backfill")
+    args = parser.parse_args()
+
+    table_name = args.table or get_stack_output(args.stack_name, "BatchRegistryTableName")
+    start_time = time()
+    updated, skipped = backfill(table_name, args.segments, args.dry_run)
+    print(f"{'Found' if args.dry_run else 'Backfilled'} {updated} records in {time() - start_time:.2f} seconds")
+    if skipped:
+        print(f"{skipped} records changed status while being backfilled, run the script again")
+        sys.exit(1)
@@ -0,0 +1,196 @@
+"""
+Cross-shard deduplication of model inputs, for `shard_and_register.py --dedup`.
+
+Each record's `modelInput` is fingerprinted, and only the first record with a
+given fingerprint is written to a shard. The others are duplicates of that
+canonical record, which may be in an earlier ingestion run: fingerprints are
+kept in a DynamoDB text index table, `fingerprint -> (batch_id, record_id)`.
+
+Duplicates are written to `s3://<bucket>/duplicates/<batch id>/<run id>.jsonl`
+sidecars of the canonical record's batch, one `{"recordId", "canonicalRecordId"}`
+line each. The post-processor copies the canonical vectors to every duplicate
+`recordId` once the batch is post-processed.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+# BatchGetItem and BatchWriteItem limits
+LOOKUP_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 25
+DUPLICATES_PREFIX = "duplicates"
+
+
+def fingerprint(model_input: dict) -> str:
+    """128-bit hash of a record's model input, options like `dimensions` included."""
+    canonical = json.dumps(model_input, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _retry_unprocessed(call, request, unprocessed_key):
+    """Call a DynamoDB batch API until nothing is left unprocessed, backing off between attempts."""
+    responses = []
+    for attempt in range(10):
+        response = call(**request)
+        responses.append(response)
+        if not response.get(unprocessed_key):
+            return responses
+        request = dict(request, RequestItems=response[unprocessed_key])
+        time.sleep(min(2 ** attempt * 0.05, 5))
+    raise RuntimeError(f"DynamoDB kept returning {unprocessed_key} after {attempt + 1} attempts")
+
+
+class Deduplicator:
+    """
+    Decide, a block of JSONL lines at a time, which records to embed.
+
+    Fingerprints seen in this run are remembered in memory, about 150 bytes
+    per distinct text, so the text index is only read for new ones, with
+    parallel BatchGetItem calls. New fingerprints are written to the index
+    by `finish()`, after their batches are registered: a run that fails
+    half way leaves no entry pointing to a batch that doesn't exist.
+    """
+
+    def __init__(self, table_name, staging_dir, concurrency=16):
+        self.table_name = table_name
+        self.run_id = uuid.uuid4().hex[:12]
+        self.duplicates_dir = os.path.join(staging_dir, DUPLICATES_PREFIX)
+        os.makedirs(self.duplicates_dir, exist_ok=True)
+        self.unique = 0
+        self.duplicates = 0
+        self.indexed_duplicates = 0
+        self._dynamodb = boto3.client('dynamodb')
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        # fingerprint -> [batch_id, record_id, new]; batch_id is None until the record is placed in a shard
+        self._seen = {}
+        # canonical batch ids with duplicates in this run
+        self._batches = set()
+
+    def _lookup_batch(self, fingerprints):
+        request = {'RequestItems': {self.table_name: {
+            'Keys': [{'fingerprint': {'S': fp}} for fp in fingerprints],
+            'ProjectionExpression': 'fingerprint, batch_id, record_id',
+        }}}
+        items = []
+        for response in _retry_unprocessed(self._dynamodb.batch_get_item, request, 'UnprocessedKeys'):
+            items.extend(response['Responses'].get(self.table_name, []))
+        return items
+
+    def lookup(self, fingerprints) -> dict:
+        """`{fingerprint: (batch_id, record_id)}` of the fingerprints already in the text index."""
+        fingerprints = list(fingerprints)
+        chunks = [fingerprints[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(fingerprints), LOOKUP_BATCH_SIZE)]
+        found = {}
+        for items in self._executor.map(self._lookup_batch, chunks):
+            for item in items:
+                found[item['fingerprint']['S']] = (item['batch_id']['S'], item['record_id']['S'])
+        return found
+
+    def filter(self, lines):
+        """
+        Split a block of lines into the `(line, fingerprint)` of the records to
+        embed and the `(recordId, fingerprint)` of duplicates of records seen before.
+        """
+        records = [(line, json.loads(line)) for line in lines]
+        fingerprints = [fingerprint(record['modelInput']) for _, record in records]
+        unknown = {fp for fp in fingerprints if fp not in self._seen}
+        for fp, (batch_id, record_id) in self.lookup(unknown).items():
+            self._seen[fp] = [batch_id, record_id, False]
+        kept, duplicates = [], []
+        for (line, record), fp in zip(records, fingerprints):
+            seen = self._seen.get(fp)
+            if seen is None:
+                self._seen[fp] = [None, record['recordId'], True]
+                kept.append((line, fp))
+                self.unique += 1
+            elif seen[1] != record['recordId']:
+                duplicates.append((record['recordId'], fp))
+                self.duplicates += 1
+                if not seen[2]:
+                    self.indexed_duplicates += 1
+        return kept, duplicates
+
+    def placed(self, fp, batch_id):
+        """Record the batch a record returned by `filter` was written to."""
+        self._seen[fp][0] = batch_id
+
+    def write_duplicates(self, duplicates):
+        """
+        Append duplicates to the local sidecar of their canonical record's batch.
+
+        Returns the duplicates whose canonical record is not placed in a shard
+        yet, to be passed again once it is.
+        """
+        by_batch = {}
+        unplaced = []
+        for record_id, fp in duplicates:
+            batch_id, canonical_id, _ = self._seen[fp]
+            if batch_id is None:
+                unplaced.append((record_id, fp))
+                continue
+            by_batch.setdefault(batch_id, []).append({'recordId': record_id, 'canonicalRecordId': canonical_id})
+        for batch_id, lines in by_batch.items():
+            self._batches.add(batch_id)
+            with open(os.path.join(self.duplicates_dir, f"{batch_id}.jsonl"), 'a') as f:
+                f.writelines(json.dumps(line) + '\n' for line in lines)
+        return unplaced
+
+    def _write_index_batch(self, entries):
+        request = {'RequestItems': {self.table_name: [
+            {'PutRequest': {'Item': {
+                'fingerprint': {'S': fp},
+                'batch_id': {'S': batch_id},
+                'record_id': {'S': record_id},
+            }}}
+            for fp, batch_id, record_id in entries
+        ]}}
+        _retry_unprocessed(self._dynamodb.batch_write_item, request, 'UnprocessedItems')
+
+    def finish(self, s3, bucket_name, registry_table_name, postprocess_function=None):
+        """
+        Once every shard is registered: upload the duplicates sidecars, add the
+        new fingerprints to the text index, and have the post-processor fan out
+        the duplicates of batches it is already done with.
+
+        Returns the ids of the batches fanned out again.
+        """
+        for batch_id in self._batches:
+            s3.upload_file(os.path.join(self.duplicates_dir, f"{batch_id}.jsonl"), bucket_name,
+                           f"{DUPLICATES_PREFIX}/{batch_id}/{self.run_id}.jsonl")
+
+        entries = [(fp, batch_id, record_id) for fp, (batch_id, record_id, new) in self._seen.items() if new]
+        chunks = [entries[i:i + WRITE_BATCH_SIZE] for i in range(0, len(entries), WRITE_BATCH_SIZE)]
+        list(self._executor.map(self._write_index_batch, chunks))
+        self._executor.shutdown()
+
+        # the post-processor lists the sidecars after marking a batch post-processed,
+        # and the sidecars are uploaded before reading that mark, so a batch
+        # finishing meanwhile is fanned out by one or the other, maybe by both
+        postprocessed = []
+        batch_ids = sorted(self._batches)
+        for i in range(0, len(batch_ids), LOOKUP_BATCH_SIZE):
+            request = {'RequestItems': {registry_table_name: {
+                'Keys': [{'id': {'S': batch_id}} for batch_id in batch_ids[i:i + LOOKUP_BATCH_SIZE]],
+                'ProjectionExpression': 'id, postprocessed_at',
+                'ConsistentRead': True,
+            }}}
+            for response in _retry_unprocessed(self._dynamodb.batch_get_item, request, 'UnprocessedKeys'):
+                postprocessed.extend(item['id']['S'] for item in response['Responses'].get(registry_table_name, [])
+                                     if 'postprocessed_at' in item)
+        if postprocess_function:
+            lambda_client = boto3.client('lambda')
+            for batch_id in postprocessed:
+                lambda_client.invoke(
+                    FunctionName=postprocess_function,
+                    InvocationType='Event',
+                    Payload=json.dumps({'id': batch_id, 'fan_out_only': True}).encode('utf-8'),
+                )
+        elif postprocessed:
+            print(f"[WARNING] {len(postprocessed)} batches with new duplicates are already post-processed, "
+                  f"invoke the post-processor with {{\"id\": ..., \"fan_out_only\": true}} for them")
+        return postprocessed
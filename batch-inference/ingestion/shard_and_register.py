@@ -0,0 +1,336 @@
+import os
+import sys
+import uuid
+import zlib
+import argparse
+import tempfile
+from collections import deque
+from itertools import islice
+from time import perf_counter as time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from dedup import Deduplicator
+
+
+# Bedrock batch inference limits for a single input file, see
+# https://docs.aws.amazon.com/bedrock/latest/userguide/quotas.html
+MAX_RECORDS_PER_SHARD = 50000
+MIN_RECORDS_PER_SHARD = 100
+MAX_BYTES_PER_SHARD = 1024 * 1024 * 1024  # 1 GB
+# lines read at once; with --dedup, the text index is looked up a block at a time
+READ_BLOCK_LINES = 10000
+
+PENDING_EMBEDDING_BATCH_STATUS = "Pending"
+# must match STATUS_SHARDS of the deployed stack
+STATUS_SHARDS = 10
+DEFAULT_OWNER = "default"
+# registry item listing every owner that ever registered a batch
+OWNERS_ID = "__owners__"
+# each priority level moves a batch this far ahead in its owner's queue
+PRIORITY_BOOST_SECONDS = 3600
+
+# parallel shard uploads, and parts per shard uploaded in parallel
+UPLOAD_CONCURRENCY = 16
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=8,
+)
+
+
+def get_stack_output(stack_name, output_key):
+    response = boto3.client('cloudformation').describe_stacks(StackName=stack_name)
+    for output in response['Stacks'][0]['Outputs']:
+        if output['OutputKey'] == output_key:
+            return output['OutputValue']
+    return None
+
+
+def new_batch_id():
+    return str(uuid.uuid4())[:12]
+
+
+def read_lines(data_file):
+    """Non-empty lines of a JSONL file, each ending with a newline."""
+    with open(data_file, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            yield line if line.endswith(b'\n') else line + b'\n'
+
+
+def shard_limits_error(data_file, max_records, max_bytes):
+    return (f"Can't split {data_file} into shards of {MIN_RECORDS_PER_SHARD} to {max_records} records "
+            f"and at most {max_bytes} bytes, its lines are too large")
+
+
+class _Shard:
+    """
+    A local shard file being written. Its last MIN_RECORDS_PER_SHARD lines
+    are held back in memory until `finish()`, so they can still be moved to
+    a following shard that would otherwise be too small.
+    """
+
+    def __init__(self, staging_dir, dedup=None):
+        self.batch_id = new_batch_id()
+        self.path = os.path.join(staging_dir, f"{self.batch_id}.jsonl")
+        self.dedup = dedup
+        self.records = 0
+        self.size = 0
+        self.tail = deque()
+        self._f = open(self.path, 'wb')
+
+    def add(self, line, fp=None):
+        self.tail.append((line, fp))
+        self.records += 1
+        self.size += len(line)
+        if len(self.tail) > MIN_RECORDS_PER_SHARD:
+            self._write(*self.tail.popleft())
+
+    def take_tail(self, count):
+        """Remove the last `count` lines, returning them as `(line, fingerprint)` pairs."""
+        lines = [self.tail.pop() for _ in range(count)]
+        self.records -= count
+        self.size -= sum(len(line) for line, _ in lines)
+        return lines
+
+    def _write(self, line, fp):
+        self._f.write(line)
+        if fp is not None:
+            self.dedup.placed(fp, self.batch_id)
+
+    def finish(self):
+        while self.tail:
+            self._write(*self.tail.popleft())
+        self._f.close()
+        return self.batch_id, self.path, self.records
+
+
+def split_into_shards(data_file, staging_dir, max_records=MAX_RECORDS_PER_SHARD, max_bytes=MAX_BYTES_PER_SHARD,
+                      dedup=None):
+    """
+    Stream a JSONL file into local shard files sized for a single batch job.
+
+    Yields `(batch_id, shard_path, record_count)` as soon as each shard is
+    closed and the one after it holds MIN_RECORDS_PER_SHARD records, so
+    uploads can start while the rest of the input is still being split. A
+    last shard left under the minimum takes lines from the end of the one
+    before it; an input with fewer records than the minimum raises
+    ValueError. Lines are read in blocks of READ_BLOCK_LINES; with a
+    `dedup.Deduplicator`, only the records of each block with an input not
+    seen before are written to the shards.
+    """
+    if max_records < MIN_RECORDS_PER_SHARD:
+        raise ValueError(f"max_records {max_records} is below the batch job minimum of {MIN_RECORDS_PER_SHARD}")
+    # a full shard, kept open until the current one is known to reach the minimum
+    previous = None
+    shard = None
+    # duplicates of records still held back in a shard's tail
+    deferred = []
+    lines = read_lines(data_file)
+    while True:
+        block = list(islice(lines, READ_BLOCK_LINES))
+        if not block:
+            break
+        if dedup is not None:
+            kept, duplicates = dedup.filter(block)
+        else:
+            kept, duplicates = [(line, None) for line in block], []
+        for line, fp in kept:
+            if shard is not None and (shard.records >= max_records or shard.size + len(line) > max_bytes):
+                if shard.records < MIN_RECORDS_PER_SHARD:
+                    raise ValueError(shard_limits_error(data_file, max_records, max_bytes))
+                if previous is not None:
+                    yield previous.finish()
+                previous, shard = shard, None
+            if shard is None:
+                shard = _Shard(staging_dir, dedup)
+            shard.add(line, fp)
+            if previous is not None and shard.records >= MIN_RECORDS_PER_SHARD:
+                yield previous.finish()
+                previous = None
+        if dedup is not None:
+            deferred = dedup.write_duplicates(deferred + duplicates)
+    if shard is None:
+        return
+
+    if shard.records < MIN_RECORDS_PER_SHARD:
+        if previous is None:
+            shard.finish()
+            os.remove(shard.path)
+            raise ValueError(f"{data_file} has {shard.records} records"
+                             f"{' left after deduplication' if dedup is not None else ''}, "
+                             f"a batch job needs at least {MIN_RECORDS_PER_SHARD}")
+        # rebalance with the full shard before it, which has lines to spare
+        # unless its lines are so large that it filled up in bytes first
+        for line, fp in previous.take_tail(MIN_RECORDS_PER_SHARD - shard.records):
+            shard.add(line, fp)
+        if previous.records < MIN_RECORDS_PER_SHARD or shard.size > max_bytes:
+            raise ValueError(shard_limits_error(data_file, max_records, max_bytes))
+    finished = [previous.finish()] if previous is not None else []
+    finished.append(shard.finish())
+    if dedup is not None:
+        dedup.write_duplicates(deferred)
+    yield from finished
+
+
+def upload_shard(s3, shard_path, bucket_name, key, keep_local=False):
+    s3.upload_file(shard_path, bucket_name, key, Config=TRANSFER_CONFIG)
+    if not keep_local:
+        os.remove(shard_path)
+
+
+def status_shard(batch_id, status, owner=DEFAULT_OWNER):
+    """Sharded status key of a record, as computed by the Lambda functions."""
+    return f"{status}#{owner}#{zlib.crc32(batch_id.encode('utf-8')) % STATUS_SHARDS}"
+
+
+def queue_position(created_dt, priority=0):
+    """Sort key within an owner's queue: earlier runs first, each priority level
+    counting as PRIORITY_BOOST_SECONDS of extra waiting time."""
+    return int(datetime.fromisoformat(created_dt).timestamp()) - priority * PRIORITY_BOOST_SECONDS
+
+
+def registry_item(batch_id, data_s3_uri, created_dt, record_count, owner=DEFAULT_OWNER, priority=0):
+    """Batch registry record picked up by the runner Lambda."""
+    return {
+        'id': batch_id,
+        'data_s3_uri': data_s3_uri,
+        'created_dt': created_dt,
+        'status': PENDING_EMBEDDING_BATCH_STATUS,
+        'status_shard': status_shard(batch_id, PENDING_EMBEDDING_BATCH_STATUS, owner),
+        'queue_position': queue_position(created_dt, priority),
+        'owner': owner,
+        'priority': priority,
+        'record_count': record_count,
+    }
+
+
+def shard_and_register(data_file, bucket_name, table_name, prefix="input", staging_dir=None,
+                       max_records=MAX_RECORDS_PER_SHARD, max_bytes=MAX_BYTES_PER_SHARD,
+                       concurrency=UPLOAD_CONCURRENCY, keep_local=False, owner=DEFAULT_OWNER, priority=0,
+                       text_index_table=None, postprocess_function=None):
+    """
+    Split `data_file` into batch job sized shards, upload them to
+    `s3://{bucket_name}/{prefix}/{batch_id}/data.jsonl` in parallel and
+    register each uploaded shard as a Pending record with batched writes.
+
+    A shard is only registered once its upload has completed, so the runner
+    never picks up a partial input file. The batches are queued under `owner`
+    with `priority` for the runner's fair-share scheduling.
+
+    With `text_index_table`, records whose model input was already registered,
+    in this run or an earlier one, are left out of the shards and written to
+    duplicates sidecars instead (see `dedup.py`). `postprocess_function` is
+    invoked to fan out the duplicates of batches already post-processed.
+    """
+    s3 = boto3.client('s3')
+    table = boto3.resource('dynamodb').Table(table_name)
+    staging_dir = staging_dir or tempfile.mkdtemp(prefix="batch-shards-")
+    created_dt = datetime.now(timezone.utc).isoformat()
+    dedup = Deduplicator(text_index_table, staging_dir, concurrency) if text_index_table else None
+
+    # make the owner's queue visible to the runner
+    if owner != DEFAULT_OWNER:
+        table.update_item(
+            Key={'id': OWNERS_ID},
+            UpdateExpression='ADD #owners :owner',
+            ExpressionAttributeNames={'#owners': 'owners'},
+            ExpressionAttributeValues={':owner': {owner}}
+        )
+
+    registered = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, table.batch_writer() as batch:
+        pending = {}
+
+        def register_completed(return_when):
+            nonlocal registered
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                item = pending.pop(future)
+                future.result()
+                batch.put_item(Item=item)
+                registered += 1
+
+        for batch_id, shard_path, record_count in split_into_shards(data_file, staging_dir, max_records, max_bytes, dedup):
+            key = f"{prefix}/{batch_id}/data.jsonl"
+            item = registry_item(batch_id, f"s3://{bucket_name}/{key}", created_dt, record_count, owner, priority)
+            pending[executor.submit(upload_shard, s3, shard_path, bucket_name, key, keep_local)] = item
+
+            # keep a bounded number of shards staged locally
+            if len(pending) >= concurrency * 2:
+                register_completed(FIRST_COMPLETED)
+
+        while pending:
+            register_completed(FIRST_COMPLETED)
+
+    if dedup is not None:
+        refreshed = dedup.finish(s3, bucket_name, table_name, postprocess_function)
+        print(f"Deduplicated {dedup.unique + dedup.duplicates} records: {dedup.unique} to embed, "
+              f"{dedup.duplicates} duplicates ({dedup.indexed_duplicates} of earlier runs), "
+              f"{len(refreshed)} post-processed batches to fan out again")
+    return registered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard a JSONL file, upload the shards and register them as Pending batches")
+    parser.add_argument("data_file", type=str, help="The batch inference JSONL file to ingest")
+    parser.add_argument("--stack-name", type=str, default="SolutionStack",
+                        help="Stack to read the bucket and table names from when not given")
+    parser.add_argument("--bucket", type=str, default=None, help="Input data bucket")
+    parser.add_argument("--table", type=str, default=None, help="Batch registry table")
+    parser.add_argument("--prefix", type=str, default="input", help="S3 key prefix of the shards")
+    parser.add_argument("--max-records", type=int, default=MAX_RECORDS_PER_SHARD,
+                        help="Max records per shard")
+    parser.add_argument("--max-bytes", type=int, default=MAX_BYTES_PER_SHARD,
+                        help="Max bytes per shard")
+    parser.add_argument("--concurrency", type=int, default=UPLOAD_CONCURRENCY,
+                        help="Number of shards uploaded in parallel")
+    parser.add_argument("--staging-dir", type=str, default=None,
+                        help="Local directory for the shards before upload, a temp dir by default")
+    parser.add_argument("--keep-local", action="store_true", help="Keep the local shards after upload")
+    parser.add_argument("--owner", type=str, default=DEFAULT_OWNER,
+                        help="Team or tenant the batches are scheduled for, slots are shared fairly between owners")
+    parser.add_argument("--priority", type=int, default=0,
+                        help=f"Higher runs earlier within the owner's queue, each level is worth {PRIORITY_BOOST_SECONDS}s of waiting")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Only embed model inputs not registered before, results are copied to the duplicates")
+    parser.add_argument("--text-index-table", type=str, default=None,
+                        help="Text index table of --dedup, read from the stack when not given")
+    parser.add_argument("--postprocess-function", type=str, default=None,
+                        help="Post-processor to fan out the new duplicates of finished batches, read from the stack when not given")
+    args = parser.parse_args()
+    if not os.path.exists(args.data_file):
+        print(f"Error: {args.data_file} is not an existing file")
+        sys.exit(1)
+
+    bucket_name = args.bucket or get_stack_output(args.stack_name, "DataS3BucketName")
+    table_name = args.table or get_stack_output(args.stack_name, "BatchRegistryTableName")
+    text_index_table, postprocess_function = None, None
+    if args.dedup:
+        text_index_table = args.text_index_table or get_stack_output(args.stack_name, "TextIndexTableName")
+        postprocess_function = args.postprocess_function or get_stack_output(args.stack_name, "PostProcessFunctionName")
+
+    start_time = time()
+    try:
+        count = shard_and_register(
+            args.data_file, bucket_name, table_name,
+            prefix=args.prefix,
+            staging_dir=args.staging_dir,
+            max_records=args.max_records,
+            max_bytes=args.max_bytes,
+            concurrency=args.concurrency,
+            keep_local=args.keep_local,
+            owner=args.owner,
+            priority=args.priority,
+            text_index_table=text_index_table,
+            postprocess_function=postprocess_function
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Registered {count} batches in {time() - start_time:.2f} seconds")
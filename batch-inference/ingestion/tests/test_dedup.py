@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+from dedup import DUPLICATES_PREFIX, Deduplicator, fingerprint
+from shard_and_register import MIN_RECORDS_PER_SHARD, split_into_shards
+
+BUCKET = "embedding-bucket"
+TEXT_INDEX_TABLE = "embedding-text-index"
+REGISTRY_TABLE = "embedding-batch-registry"
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in (("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "testing"),
+                        ("AWS_SECRET_ACCESS_KEY", "testing")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        dynamodb = boto3.resource("dynamodb")
+        for table_name, key in ((TEXT_INDEX_TABLE, "fingerprint"), (REGISTRY_TABLE, "id")):
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        yield s3, dynamodb
+
+
+def write_records(path, texts):
+    with open(path, 'w') as f:
+        for record_id, text in texts:
+            f.write(json.dumps({'recordId': record_id, 'modelInput': {'inputText': text}}) + '\n')
+    return str(path)
+
+
+def split(data_file, staging_dir, max_records=150):
+    dedup = Deduplicator(TEXT_INDEX_TABLE, str(staging_dir))
+    shards = {}
+    for batch_id, path, _ in split_into_shards(data_file, str(staging_dir), max_records=max_records, dedup=dedup):
+        with open(path) as f:
+            shards[batch_id] = [json.loads(line)['recordId'] for line in f]
+    return dedup, shards
+
+
+def batch_of(shards, record_id):
+    return next(batch_id for batch_id, record_ids in shards.items() if record_id in record_ids)
+
+
+def read_sidecars(duplicates_dir):
+    return {
+        name[:-len('.jsonl')]: [json.loads(line) for line in open(os.path.join(duplicates_dir, name))]
+        for name in os.listdir(duplicates_dir)
+    }
+
+
+def test_fingerprint_covers_the_whole_model_input():
+    assert fingerprint({'inputText': 'a', 'dimensions': 256}) == fingerprint({'dimensions': 256, 'inputText': 'a'})
+    assert fingerprint({'inputText': 'a', 'dimensions': 256}) != fingerprint({'inputText': 'a', 'dimensions': 512})
+
+
+def test_duplicates_across_shards_point_to_the_canonical_batch(aws, tmp_path):
+    # 300 distinct texts, then a repeat of the first and of the last one; the
+    # last is still held back in its shard's tail when its repeat is read
+    texts = [(f"r{i}", f"text {i}") for i in range(300)] + [("d0", "text 0"), ("d299", "text 299")]
+    dedup, shards = split(write_records(tmp_path / 'data.jsonl', texts), tmp_path / 'staging')
+
+    assert sorted(len(record_ids) for record_ids in shards.values()) == [150, 150]
+    assert not {'d0', 'd299'} & {record_id for record_ids in shards.values() for record_id in record_ids}
+    assert (dedup.unique, dedup.duplicates, dedup.indexed_duplicates) == (300, 2, 0)
+    sidecars = read_sidecars(dedup.duplicates_dir)
+    assert sidecars == {
+        batch_of(shards, 'r0'): [{'recordId': 'd0', 'canonicalRecordId': 'r0'}],
+        batch_of(shards, 'r299'): [{'recordId': 'd299', 'canonicalRecordId': 'r299'}],
+    }
+
+
+def test_finish_uploads_sidecars_and_indexes_new_fingerprints(aws, tmp_path):
+    s3, dynamodb = aws
+    texts = [(f"r{i}", f"text {i}") for i in range(MIN_RECORDS_PER_SHARD)] + [("d1", "text 1")]
+    dedup, shards = split(write_records(tmp_path / 'data.jsonl', texts), tmp_path / 'staging')
+    [batch_id] = shards
+
+    assert dedup.finish(s3, BUCKET, REGISTRY_TABLE) == []
+    key = f"{DUPLICATES_PREFIX}/{batch_id}/{dedup.run_id}.jsonl"
+    sidecar = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read().decode('utf-8')
+    assert [json.loads(line) for line in sidecar.splitlines()] == [{'recordId': 'd1', 'canonicalRecordId': 'r1'}]
+    index = dynamodb.Table(TEXT_INDEX_TABLE).scan()['Items']
+    assert len(index) == MIN_RECORDS_PER_SHARD
+    assert {(item['batch_id'], item['record_id']) for item in index} == {(batch_id, f"r{i}") for i in range(MIN_RECORDS_PER_SHARD)}
+
+
+def test_later_run_fans_out_to_batches_already_post_processed(aws, tmp_path):
+    s3, dynamodb = aws
+    first = [(f"r{i}", f"text {i}") for i in range(MIN_RECORDS_PER_SHARD)]
+    dedup, shards = split(write_records(tmp_path / 'first.jsonl', first), tmp_path / 'first')
+    dedup.finish(s3, BUCKET, REGISTRY_TABLE)
+    [first_batch] = shards
+    dynamodb.Table(REGISTRY_TABLE).put_item(Item={'id': first_batch, 'postprocessed_at': '2026-01-01T00:00:00+00:00'})
+
+    second = [("again-r5", "text 5")] + [(f"n{i}", f"new text {i}") for i in range(MIN_RECORDS_PER_SHARD)]
+    dedup, shards = split(write_records(tmp_path / 'second.jsonl', second), tmp_path / 'second')
+    assert (dedup.unique, dedup.duplicates, dedup.indexed_duplicates) == (MIN_RECORDS_PER_SHARD, 1, 1)
+    assert 'again-r5' not in next(iter(shards.values()))
+    assert read_sidecars(dedup.duplicates_dir) == {first_batch: [{'recordId': 'again-r5', 'canonicalRecordId': 'r5'}]}
+    # without a post-processor to invoke, the batch to fan out again is returned
+    assert dedup.finish(s3, BUCKET, REGISTRY_TABLE) == [first_batch]
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import shard_and_register
+from shard_and_register import MIN_RECORDS_PER_SHARD, split_into_shards
+
+
+def write_records(path, count, text_size=10):
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(json.dumps({'recordId': f"r{i}", 'modelInput': {'inputText': f"{i:0{text_size}d}"}}) + '\n')
+    return str(path)
+
+
+def shard_record_ids(shards):
+    ids = []
+    for _, path, records in shards:
+        with open(path) as f:
+            lines = [json.loads(line)['recordId'] for line in f]
+        assert len(lines) == records
+        ids.append(lines)
+    return ids
+
+
+def test_exact_multiple_fills_every_shard(tmp_path):
+    data_file = write_records(tmp_path / 'data.jsonl', 3 * 150)
+    shards = list(split_into_shards(data_file, str(tmp_path), max_records=150))
+    ids = shard_record_ids(shards)
+    assert [len(shard) for shard in ids] == [150, 150, 150]
+    assert sum(ids, []) == [f"r{i}" for i in range(450)]
+    assert len({batch_id for batch_id, _, _ in shards}) == 3
+
+
+def test_tail_below_the_minimum_takes_lines_from_the_shard_before(tmp_path):
+    data_file = write_records(tmp_path / 'data.jsonl', 2 * 200 + 30)
+    ids = shard_record_ids(split_into_shards(data_file, str(tmp_path), max_records=200))
+    assert [len(shard) for shard in ids] == [200, 200 - (MIN_RECORDS_PER_SHARD - 30), MIN_RECORDS_PER_SHARD]
+    # the lines moved come from the end of the shard before, none lost or repeated
+    assert ids[0] + ids[1] == [f"r{i}" for i in range(330)]
+    assert sorted(ids[2]) == sorted(f"r{i}" for i in range(330, 430))
+
+
+def test_input_below_the_minimum_is_refused(tmp_path):
+    data_file = write_records(tmp_path / 'data.jsonl', MIN_RECORDS_PER_SHARD - 1)
+    with pytest.raises(ValueError, match="a batch job needs at least"):
+        list(split_into_shards(data_file, str(tmp_path), max_records=150))
+
+
+def test_tail_the_shard_before_cannot_spare_is_refused(tmp_path):
+    data_file = write_records(tmp_path / 'data.jsonl', 150 + 30)
+    with pytest.raises(ValueError, match="its lines are too large"):
+        list(split_into_shards(data_file, str(tmp_path), max_records=150))
+
+
+def test_tail_of_a_shard_full_in_bytes_is_refused(tmp_path):
+    # each shard fills up in bytes at the minimum, so none has lines to spare
+    data_file = write_records(tmp_path / 'data.jsonl', MIN_RECORDS_PER_SHARD + 10, text_size=100)
+    line_size = len(open(data_file, 'rb').readline())
+    with pytest.raises(ValueError, match="its lines are too large"):
+        list(split_into_shards(data_file, str(tmp_path), max_bytes=MIN_RECORDS_PER_SHARD * line_size))
+
+
+def test_blocks_do_not_change_the_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(shard_and_register, 'READ_BLOCK_LINES', 7)
+    data_file = write_records(tmp_path / 'data.jsonl', 2 * 200 + 30)
+    ids = shard_record_ids(split_into_shards(data_file, str(tmp_path), max_records=200))
+    assert [len(shard) for shard in ids] == [200, 130, MIN_RECORDS_PER_SHARD]
@@ -0,0 +1,131 @@
+"""
+Cold start benchmark for the Lambda functions.
+
+Every sample runs in a fresh interpreter, like a new Lambda execution
+environment, and measures:
+
+* import: importing the handler module
+* init: building the AWS clients its first invocation needs
+
+No AWS call is made, the clients are only constructed. Pass `--layer` to
+import boto3 from the built layer the way Lambda does from /opt/python, and
+`--max-import-ms` / `--max-init-ms` to fail (exit code 1) when a median
+goes over budget, e.g. in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SOLUTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(SOLUTION_DIR, "lambda")
+# stdlib only modules the layer gets from the on-demand tools, see build_layer.py
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(SOLUTION_DIR)), "on-demand-invocation")
+
+# handler module -> AWS clients its first invocation builds
+FUNCTIONS = {
+    "runner": ["bedrock"],
+    "monitor": ["bedrock", "lambda"],
+    "postprocess": ["s3"],
+}
+
+FAKE_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "TABLE_NAME": "embedding-batch-registry",
+    "MODEL_ID": "amazon.titan-embed-text-v2:0",
+    "BATCH_JOB_S3_OUTPUT_URI": "s3://benchmark/output/",
+    "IAM_ROLE_ARN": "arn:aws:iam::123456789012:role/benchmark",
+    "EMBEDDINGS_S3_URI": "s3://benchmark/embeddings/",
+    "RESUBMIT_S3_URI": "s3://benchmark/input/",
+    "DUPLICATES_S3_URI": "s3://benchmark/duplicates/",
+}
+
+SAMPLE = """
+import importlib, io, json, sys
+from contextlib import redirect_stdout
+from time import perf_counter
+sys.path[:0] = {paths!r}
+start = perf_counter()
+with redirect_stdout(io.StringIO()):
+    importlib.import_module({module!r})
+imported = perf_counter()
+import clients
+for service_name in {services!r}:
+    clients.client(service_name)
+clients.registry_table()
+initialized = perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "init_ms": (initialized - imported) * 1000}}))
+"""
+
+
+def run_sample(module, services, layer=None, cold_bytecode=False):
+    # without a layer, the modules it gets from on-demand-invocation are
+    # imported from there, after lambda/ whose metrics.py shares a name
+    paths = ([layer] if layer else []) + [LAMBDA_DIR] + ([] if layer else [SHARED_DIR])
+    env = dict(os.environ, **FAKE_ENVIRONMENT)
+    with tempfile.TemporaryDirectory() as pycache:
+        if cold_bytecode:
+            # nothing precompiled: every module is compiled from source
+            env["PYTHONPYCACHEPREFIX"] = pycache
+        out = subprocess.run(
+            [sys.executable, "-c", SAMPLE.format(paths=paths, module=module, services=services)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def benchmark(functions, repeat, layer=None, cold_bytecode=False):
+    results = {}
+    for module in functions:
+        # first sample only warms the OS file cache
+        run_sample(module, FUNCTIONS[module], layer, cold_bytecode)
+        samples = [run_sample(module, FUNCTIONS[module], layer, cold_bytecode) for _ in range(repeat)]
+        results[module] = {
+            key: {
+                "median": statistics.median(s[key] for s in samples),
+                "max": max(s[key] for s in samples),
+            }
+            for key in ("import_ms", "init_ms")
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import and client init time of the Lambda handlers")
+    parser.add_argument("--functions", type=str, default=",".join(FUNCTIONS),
+                        help="Comma separated handler modules to measure")
+    parser.add_argument("--repeat", type=int, default=10, help="Fresh interpreters per function")
+    parser.add_argument("--layer", type=str, default=None,
+                        help="Layer python directory to import boto3 from, e.g. lambda-layer/python")
+    parser.add_argument("--cold-bytecode", action="store_true",
+                        help="Ignore existing .pyc files, as for a layer that wasn't byte-compiled")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Fail if a median import time is higher")
+    parser.add_argument("--max-init-ms", type=float, default=None, help="Fail if a median init time is higher")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    functions = [f.strip() for f in args.functions.split(",") if f.strip()]
+    results = benchmark(functions, args.repeat, args.layer, args.cold_bytecode)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'function':<12} {'import median':>14} {'import max':>11} {'init median':>12} {'init max':>9}")
+        for module, r in results.items():
+            print(f"{module:<12} {r['import_ms']['median']:>12.1f}ms {r['import_ms']['max']:>9.1f}ms "
+                  f"{r['init_ms']['median']:>10.1f}ms {r['init_ms']['max']:>7.1f}ms")
+
+    over_budget = [
+        f"{module} {key} {r[key]['median']:.1f}ms > {limit}ms"
+        for module, r in results.items()
+        for key, limit in (("import_ms", args.max_import_ms), ("init_ms", args.max_init_ms))
+        if limit is not None and r[key]["median"] > limit
+    ]
+    if over_budget:
+        print("Over budget: " + ", ".join(over_budget))
+        sys.exit(1)
@@ -0,0 +1,528 @@
+"""
+Simulated-clock replay of the batch scheduler.
+
+Runs the real `runner.handler` and `monitor.handler` against in-memory
+stand-ins for the registry table, the Bedrock batch control plane, Lambda
+async invokes and the two EventBridge rules (the runner schedule and the job
+state change rule), on a simulated clock, so a backlog that takes days to
+drain replays in seconds. Each record becomes one batch job whose runtime
+is drawn from a log-normal distribution. Reports:
+
+* makespan, next to a lower bound from the drawn job times
+* slot utilization, and slot-hours left idle while records were waiting
+* queue wait of the records, from registration to job creation
+* runner and monitor invocations, and API calls per service operation
+
+The handlers take no simulated time; only job runtimes, event delivery and
+async invoke delays advance the clock. Pass `--min-utilization` or
+`--max-makespan-hours` to exit with 1 when a run misses its target.
+"""
+import argparse
+import copy
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import uuid
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+SOLUTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(SOLUTION_DIR, "lambda")
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+TERMINAL_JOB_STATUSES = ("Completed", "Failed")
+
+FAKE_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "TABLE_NAME": "embedding-batch-registry",
+    "MODEL_ID": "amazon.titan-embed-text-v2:0",
+    "BATCH_JOB_S3_OUTPUT_URI": "s3://simulation/output/",
+    "IAM_ROLE_ARN": "arn:aws:iam::123456789012:role/simulation",
+    "RUNNER_FUNCTION_NAME": "runner",
+    "POSTPROCESS_FUNCTION_NAME": "postprocess",
+}
+
+# index name -> (partition key, sort key, projected attributes or None for ALL),
+# as declared in solution_stack.py
+INDEXES = {
+    "status-shard-index": ("status_shard", "queue_position",
+                           ["status", "data_s3_uri", "claimed_at", "batch_job_name", "owner", "priority"]),
+    "batch-job-arn-index": ("batch_job_arn", "created_dt", None),
+}
+
+
+class SimClock:
+    """Event queue ordered on simulated epoch seconds."""
+
+    def __init__(self, start=START):
+        self.now = start
+        self._events = []
+        self._sequence = itertools.count()
+
+    def schedule(self, delay, action, *args):
+        heapq.heappush(self._events, (self.now + delay, next(self._sequence), action, args))
+
+    def run(self, until):
+        while self._events and self._events[0][0] <= until:
+            self.now, _, action, args = heapq.heappop(self._events)
+            action(*args)
+        return bool(self._events)
+
+
+def sim_datetime(clock):
+    """`datetime` whose now() follows the simulated clock, patched into the handler modules."""
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.now, tz)
+    return SimDatetime
+
+
+def client_error(code, operation_name):
+    return ClientError({'Error': {'Code': code, 'Message': f'simulated {code}'}}, operation_name)
+
+
+def to_dynamo(value):
+    """Numbers come back from DynamoDB as Decimal, so store them that way."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    return value
+
+
+UPDATE_CLAUSE = re.compile(r'\b(SET|REMOVE|ADD)\b')
+FUNCTION_CONDITION = re.compile(r'(attribute_exists|attribute_not_exists)\((\S+)\)')
+COMPARISON_CONDITION = re.compile(r'(\S+)\s*(<>|<=|>=|=|<|>)\s*(\S+)')
+COMPARISONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+
+
+def evaluate_condition(item, expression, names, values):
+    """AND/OR of comparisons and attribute_(not_)exists, as used by the handlers (no parentheses)."""
+    def atom(text):
+        match = FUNCTION_CONDITION.fullmatch(text)
+        if match:
+            exists = names.get(match.group(2), match.group(2)) in item
+            return exists if match.group(1) == 'attribute_exists' else not exists
+        name, comparison, value = COMPARISON_CONDITION.fullmatch(text).groups()
+        current = item.get(names.get(name, name))
+        return current is not None and COMPARISONS[comparison](current, values[value])
+
+    if not expression:
+        return True
+    return any(all(atom(a.strip()) for a in disjunct.split(' AND ')) for disjunct in expression.split(' OR '))
+
+
+def apply_update(item, expression, names, values):
+    parts = UPDATE_CLAUSE.split(expression)
+    for action, body in zip(parts[1::2], parts[2::2]):
+        for clause in body.split(','):
+            clause = clause.strip()
+            if action == 'SET':
+                name, value = (s.strip() for s in clause.split('='))
+                item[names.get(name, name)] = values[value]
+            elif action == 'REMOVE':
+                item.pop(names.get(clause, clause), None)
+            else:
+                name, value = clause.split()
+                name = names.get(name, name)
+                if isinstance(values[value], set):
+                    item[name] = item.get(name, set()) | values[value]
+                else:
+                    item[name] = item.get(name, 0) + values[value]
+
+
+class FakeTable:
+    """In-memory registry table with the subset of the resource API the handlers use."""
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.items = {}
+        self.calls = calls
+        self.lock = threading.RLock()
+        self.meta = type('Meta', (), {'client': FakeDynamoClient(self)})()
+
+    def get_item(self, Key, ConsistentRead=False):
+        with self.lock:
+            self.calls['dynamodb.GetItem'] += 1
+            item = self.items.get(Key['id'])
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        with self.lock:
+            self.calls['dynamodb.PutItem'] += 1
+            current = self.items.get(Item['id'], {})
+            if not evaluate_condition(current, ConditionExpression, ExpressionAttributeNames or {},
+                                      to_dynamo(ExpressionAttributeValues or {})):
+                raise client_error('ConditionalCheckFailedException', 'PutItem')
+            self.items[Item['id']] = to_dynamo(Item)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        with self.lock:
+            self.calls['dynamodb.UpdateItem'] += 1
+            self._update(Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+
+    def _check(self, key, condition, names, values):
+        current = self.items.get(key['id'], {})
+        return evaluate_condition(current, condition, names or {}, to_dynamo(values or {}))
+
+    def _update(self, key, expression, condition, names, values, check=True):
+        if check and not self._check(key, condition, names, values):
+            raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+        item = self.items.setdefault(key['id'], {'id': key['id']})
+        apply_update(item, expression, names or {}, to_dynamo(values or {}))
+
+    def query(self, IndexName, KeyConditionExpression, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None):
+        with self.lock:
+            self.calls['dynamodb.Query'] += 1
+            partition_key, sort_key, projection = INDEXES[IndexName]
+            key_name, key_value = KeyConditionExpression.get_expression()['values']
+            assert key_name.name == partition_key, f"{IndexName} is keyed on {partition_key}"
+            matches = sorted(
+                (item for item in self.items.values() if item.get(partition_key) == key_value and sort_key in item),
+                key=lambda item: (item[sort_key], item['id']), reverse=not ScanIndexForward
+            )
+            if ExclusiveStartKey is not None:
+                ids = [item['id'] for item in matches]
+                matches = matches[ids.index(ExclusiveStartKey['id']) + 1:]
+            page = matches[:Limit] if Limit is not None else matches
+            if projection is not None:
+                keep = {'id', partition_key, sort_key, *projection}
+                page = [{k: v for k, v in item.items() if k in keep} for item in page]
+            response = {'Items': copy.deepcopy(page), 'Count': len(page)}
+            if Limit is not None and len(matches) > Limit:
+                last = page[-1]
+                response['LastEvaluatedKey'] = {'id': last['id'], partition_key: last[partition_key], sort_key: last[sort_key]}
+            return response
+
+
+class FakeDynamoClient:
+    """The `table.meta.client` calls: transactions and plain updates."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def transact_write_items(self, TransactItems):
+        table = self.table
+        with table.lock:
+            table.calls['dynamodb.TransactWriteItems'] += 1
+            updates = [entry['Update'] for entry in TransactItems]
+            passed = [table._check(u['Key'], u.get('ConditionExpression'), u.get('ExpressionAttributeNames'),
+                                   u.get('ExpressionAttributeValues')) for u in updates]
+            if not all(passed):
+                error = client_error('TransactionCanceledException', 'TransactWriteItems')
+                error.response['CancellationReasons'] = [
+                    {'Code': 'None' if ok else 'ConditionalCheckFailed'} for ok in passed
+                ]
+                raise error
+            for u in updates:
+                table._update(u['Key'], u['UpdateExpression'], None, u.get('ExpressionAttributeNames'),
+                              u.get('ExpressionAttributeValues'), check=False)
+
+    def update_item(self, TableName, **kwargs):
+        self.table.update_item(**kwargs)
+
+
+class FakeBedrock:
+    """
+    Batch inference control plane. A job starts `start_seconds` after it is
+    created, runs for a log-normal time around `job_seconds`, and on reaching
+    a terminal status sends a state change event to `on_terminal` after
+    `event_delay` seconds. More than `quota` unfinished jobs are refused with
+    ServiceQuotaExceededException, like the account quota.
+    """
+
+    def __init__(self, clock, calls, stats, quota, start_seconds, job_seconds, job_sigma, failure_rate,
+                 event_delay, on_terminal, seed):
+        self.clock = clock
+        self.calls = calls
+        self.stats = stats
+        self.quota = quota
+        self.start_seconds = start_seconds
+        self.job_seconds = job_seconds
+        self.job_sigma = job_sigma
+        self.failure_rate = failure_rate
+        self.event_delay = event_delay
+        self.on_terminal = on_terminal
+        self.seed = seed
+        self.jobs = {}
+        self.tokens = {}
+        self.lock = threading.RLock()
+
+    def job_plan(self, data_s3_uri):
+        """Runtime and outcome of the job for an input, independent of submission order."""
+        rng = random.Random(hashlib.sha256(f"{self.seed}:{data_s3_uri}".encode()).digest())
+        runtime = self.job_seconds * math.exp(rng.gauss(0, self.job_sigma))
+        return runtime, "Failed" if rng.random() < self.failure_rate else "Completed"
+
+    def unfinished(self):
+        return sum(job['status'] not in TERMINAL_JOB_STATUSES for job in self.jobs.values())
+
+    def create_model_invocation_job(self, modelId, jobName, roleArn, inputDataConfig, outputDataConfig,
+                                    clientRequestToken=None, **kwargs):
+        with self.lock:
+            self.calls['bedrock.CreateModelInvocationJob'] += 1
+            if clientRequestToken in self.tokens:
+                return {'jobArn': self.tokens[clientRequestToken]}
+            if self.unfinished() >= self.quota:
+                self.stats['rejected_creates'] += 1
+                raise client_error('ServiceQuotaExceededException', 'CreateModelInvocationJob')
+            job_arn = f"arn:aws:bedrock:us-east-1:123456789012:model-invocation-job/{uuid.uuid4().hex[:12]}"
+            data_s3_uri = inputDataConfig['s3InputDataConfig']['s3Uri']
+            runtime, outcome = self.job_plan(data_s3_uri)
+            self.jobs[job_arn] = {
+                'jobArn': job_arn, 'jobName': jobName, 'status': 'Submitted', 'data_s3_uri': data_s3_uri,
+                'outputDataConfig': outputDataConfig, 'submitTime': self.clock.now,
+            }
+            self.tokens[clientRequestToken] = job_arn
+            self.stats['job_seconds'] += self.start_seconds + runtime
+            self.stats['longest_job_seconds'] = max(self.stats['longest_job_seconds'], self.start_seconds + runtime)
+            self.clock.schedule(self.start_seconds, self._transition, job_arn, 'InProgress')
+            self.clock.schedule(self.start_seconds + runtime, self._transition, job_arn, outcome)
+            return {'jobArn': job_arn}
+
+    def _transition(self, job_arn, status):
+        with self.lock:
+            self.jobs[job_arn]['status'] = status
+        if status in TERMINAL_JOB_STATUSES:
+            self.clock.schedule(self.event_delay, self.on_terminal, job_arn, status)
+
+    def list_model_invocation_jobs(self, nameContains=None, statusEquals=None, nextToken=None, **kwargs):
+        with self.lock:
+            self.calls['bedrock.ListModelInvocationJobs'] += 1
+            return {'invocationJobSummaries': [
+                {k: job[k] for k in ('jobArn', 'jobName', 'status')}
+                for job in self.jobs.values()
+                if (nameContains is None or nameContains in job['jobName'])
+                and (statusEquals is None or job['status'] == statusEquals)
+            ]}
+
+    def get_model_invocation_job(self, jobIdentifier):
+        with self.lock:
+            self.calls['bedrock.GetModelInvocationJob'] += 1
+            return copy.deepcopy(self.jobs[jobIdentifier])
+
+
+class FakeLambda:
+    """Async invokes, delivered to the registered function after `delay` seconds."""
+
+    def __init__(self, clock, calls, functions, delay):
+        self.clock = clock
+        self.calls = calls
+        self.functions = functions
+        self.delay = delay
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.calls['lambda.Invoke'] += 1
+        function = self.functions.get(FunctionName)
+        if function is not None:
+            self.clock.schedule(self.delay, function, json.loads(Payload))
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def simulate(records, max_concurrent_jobs, owners=1, owner_weights="", quota=None, start_minutes=10.0,
+             job_minutes=60.0, job_sigma=0.5, failure_rate=0.0, schedule_minutes=5.0, event_delay_seconds=5.0,
+             invoke_delay_seconds=1.0, refill=True, max_hours=24 * 30, seed=0):
+    os.environ.update(FAKE_ENVIRONMENT)
+    os.environ['MAX_CONCURRENT_JOBS'] = str(max_concurrent_jobs)
+    os.environ['OWNER_WEIGHTS'] = owner_weights
+    if not refill:
+        os.environ['RUNNER_FUNCTION_NAME'] = ''
+    sys.path.insert(0, LAMBDA_DIR)
+    with redirect_stdout(io.StringIO()):
+        import clients
+        import monitor
+        import registry
+        import runner
+        import slot_ledger
+
+    clock = SimClock()
+    calls = Counter()
+    stats = Counter(longest_job_seconds=0)
+    invocations = Counter()
+    created_at = {}
+    finished = []
+    # slot occupancy of Bedrock jobs, integrated over time
+    usage = {'active': 0, 'backlog': records, 'since': clock.now, 'slot_seconds': 0.0, 'idle_with_backlog': 0.0}
+
+    def account(active_change=0, backlog_change=0):
+        elapsed = clock.now - usage['since']
+        usage['slot_seconds'] += usage['active'] * elapsed
+        if usage['backlog'] > 0:
+            usage['idle_with_backlog'] += max(max_concurrent_jobs - usage['active'], 0) * elapsed
+        usage['since'] = clock.now
+        usage['active'] += active_change
+        usage['backlog'] += backlog_change
+
+    def call_handler(module, event):
+        try:
+            with redirect_stdout(io.StringIO()):
+                module.handler(event, None)
+        except Exception as e:
+            stats['handler_errors'] += 1
+            print(f"[WARNING] {module.__name__}.handler failed: {e!r}", file=sys.stderr)
+
+    def run_runner(event):
+        invocations[f"runner ({event.get('source', 'unknown')})"] += 1
+        jobs_before = len(bedrock.jobs)
+        call_handler(runner, event)
+        for job_arn in list(bedrock.jobs)[jobs_before:]:
+            created_at[job_arn] = clock.now
+            account(active_change=1, backlog_change=-1)
+
+    def scheduled_run():
+        run_runner({'source': 'aws.events'})
+        if len(finished) < records:
+            clock.schedule(schedule_minutes * 60, scheduled_run)
+
+    def job_state_change(job_arn, status):
+        invocations['monitor'] += 1
+        finished.append(clock.now)
+        account(active_change=-1)
+        call_handler(monitor, {'detail': {'status': status, 'batchJobArn': job_arn}})
+
+    def postprocess(event):
+        invocations['postprocess'] += 1
+
+    bedrock = FakeBedrock(clock, calls, stats, quota or max_concurrent_jobs, start_minutes * 60, job_minutes * 60,
+                          job_sigma, failure_rate, event_delay_seconds,
+                          lambda job_arn, status: job_state_change(job_arn, status), seed)
+    table = FakeTable(FAKE_ENVIRONMENT['TABLE_NAME'], calls)
+    fakes = {
+        'bedrock': bedrock,
+        'lambda': FakeLambda(clock, calls, {'runner': run_runner, 'postprocess': postprocess}, invoke_delay_seconds),
+    }
+    clients.client = lambda service_name: fakes[service_name]
+    clients.registry_table = lambda: table
+    for module in (runner, monitor, slot_ledger):
+        module.datetime = sim_datetime(clock)
+
+    owner_names = [registry.DEFAULT_OWNER] + [f"owner{i}" for i in range(1, owners)]
+    if owners > 1:
+        table.items[registry.OWNERS_ID] = {'id': registry.OWNERS_ID, 'owners': set(owner_names[1:])}
+    for i in range(records):
+        record_id, owner = f"batch-{i:06d}", owner_names[i % owners]
+        table.items[record_id] = to_dynamo({
+            'id': record_id,
+            'data_s3_uri': f"s3://simulation/input/{record_id}/data.jsonl",
+            'created_dt': datetime.fromtimestamp(clock.now, timezone.utc).isoformat(),
+            'status': runner.PENDING_EMBEDDING_BATCH_STATUS,
+            'status_shard': registry.status_shard(record_id, runner.PENDING_EMBEDDING_BATCH_STATUS, owner),
+            'queue_position': int(clock.now),
+            'owner': owner,
+            'priority': 0,
+        })
+
+    scheduled_run()
+    pending_events = clock.run(START + max_hours * 3600)
+    if len(finished) < records:
+        print(f"[WARNING] only {len(finished)} of {records} jobs finished within {max_hours} hours"
+              + ("" if pending_events else ", nothing left to run"), file=sys.stderr)
+    account()
+
+    makespan = (max(finished) - START) if finished else 0.0
+    waits = sorted((t - START) / 60 for t in created_at.values())
+    ledger = table.items.get(slot_ledger.SLOT_LEDGER_ID, {})
+    return {
+        "records": records,
+        "max_concurrent_jobs": max_concurrent_jobs,
+        "jobs_finished": len(finished),
+        "makespan_hours": makespan / 3600,
+        "makespan_lower_bound_hours": max(stats['job_seconds'] / max_concurrent_jobs, stats['longest_job_seconds']) / 3600,
+        "slot_utilization": usage['slot_seconds'] / (max_concurrent_jobs * makespan) if makespan else 0.0,
+        "idle_slot_hours_with_backlog": usage['idle_with_backlog'] / 3600,
+        "queue_wait_minutes": {
+            "mean": statistics.mean(waits) if waits else None,
+            "p50": percentile(waits, 50),
+            "p95": percentile(waits, 95),
+            "max": waits[-1] if waits else None,
+        },
+        "invocations": dict(sorted(invocations.items())),
+        "api_calls": dict(sorted(calls.items())),
+        "rejected_creates": stats['rejected_creates'],
+        "handler_errors": stats['handler_errors'],
+        # should be back to 0 once every job reported a terminal status
+        "ledger_active_jobs": int(ledger.get('active_jobs', 0)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a backlog through the batch scheduler on a simulated clock")
+    parser.add_argument("--records", type=int, default=200, help="Pending registry records, one batch job each")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=20, help="MAX_CONCURRENT_JOBS of the runner")
+    parser.add_argument("--owners", type=int, default=1, help="Owners the records are spread over, round robin")
+    parser.add_argument("--owner-weights", type=str, default="", help="OWNER_WEIGHTS of the runner, e.g. owner1=3")
+    parser.add_argument("--quota", type=int, default=None,
+                        help="Bedrock limit of unfinished jobs, --max-concurrent-jobs by default")
+    parser.add_argument("--start-minutes", type=float, default=10.0, help="Validation and scheduling time of a job")
+    parser.add_argument("--job-minutes", type=float, default=60.0, help="Median job runtime")
+    parser.add_argument("--job-sigma", type=float, default=0.5, help="Log-normal shape of the job runtime")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of jobs ending Failed")
+    parser.add_argument("--schedule-minutes", type=float, default=5.0, help="Rate of the runner schedule rule")
+    parser.add_argument("--event-delay-seconds", type=float, default=5.0, help="Job state change event delivery delay")
+    parser.add_argument("--invoke-delay-seconds", type=float, default=1.0, help="Lambda async invoke delay")
+    parser.add_argument("--no-refill", action="store_true", help="Don't let the monitor invoke the runner")
+    parser.add_argument("--max-hours", type=float, default=24 * 30, help="Simulated time to give up after")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the job runtimes and failures")
+    parser.add_argument("--min-utilization", type=float, default=None, help="Fail if slot utilization is lower")
+    parser.add_argument("--max-makespan-hours", type=float, default=None, help="Fail if the makespan is longer")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    result = simulate(args.records, args.max_concurrent_jobs, args.owners, args.owner_weights, args.quota,
+                      args.start_minutes, args.job_minutes, args.job_sigma, args.failure_rate, args.schedule_minutes,
+                      args.event_delay_seconds, args.invoke_delay_seconds, not args.no_refill, args.max_hours, args.seed)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        wait = result["queue_wait_minutes"]
+        print(f"Jobs finished:       {result['jobs_finished']} / {result['records']}")
+        print(f"Makespan:            {result['makespan_hours']:.2f}h "
+              f"(lower bound {result['makespan_lower_bound_hours']:.2f}h)")
+        print(f"Slot utilization:    {result['slot_utilization']:.1%} of {result['max_concurrent_jobs']} slots, "
+              f"{result['idle_slot_hours_with_backlog']:.1f} slot-hours idle with records waiting")
+        if wait["mean"] is not None:
+            print(f"Queue wait:          mean {wait['mean']:.1f}m, p50 {wait['p50']:.1f}m, "
+                  f"p95 {wait['p95']:.1f}m, max {wait['max']:.1f}m")
+        print(f"Invocations:         " + ", ".join(f"{k} {v}" for k, v in result["invocations"].items()))
+        print(f"API calls:           " + ", ".join(f"{k} {v}" for k, v in result["api_calls"].items()))
+        print(f"Rejected creates:    {result['rejected_creates']}, handler errors: {result['handler_errors']}, "
+              f"ledger active jobs at the end: {result['ledger_active_jobs']}")
+
+    over_budget = []
+    if result["jobs_finished"] < result["records"]:
+        over_budget.append(f"{result['records'] - result['jobs_finished']} jobs never finished")
+    if args.min_utilization is not None and result["slot_utilization"] < args.min_utilization:
+        over_budget.append(f"slot utilization {result['slot_utilization']:.3f} < {args.min_utilization}")
+    if args.max_makespan_hours is not None and result["makespan_hours"] > args.max_makespan_hours:
+        over_budget.append(f"makespan {result['makespan_hours']:.2f}h > {args.max_makespan_hours}h")
+    if over_budget:
+        print("Over budget: " + ", ".join(over_budget))
+        sys.exit(1)
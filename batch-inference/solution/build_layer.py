@@ -0,0 +1,75 @@
+"""
+Build the boto3 Lambda layer into lambda-layer/python.
+
+Installs the latest boto3, then drops what the functions never load: the
+botocore models and boto3 resource models of services they don't call, and
+cached bytecode of the build machine. When run with the Lambda runtime's
+Python version, the layer is byte-compiled, since /opt is read-only and
+Lambda would otherwise compile every imported module on each cold start.
+Modules shared with the on-demand tools are copied in next to boto3.
+"""
+import argparse
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+
+# services called by runner.py, monitor.py and postprocess.py, plus sts for credentials
+BOTOCORE_SERVICES = {'bedrock', 'bedrock-runtime', 'dynamodb', 's3', 'lambda', 'sts'}
+BOTO3_RESOURCES = {'dynamodb'}
+LAMBDA_PYTHON_VERSION = (3, 12)
+# stdlib only modules of on-demand-invocation the functions import, e.g. postprocess.py's npy_format
+SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'on-demand-invocation')
+SHARED_MODULES = ['npy_format.py']
+
+
+def prune_dir(path, keep):
+    """Delete the sub directories of `path` not in `keep`, keeping plain files."""
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        if os.path.isdir(full_path) and name not in keep:
+            shutil.rmtree(full_path)
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def build_layer(target, services=BOTOCORE_SERVICES, resources=BOTO3_RESOURCES):
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    subprocess.run(
+        [sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile', '--target', target, 'boto3'],
+        check=True
+    )
+    full_size = dir_size(target)
+
+    prune_dir(os.path.join(target, 'botocore', 'data'), services)
+    prune_dir(os.path.join(target, 'boto3', 'data'), resources)
+    shutil.rmtree(os.path.join(target, 'bin'), ignore_errors=True)
+    for name in SHARED_MODULES:
+        shutil.copy(os.path.join(SHARED_DIR, name), target)
+    for root, dirs, _ in os.walk(target):
+        if '__pycache__' in dirs:
+            shutil.rmtree(os.path.join(root, '__pycache__'))
+            dirs.remove('__pycache__')
+
+    if sys.version_info[:2] == LAMBDA_PYTHON_VERSION:
+        compileall.compile_dir(target, quiet=1, optimize=0, workers=0)
+    else:
+        print(f"[WARNING] building with Python {sys.version_info[0]}.{sys.version_info[1]}, not "
+              f"{LAMBDA_PYTHON_VERSION[0]}.{LAMBDA_PYTHON_VERSION[1]}: the layer is left uncompiled")
+
+    print(f"Layer size: {full_size / 2**20:.1f} MB -> {dir_size(target) / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a slim boto3 Lambda layer")
+    parser.add_argument("--target", type=str, default=os.path.join("lambda-layer", "python"),
+                        help="Directory to install the layer packages into")
+    parser.add_argument("--extra-services", type=str, default="",
+                        help="Comma separated botocore service models to keep on top of the defaults")
+    args = parser.parse_args()
+    extra = {s.strip() for s in args.extra_services.split(',') if s.strip()}
+    build_layer(args.target, BOTOCORE_SERVICES | extra)
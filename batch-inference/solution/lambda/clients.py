@@ -0,0 +1,28 @@
+"""
+AWS clients shared by the Lambda functions, built on first use and cached.
+
+Nothing is created at import time, so a cold start only pays for the clients
+an invocation actually needs (the monitor, for instance, only talks to
+Bedrock and Lambda for some events), and warm invocations reuse them.
+Building boto3 clients from several threads at once isn't safe, so the
+getters serialize construction and can be called from worker threads.
+"""
+import os
+import threading
+from functools import lru_cache
+
+import boto3
+
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def client(service_name: str):
+    with _lock:
+        return boto3.client(service_name)
+
+
+@lru_cache(maxsize=None)
+def registry_table():
+    with _lock:
+        return boto3.resource('dynamodb').Table(os.environ['TABLE_NAME'])
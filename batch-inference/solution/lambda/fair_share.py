@@ -0,0 +1,54 @@
+"""
+Weighted fair-share allocation of free job slots between owners.
+
+Each free slot goes to the owner with the lowest `(active + granted) / weight`
+among those with pending batches, ties going to the batch earliest in queue
+order. An owner alone in the queue can use every slot, but as soon as others
+show up, slots freed by finishing jobs go to whoever is furthest below their
+share, so a bulk backfill can't starve small batches for hours. Within an
+owner, batches are taken in queue order, see `registry`.
+
+Priority only orders an owner's own queue: it isn't part of the allocation
+key, so an owner's high priority batch waits behind the fair share of the
+others like any other batch of that owner, and only breaks ties through its
+earlier queue position. To favor an owner across the board, raise its weight.
+"""
+from typing import Dict, List
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse a comma separated `OWNER=WEIGHT` list, e.g. `search=4,backfill=1`."""
+    weights = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        owner, _, weight = entry.partition('=')
+        weights[owner.strip()] = float(weight)
+    return weights
+
+
+def allocate(candidates: Dict[str, List[dict]], active: Dict[str, int], free_slots: int,
+             weights: Dict[str, float] = None, default_weight: float = 1.0) -> List[dict]:
+    """
+    Pick up to `free_slots` records from the per-owner `candidates` queues.
+
+    `active` holds the slots each owner already uses. Owners missing from
+    `weights` get `default_weight`.
+    """
+    weights = weights or {}
+    granted = {owner: 0 for owner in candidates}
+    heads = {owner: 0 for owner in candidates}
+    selected = []
+    while len(selected) < free_slots:
+        waiting = [owner for owner, queue in candidates.items() if heads[owner] < len(queue)]
+        if not waiting:
+            break
+        owner = min(waiting, key=lambda o: (
+            (active.get(o, 0) + granted[o]) / weights.get(o, default_weight),
+            candidates[o][heads[o]]['queue_position'],
+        ))
+        selected.append(candidates[owner][heads[owner]])
+        heads[owner] += 1
+        granted[owner] += 1
+    return selected
@@ -0,0 +1,75 @@
+"""
+CloudWatch metrics of the Lambda functions, in Embedded Metric Format.
+
+Values are kept in memory during an invocation and printed as EMF records
+when the handler returns; CloudWatch Logs turns them into metrics, so the
+hot path makes no PutMetricData call. Decorate a handler with `emitting`.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'EmbeddingBatchInference')
+# EMF takes at most 100 values per metric in one record
+MAX_VALUES_PER_RECORD = 100
+
+_lock = threading.Lock()
+# metric name -> (unit, values)
+_values = {}
+
+
+def put(name: str, value: float, unit: str = 'Count'):
+    with _lock:
+        _values.setdefault(name, (unit, []))[1].append(value)
+
+
+@contextmanager
+def timer(name: str):
+    """Record the duration of the block in milliseconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        put(name, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+
+def flush():
+    """Print the values collected so far as EMF records, and forget them."""
+    global _values
+    with _lock:
+        values, _values = _values, {}
+    if not values:
+        return
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    longest = max(len(v) for _, v in values.values())
+    for offset in range(0, longest, MAX_VALUES_PER_RECORD):
+        record = {
+            name: samples[offset:offset + MAX_VALUES_PER_RECORD]
+            for name, (_, samples) in values.items() if len(samples) > offset
+        }
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': values[name][0]} for name in record],
+                }],
+            },
+            'FunctionName': function_name,
+            **{name: samples if len(samples) > 1 else samples[0] for name, samples in record.items()},
+        }, default=float))
+
+
+def emitting(handler):
+    """Flush the metrics of every invocation of `handler`, even a failed one."""
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush()
+    return wrapper
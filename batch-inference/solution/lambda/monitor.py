@@ -1,23 +1,102 @@
 import os
-import boto3
+import json
 from datetime import datetime
 from datetime import timezone
-from pprint import pprint
 from boto3.dynamodb.conditions import Key
 
+import clients
+import metrics
+import registry
+import slot_ledger
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['TABLE_NAME'])
 
-bedrock = boto3.client('bedrock')
+# the runner is invoked as soon as a slot frees up; its schedule is only a safety net
+RUNNER_FUNCTION_NAME = os.environ.get('RUNNER_FUNCTION_NAME')
+# converts the output of successful jobs into embedding shards
+POSTPROCESS_FUNCTION_NAME = os.environ.get('POSTPROCESS_FUNCTION_NAME')
 
+SUBMITTED_EMBEDDING_BATCH_STATUS = "SUMMITTED"
+POSTPROCESS_JOB_STATUSES = ("Completed", "PartiallyCompleted")
+
+def invoke_async(function_name, payload):
+    if not function_name:
+        return
+    try:
+        clients.client('lambda').invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps(payload)
+        )
+    except Exception as e:
+        print(f"[WARNING] Failed to trigger {function_name}: {str(e)}")
+
+def refill_slots(job_arn):
+    """Kick the runner asynchronously so the freed slot is reused right away."""
+    # if this fails, the scheduled run will pick the slot up instead
+    invoke_async(RUNNER_FUNCTION_NAME, {'source': 'batch-inference-status-monitor', 'released_by': job_arn})
+
+def start_postprocessing(item_id):
+    """Kick the post-processing of a finished job's output."""
+    invoke_async(POSTPROCESS_FUNCTION_NAME, {'source': 'batch-inference-status-monitor', 'id': item_id})
+
+def record_job_status(table, item, job_arn, job_status):
+    """
+    Record the status of a registry record's job. The first terminal status
+    of a submitted job frees its slot, refills it and starts post-processing.
+    """
+    # batch job record exists, hence, we may find the S3 output uri.
+    job = clients.client('bedrock').get_model_invocation_job(jobIdentifier=job_arn)
+    output_data_s3_uri = job['outputDataConfig']['s3OutputDataConfig']['s3Uri'] + job_arn.split('/')[-1]
+
+    # update the item with the new status, updated_at and output_data_s3_uri
+    status_update = {
+        'TableName': table.name,
+        'Key': {'id': item['id']},
+        'UpdateExpression': 'SET #status = :status, #status_shard = :status_shard, #updated_at = :updated_at, #output_data_s3_uri = :output_data_s3_uri',
+        'ExpressionAttributeNames': {
+            '#status': 'status',
+            '#status_shard': 'status_shard',
+            '#updated_at': 'updated_at',
+            '#output_data_s3_uri': 'output_data_s3_uri'
+        },
+        'ExpressionAttributeValues': {
+            ':status': job_status,
+            ':status_shard': registry.status_shard(item['id'], job_status, registry.record_owner(item)),
+            ':updated_at': datetime.now(timezone.utc).isoformat(),
+            ':output_data_s3_uri': output_data_s3_uri
+        }
+    }
+    # the first terminal event for a submitted job frees its slot; the
+    # condition makes redelivered events leave the ledger alone
+    first_terminal_update = dict(
+        status_update,
+        ConditionExpression='#status = :submitted',
+        ExpressionAttributeValues=dict(status_update['ExpressionAttributeValues'], **{
+            ':submitted': SUBMITTED_EMBEDDING_BATCH_STATUS
+        })
+    )
+    if slot_ledger.transact(table, [{'Update': first_terminal_update}, slot_ledger.release_slot(table, registry.record_owner(item))]):
+        print(f"Released slot held by job {job_arn}")
+        metrics.put(f'Jobs{job_status}', 1)
+        if 'created_dt' in item:
+            runtime = datetime.now(timezone.utc) - datetime.fromisoformat(item['created_dt'])
+            metrics.put('JobRuntime', runtime.total_seconds(), 'Seconds')
+        refill_slots(job_arn)
+        if job_status in POSTPROCESS_JOB_STATUSES:
+            start_postprocessing(item['id'])
+        return True
+    metrics.put('RedeliveredEvents', 1)
+    table.meta.client.update_item(**status_update)
+    return False
+
+@metrics.emitting
 def handler(event, context):
     # Extract relevant information from the event
-    pprint(f"Event: {event}")
-    pprint(f"context: {context}")
     detail = event['detail']
     job_status = detail['status']
     job_arn = detail['batchJobArn']
+    print(f"Job {job_arn} is {job_status}")
+    table = clients.registry_table()
     
     # Query DynamoDB using the batch-job-arn-index to find the record
     response = table.query(
@@ -25,30 +104,9 @@ def handler(event, context):
         KeyConditionExpression=Key('batch_job_arn').eq(job_arn)
     )
 
-
-    pprint(f"DynamoDB query response: {response}")
     # Update the item with the new status
     if response['Items']:
-        # batch job record exists, hence, we may find the S3 output uri.
-        response = bedrock.get_model_invocation_job(jobIdentifier=job_arn)
-        output_data_s3_uri = response['outputDataConfig']['s3OutputDataConfig']['s3Uri'] + job_arn.split('/')[-1]
-
-        # update the item with the new status, updated_at and output_data_s3_uri
-        item = response['Items'][0]
-        table.update_item(
-            Key={'id': item['id']},
-            UpdateExpression='SET #status = :status, #updated_at = :updated_at, #output_data_s3_uri = :output_data_s3_uri',
-            ExpressionAttributeNames={
-                '#status': 'status',
-                '#updated_at': 'updated_at',
-                '#output_data_s3_uri': 'output_data_s3_uri'
-            },
-            ExpressionAttributeValues={
-                ':status': job_status,
-                ':updated_at': datetime.now(timezone.utc).isoformat(),
-                ':output_data_s3_uri': output_data_s3_uri
-            }
-        )
+        record_job_status(table, response['Items'][0], job_arn, job_status)
     else:
         print(f"[WARNING] No item found for job {job_arn}")
     return {
@@ -0,0 +1,320 @@
+import os
+import json
+import tempfile
+import uuid
+from array import array
+from time import perf_counter
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+import clients
+import metrics
+import registry
+# from the layer, the same .npy layout as the on-demand NpyEmbeddingWriter
+from npy_format import NPY_HEADER_SIZE, npy_header, npy_shape
+
+
+# where the embedding shards and the failed records are written, e.g. s3://bucket/embeddings/
+EMBEDDINGS_S3_URI = os.environ['EMBEDDINGS_S3_URI']
+RESUBMIT_S3_URI = os.environ['RESUBMIT_S3_URI']
+# duplicates sidecars of the ingestion tool's --dedup, s3://bucket/duplicates/<batch id>/<run id>.jsonl
+DUPLICATES_S3_URI = os.environ.get('DUPLICATES_S3_URI')
+# output objects streamed and converted in parallel
+POSTPROCESS_CONCURRENCY = int(os.environ.get('POSTPROCESS_CONCURRENCY', '8'))
+# Bedrock refuses batch jobs below this many records, smaller retries are only written out
+MIN_RECORDS_PER_JOB = 100
+
+PENDING_EMBEDDING_BATCH_STATUS = "Pending"
+TRANSFER_CONFIG = TransferConfig(multipart_chunksize=64 * 1024 * 1024, max_concurrency=4)
+
+# rows of an embedding shard read at once when copying vectors to duplicates
+FAN_OUT_READ_ROWS = 4096
+
+
+def split_s3_uri(uri):
+    parsed = urlparse(uri)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def list_output_objects(output_data_s3_uri):
+    """The `.jsonl.out` result files of a batch job, skipping the manifest."""
+    bucket, prefix = split_s3_uri(output_data_s3_uri)
+    keys = []
+    for page in clients.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('.jsonl.out'))
+    return bucket, sorted(keys)
+
+
+def convert_output_object(bucket, key, shard_uri, work_dir):
+    """
+    Stream one output object into a float32 `.npy` shard plus a recordId index.
+
+    Lines are parsed as they arrive and vectors go straight to a local file,
+    so memory stays flat whatever the object size. Records that errored are
+    returned in batch input format so they can be resubmitted.
+    """
+    local = os.path.join(work_dir, uuid.uuid4().hex)
+    rows, dimensions, failed = 0, 0, []
+    start = perf_counter()
+    body = clients.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    with open(local + '.npy', 'wb') as vectors, open(local + '.index.jsonl', 'w') as index:
+        vectors.write(npy_header(0, 0))
+        for line in body.iter_lines(chunk_size=1024 * 1024):
+            if not line:
+                continue
+            record = json.loads(line)
+            embedding = (record.get('modelOutput') or {}).get('embedding')
+            if 'error' in record or not embedding:
+                failed.append({'recordId': record['recordId'], 'modelInput': record['modelInput']})
+                continue
+            vector = array('f', embedding)
+            if dimensions == 0:
+                dimensions = len(vector)
+            elif len(vector) != dimensions:
+                raise ValueError(f"Record {record['recordId']} in {key} has {len(vector)} dimensions, expected {dimensions}")
+            vectors.write(vector.tobytes())
+            index.write(json.dumps({'recordId': record['recordId']}) + '\n')
+            rows += 1
+        vectors.seek(0)
+        vectors.write(npy_header(rows, dimensions))
+
+    shard_bucket, shard_key = split_s3_uri(shard_uri)
+    clients.client('s3').upload_file(local + '.npy', shard_bucket, shard_key + '.npy', Config=TRANSFER_CONFIG)
+    clients.client('s3').upload_file(local + '.index.jsonl', shard_bucket, shard_key + '.index.jsonl', Config=TRANSFER_CONFIG)
+    os.remove(local + '.npy')
+    os.remove(local + '.index.jsonl')
+    metrics.put('ObjectConversionLatency', (perf_counter() - start) * 1000, 'Milliseconds')
+    return rows, failed
+
+
+def root_batch_id(batch_id):
+    """Id of the batch registered by the ingestion tool, for a resubmission of its failed records."""
+    while batch_id.endswith('-r'):
+        batch_id = batch_id[:-2]
+    return batch_id
+
+
+def read_exactly(body, size):
+    chunks = []
+    while size > 0:
+        chunk = body.read(size)
+        if not chunk:
+            raise EOFError("Embedding shard is shorter than its header says")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_rows(bucket, key, rows):
+    """`{row: float32 bytes}` of some rows of an embedding shard, streaming it only up to the last one."""
+    body = clients.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    header = read_exactly(body, NPY_HEADER_SIZE)
+    shape_rows, dimensions = npy_shape(header)
+    row_bytes = dimensions * 4
+    found = {}
+    wanted = sorted(rows)
+    i = 0
+    for start in range(0, wanted[-1] + 1, FAN_OUT_READ_ROWS):
+        data = read_exactly(body, min(FAN_OUT_READ_ROWS, shape_rows - start) * row_bytes)
+        while i < len(wanted) and wanted[i] < start + FAN_OUT_READ_ROWS:
+            offset = (wanted[i] - start) * row_bytes
+            found[wanted[i]] = data[offset:offset + row_bytes]
+            i += 1
+    body.close()
+    return found
+
+
+def canonical_vectors(root_id, record_ids):
+    """
+    Vectors of `record_ids` found in the embedding shards of batch `root_id`
+    and of its resubmissions, as `{recordId: float32 bytes}`.
+    """
+    # batch ids have a fixed length, so this prefix only matches the batch and its resubmissions
+    bucket, prefix = split_s3_uri(f"{EMBEDDINGS_S3_URI.rstrip('/')}/{root_id}")
+    index_keys = []
+    for page in clients.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        index_keys.extend(obj['Key'] for obj in page.get('Contents', [])
+                          if '/part-' in obj['Key'] and obj['Key'].endswith('.index.jsonl'))
+
+    def read_shard(index_key):
+        body = clients.client('s3').get_object(Bucket=bucket, Key=index_key)['Body']
+        rows = {}
+        for row, line in enumerate(line for line in body.iter_lines() if line):
+            record_id = json.loads(line)['recordId']
+            if record_id in record_ids:
+                rows[row] = record_id
+        if not rows:
+            return {}
+        vectors = read_rows(bucket, index_key[:-len('.index.jsonl')] + '.npy', rows)
+        return {rows[row]: vector for row, vector in vectors.items()}
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=POSTPROCESS_CONCURRENCY) as executor:
+        for vectors in executor.map(read_shard, index_keys):
+            found.update(vectors)
+    return found
+
+
+def fan_out_duplicates(root_id):
+    """
+    Copy the vectors of batch `root_id` to the duplicates its ingestion left out.
+
+    Each duplicates sidecar `<DUPLICATES_S3_URI><root_id>/<run id>.jsonl`
+    becomes `<EMBEDDINGS_S3_URI><root_id>/dup-<run id>.npy` plus its index, in
+    the same format as the part shards. The shards are rebuilt from scratch,
+    so this can be run again, e.g. once a resubmission of failed records is
+    post-processed; duplicates of records still without a vector are missing
+    until then. Returns `(written, missing)`.
+    """
+    if not DUPLICATES_S3_URI:
+        return 0, 0
+    bucket, prefix = split_s3_uri(f"{DUPLICATES_S3_URI.rstrip('/')}/{root_id}/")
+    sidecars = {}
+    for page in clients.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.jsonl'):
+                body = clients.client('s3').get_object(Bucket=bucket, Key=obj['Key'])['Body']
+                sidecars[obj['Key']] = [json.loads(line) for line in body.iter_lines() if line]
+    if not sidecars:
+        return 0, 0
+
+    vectors = canonical_vectors(root_id, {d['canonicalRecordId'] for lines in sidecars.values() for d in lines})
+    written, missing = 0, 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        for key, duplicates in sidecars.items():
+            run_id = os.path.basename(key)[:-len('.jsonl')]
+            local = os.path.join(work_dir, run_id)
+            rows, dimensions = 0, 0
+            with open(local + '.npy', 'wb') as f, open(local + '.index.jsonl', 'w') as index:
+                f.write(npy_header(0, 0))
+                for duplicate in duplicates:
+                    vector = vectors.get(duplicate['canonicalRecordId'])
+                    if vector is None:
+                        missing += 1
+                        continue
+                    dimensions = len(vector) // 4
+                    f.write(vector)
+                    index.write(json.dumps({'recordId': duplicate['recordId']}) + '\n')
+                    rows += 1
+                f.seek(0)
+                f.write(npy_header(rows, dimensions))
+            if rows:
+                shard_bucket, shard_key = split_s3_uri(f"{EMBEDDINGS_S3_URI.rstrip('/')}/{root_id}/dup-{run_id}")
+                clients.client('s3').upload_file(local + '.npy', shard_bucket, shard_key + '.npy', Config=TRANSFER_CONFIG)
+                clients.client('s3').upload_file(local + '.index.jsonl', shard_bucket, shard_key + '.index.jsonl', Config=TRANSFER_CONFIG)
+            written += rows
+
+    metrics.put('DuplicatesWritten', written)
+    metrics.put('DuplicatesMissing', missing)
+    print(f"Batch {root_id}: copied embeddings to {written} duplicates, {missing} still without a vector")
+    return written, missing
+
+
+def register_resubmission(item, failed):
+    """Write the failed records as a new batch input and queue it, if it is large enough."""
+    # derived from the original id, so a retried invocation can't queue it twice
+    batch_id = f"{item['id']}-r"
+    data_s3_uri = f"{RESUBMIT_S3_URI.rstrip('/')}/{batch_id}/data.jsonl"
+    bucket, key = split_s3_uri(data_s3_uri)
+    clients.client('s3').put_object(Bucket=bucket, Key=key, Body=''.join(json.dumps(record) + '\n' for record in failed).encode('utf-8'))
+    if len(failed) < MIN_RECORDS_PER_JOB:
+        print(f"[WARNING] {len(failed)} failed records of batch {item['id']} written to {data_s3_uri}, too few to resubmit as a batch job")
+        return data_s3_uri
+
+    owner = registry.record_owner(item)
+    created_dt = datetime.now(timezone.utc).isoformat()
+    try:
+        clients.registry_table().put_item(Item={
+            'id': batch_id,
+            'data_s3_uri': data_s3_uri,
+            'created_dt': created_dt,
+            'status': PENDING_EMBEDDING_BATCH_STATUS,
+            'status_shard': registry.status_shard(batch_id, PENDING_EMBEDDING_BATCH_STATUS, owner),
+            # retries keep their original place in the owner's queue
+            'queue_position': item.get('queue_position', int(datetime.fromisoformat(created_dt).timestamp())),
+            'owner': owner,
+            'priority': item.get('priority', 0),
+            'record_count': len(failed),
+            'retry_of': item['id'],
+        }, ConditionExpression='attribute_not_exists(id)')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Failed records of batch {item['id']} were already registered as batch {batch_id}")
+        return data_s3_uri
+    print(f"Registered {len(failed)} failed records of batch {item['id']} as batch {batch_id}")
+    return data_s3_uri
+
+
+@metrics.emitting
+def handler(event, context):
+    """
+    Convert the output of a completed batch job into embedding shards.
+
+    Invoked asynchronously by the status monitor with the registry `id` of the
+    batch. Each `.jsonl.out` object becomes `<EMBEDDINGS_S3_URI><id>/part-NNNNN.npy`
+    plus `part-NNNNN.index.jsonl`, loadable with `record_io.load_embeddings`.
+    The vectors are then copied to the duplicates the ingestion tool left out
+    of the batch. With `fan_out_only` in the event, only that last step runs.
+    """
+    if event.get('fan_out_only'):
+        written, missing = fan_out_duplicates(root_batch_id(event['id']))
+        return {
+            'statusCode': 200,
+            'body': f'Fanned out batch {event["id"]}: {written} duplicates, {missing} without a vector'
+        }
+
+    table = clients.registry_table()
+    item = table.get_item(Key={'id': event['id']})['Item']
+    bucket, keys = list_output_objects(item['output_data_s3_uri'])
+    embeddings_s3_uri = f"{EMBEDDINGS_S3_URI.rstrip('/')}/{item['id']}/"
+    print(f"Post-processing {len(keys)} output objects of batch {item['id']} into {embeddings_s3_uri}")
+
+    embedded, failed = 0, []
+    with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(max_workers=POSTPROCESS_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(convert_output_object, bucket, key, f"{embeddings_s3_uri}part-{i:05d}", work_dir)
+            for i, key in enumerate(keys)
+        ]
+        for future in futures:
+            rows, shard_failed = future.result()
+            embedded += rows
+            failed.extend(shard_failed)
+
+    update_expression = 'SET #embeddings_s3_uri = :embeddings_s3_uri, #embedded_count = :embedded_count, #failed_count = :failed_count, #postprocessed_at = :postprocessed_at'
+    names = {
+        '#embeddings_s3_uri': 'embeddings_s3_uri',
+        '#embedded_count': 'embedded_count',
+        '#failed_count': 'failed_count',
+        '#postprocessed_at': 'postprocessed_at'
+    }
+    values = {
+        ':embeddings_s3_uri': embeddings_s3_uri,
+        ':embedded_count': embedded,
+        ':failed_count': len(failed),
+        ':postprocessed_at': datetime.now(timezone.utc).isoformat()
+    }
+    if failed:
+        update_expression += ', #failed_records_s3_uri = :failed_records_s3_uri'
+        names['#failed_records_s3_uri'] = 'failed_records_s3_uri'
+        values[':failed_records_s3_uri'] = register_resubmission(item, failed)
+    table.update_item(
+        Key={'id': item['id']},
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+    # only listed once the batch is marked post-processed, see the ingestion tool's dedup.py
+    fan_out_duplicates(root_batch_id(item['id']))
+
+    metrics.put('EmbeddingsWritten', embedded)
+    metrics.put('FailedRecords', len(failed))
+    print(f"Batch {item['id']}: {embedded} embeddings, {len(failed)} failed records")
+    return {
+        'statusCode': 200,
+        'body': f'Post-processed batch {item["id"]}: {embedded} embeddings, {len(failed)} failed records'
+    }
@@ -0,0 +1,91 @@
+"""
+Sharded, per-owner status lookups on the batch registry table.
+
+Every record carries a `status_shard` attribute, `<status>#<owner>#<n>` with
+`n` derived from the record id, which is the partition key of
+`status-shard-index`. Records in one status are spread over STATUS_SHARDS
+index partitions per owner instead of piling up on a single hot one, and
+are read back by querying every shard in parallel and merging them.
+
+The index is sorted on `queue_position`, the registration time in epoch
+seconds minus `priority * PRIORITY_BOOST_SECONDS`, so higher priority
+batches come first while old low priority ones still age their way up.
+"""
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from boto3.dynamodb.conditions import Key
+
+STATUS_SHARD_INDEX = 'status-shard-index'
+STATUS_SHARDS = int(os.environ.get('STATUS_SHARDS', '10'))
+
+# queue_position head start of one priority level
+PRIORITY_BOOST_SECONDS = 3600
+
+DEFAULT_OWNER = 'default'
+# registry item listing every owner that ever registered a batch
+OWNERS_ID = '__owners__'
+
+
+def record_owner(item: dict) -> str:
+    return item.get('owner', DEFAULT_OWNER)
+
+
+def registered_at(item: dict) -> float:
+    """Registration time of a record in epoch seconds, from its queue position."""
+    return float(item['queue_position']) + float(item.get('priority', 0)) * PRIORITY_BOOST_SECONDS
+
+
+def status_shard(record_id: str, status: str, owner: str = DEFAULT_OWNER) -> str:
+    """Sharded status key of a record, stable for a given id, status and owner."""
+    return f"{status}#{owner}#{zlib.crc32(record_id.encode('utf-8')) % STATUS_SHARDS}"
+
+
+def get_owners(table) -> set:
+    response = table.get_item(Key={'id': OWNERS_ID})
+    return set(response.get('Item', {}).get('owners', set())) | {DEFAULT_OWNER}
+
+
+def query_shard(table, shard_key: str, limit: int = None) -> list:
+    """Records of one shard in queue order, following pages up to `limit` items."""
+    items = []
+    kwargs = {
+        'IndexName': STATUS_SHARD_INDEX,
+        'KeyConditionExpression': Key('status_shard').eq(shard_key),
+        'ScanIndexForward': True,
+    }
+    while True:
+        if limit is not None:
+            kwargs['Limit'] = limit - len(items)
+        response = table.query(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response or (limit is not None and len(items) >= limit):
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_status(table, status: str, owners, limit: int = None) -> dict:
+    """
+    Scatter-gather the records in `status` across all shards of every owner.
+
+    Returns `{owner: records}`, each list in queue order and at most `limit`
+    long, so no more than `limit * STATUS_SHARDS` items are read per owner
+    however long the backlog is.
+    """
+    owners = sorted(owners)
+    if limit is not None and limit <= 0:
+        return {owner: [] for owner in owners}
+    shard_keys = [(owner, f"{status}#{owner}#{n}") for owner in owners for n in range(STATUS_SHARDS)]
+    with ThreadPoolExecutor(max_workers=min(len(shard_keys), 64)) as executor:
+        shards = list(executor.map(lambda key: query_shard(table, key[1], limit), shard_keys))
+
+    by_owner = {owner: [] for owner in owners}
+    for (owner, _), items in zip(shard_keys, shards):
+        by_owner[owner].append(items)
+    return {
+        owner: list(islice(heapq.merge(*queues, key=lambda item: item['queue_position']), limit))
+        for owner, queues in by_owner.items()
+    }
@@ -2,13 +2,16 @@ import os
 import boto3
 from datetime import datetime, timezone
 import uuid
-import time
-from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
+import clients
+import fair_share
+import metrics
+import monitor
+import registry
+import slot_ledger
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-bedrock = boto3.client('bedrock')
 
 print(f"boto3 version: {boto3.__version__}")
 
@@ -20,56 +23,241 @@ BATCH_JOB_S3_OUTPUT_URI = os.environ['BATCH_JOB_S3_OUTPUT_URI']
 IAM_ROLE_ARN = os.environ['IAM_ROLE_ARN']
 BATCH_JOB_NAME_PREFIX = os.environ.get('BATCH_JOB_NAME_PREFIX', 'embedding-job')
 MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', '20'))  # Default to 3 if not set
+# a claim older than this is assumed to belong to a runner that died mid-submission
+CLAIM_TIMEOUT_SECONDS = int(os.environ.get('CLAIM_TIMEOUT_SECONDS', '900'))
+# how often the slot ledger is overwritten with a count taken from Bedrock
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', '900'))
+# relative slot shares per owner, e.g. "search=4,backfill=1"; unlisted owners weigh 1
+OWNER_WEIGHTS = fair_share.parse_weights(os.environ.get('OWNER_WEIGHTS', ''))
 
 
 PENDING_EMBEDDING_BATCH_STATUS = "Pending"
+CLAIMED_EMBEDDING_BATCH_STATUS = "Claimed"
+SUBMITTED_EMBEDDING_BATCH_STATUS = "SUMMITTED"
+ACTIVE_JOB_STATUSES = ["Submitted", "Validating", "Scheduled", "InProgress", "Stopping"]
 
-table = dynamodb.Table(TABLE_NAME)
-
-def get_batch_inference_jobs(status_list: list[str]=["Submitted", "Validating", "Scheduled", "InProgress", "Stopping"], name_contains: str=BATCH_JOB_NAME_PREFIX):
+def get_batch_inference_jobs(status_list: list[str]=ACTIVE_JOB_STATUSES, name_contains: str=BATCH_JOB_NAME_PREFIX):
     """
     Get batch inference jobs by status and name contains.
+
+    Filters by status on the service side, one listing per status, so the cost
+    follows the number of matching jobs rather than the whole job history.
     """
-    if not status_list:
-        return []
-    next_token = None
     invocations = []
-    while True:
-        if next_token is None:
-            res = bedrock.list_model_invocation_jobs(
-                nameContains=name_contains,
-            )
-        else:
-            res = bedrock.list_model_invocation_jobs(
-                nameContains=name_contains,
-                nextToken=next_token
-            )
-            
-        invocations.extend(res.get("invocationJobSummaries"))
-        if "nextToken" in res: 
+    for status in status_list:
+        next_token = None
+        while True:
+            kwargs = {'nameContains': name_contains, 'statusEquals': status}
+            if next_token is not None:
+                kwargs['nextToken'] = next_token
+            res = clients.client('bedrock').list_model_invocation_jobs(**kwargs)
+            invocations.extend(res.get("invocationJobSummaries", []))
             next_token = res.get("nextToken")
-        else:
-            break
+            if next_token is None:
+                break
+
+    return invocations
+
+def get_embedding_batch_records_by_owner(status, limit=None, owners=None):
+    table = clients.registry_table()
+    if owners is None:
+        owners = registry.get_owners(table)
+    return registry.query_status(table, status, owners, limit)
+
+def get_claimed_embedding_batch_records():
+    records = get_embedding_batch_records_by_owner(CLAIMED_EMBEDDING_BATCH_STATUS)
+    return [item for items in records.values() for item in items]
+
+def record_missed_terminal_statuses(submitted):
+    """
+    Record the terminal status of submitted records whose job has ended
+    without the monitor hearing of it, because its state change event was
+    lost or because a stale claim was recovered after the job finished.
+
+    Bedrock is listed after the registry was read, so a job missing from the
+    active listing has ended. The monitor's conditional transaction frees the
+    slot once, whether the event or this check gets there first. Returns the
+    ids of the records found finished, and how many slots this call freed.
+    """
+    active_job_names = {job['jobName'] for job in get_batch_inference_jobs()}
+    finished = set()
+    released = 0
+    table = clients.registry_table()
+    for item in (item for items in submitted.values() for item in items):
+        job_name = item.get('batch_job_name')
+        if job_name is None or job_name in active_job_names:
+            continue
+        job = find_job_by_name(job_name)
+        if job is None or job['status'] in ACTIVE_JOB_STATUSES:
+            continue
+        metrics.put('MissedJobEvents', 1)
+        print(f"Job {job['jobArn']} of batch {item['id']} is {job['status']} without a recorded status, recording it")
+        released += monitor.record_job_status(table, item, job['jobArn'], job['status'])
+        finished.add(item['id'])
+    return finished, released
+
+def get_active_slots():
+    """
+    Read the active job count, in total and per owner, from the slot ledger,
+    reconciling it when the last reconciliation is older than
+    RECONCILE_INTERVAL_SECONDS.
+    """
+    ledger = slot_ledger.read_ledger(clients.registry_table())
+    reconciled_at = ledger.get('reconciled_at')
+    if reconciled_at is not None:
+        age = (datetime.now(timezone.utc) - datetime.fromisoformat(reconciled_at)).total_seconds()
+        if age < RECONCILE_INTERVAL_SECONDS:
+            return int(ledger.get('active_jobs', 0)), slot_ledger.owner_active(ledger)
+
+    # a slot is held from the claim until the monitor records the job's
+    # terminal status, so both the total and the owner counts come from the
+    # Claimed and submitted registry records, which is what the monitor and
+    # the runner add to and take from the ledger
+    # both queries get the same owners, so one registered in between can't
+    # appear in only one of them
+    owners = registry.get_owners(clients.registry_table())
+    claimed = get_embedding_batch_records_by_owner(CLAIMED_EMBEDDING_BATCH_STATUS, owners=owners)
+    submitted = get_embedding_batch_records_by_owner(SUBMITTED_EMBEDDING_BATCH_STATUS, owners=owners)
+    finished, released = record_missed_terminal_statuses(submitted)
+    active_by_owner = {
+        owner: len(claimed.get(owner, [])) + sum(item['id'] not in finished for item in submitted.get(owner, []))
+        for owner in owners
+    }
+    active_job_count = sum(active_by_owner.values())
+    # the counts are only written if nobody took or gave back a slot since the
+    # ledger was read, other than the slots freed just above; otherwise the
+    # ledger, kept exact by the transactions, is used as is
+    seen = ledger.get('active_jobs')
+    expected = int(seen) - released if seen is not None else None
+    if slot_ledger.reconcile(clients.registry_table(), active_job_count, active_by_owner, reconciled_at, expected):
+        metrics.put('LedgerDrift', active_job_count - (expected or 0))
+        print(f"Reconciled slot ledger: {expected} -> {active_job_count}, per owner {active_by_owner}")
+        return active_job_count, active_by_owner
+    metrics.put('ReconcileSkipped', 1)
+    print("Slot ledger changed while counting, skipping reconciliation")
+    ledger = slot_ledger.read_ledger(clients.registry_table())
+    return int(ledger.get('active_jobs', 0)), slot_ledger.owner_active(ledger)
+
+def get_pending_embedding_batch_records(limit=None):
+    """Query DynamoDB for the first `limit` pending jobs of every owner, in queue order."""
+    return get_embedding_batch_records_by_owner(PENDING_EMBEDDING_BATCH_STATUS, limit)
 
-    return [inv for inv in invocations if inv.get("status") in status_list]
+def is_conditional_check_failure(e: Exception) -> bool:
+    return isinstance(e, ClientError) and e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+def claim_batch_record(job_item, job_name):
+    """
+    Atomically move a record from Pending to Claimed and take an active job slot.
 
-def get_pending_embedding_batch_records():
-    """Query DynamoDB for pending jobs that haven't been started."""
-    response = table.query(
-        IndexName='status-index',
-        KeyConditionExpression=Key('status').eq(PENDING_EMBEDDING_BATCH_STATUS)
-    )
-    return response.get('Items', [])
+    Only one runner invocation can win the claim, so overlapping invocations
+    never submit the same input file twice, and the claim fails if every slot
+    is already taken. The job name is stored with the claim so a stale claim
+    can be checked against Bedrock before it is retried.
+    """
+    table = clients.registry_table()
+    return slot_ledger.transact(table, [
+        {
+            'Update': {
+                'TableName': table.name,
+                'Key': {'id': job_item['id']},
+                'UpdateExpression': 'SET #status = :claimed, #status_shard = :status_shard, #claimed_at = :claimed_at, #job_name = :job_name',
+                'ConditionExpression': '#status = :pending',
+                'ExpressionAttributeNames': {
+                    '#status': 'status',
+                    '#status_shard': 'status_shard',
+                    '#claimed_at': 'claimed_at',
+                    '#job_name': 'batch_job_name'
+                },
+                'ExpressionAttributeValues': {
+                    ':claimed': CLAIMED_EMBEDDING_BATCH_STATUS,
+                    ':status_shard': registry.status_shard(job_item['id'], CLAIMED_EMBEDDING_BATCH_STATUS, registry.record_owner(job_item)),
+                    ':pending': PENDING_EMBEDDING_BATCH_STATUS,
+                    ':claimed_at': datetime.now(timezone.utc).isoformat(),
+                    ':job_name': job_name
+                }
+            }
+        },
+        slot_ledger.acquire_slot(table, MAX_CONCURRENT_JOBS, registry.record_owner(job_item))
+    ])
+
+def release_claim(job_item, job_name):
+    """Put a claimed record back to Pending and free its slot, if it is still our claim."""
+    table = clients.registry_table()
+    return slot_ledger.transact(table, [
+        {
+            'Update': {
+                'TableName': table.name,
+                'Key': {'id': job_item['id']},
+                'UpdateExpression': 'SET #status = :pending, #status_shard = :status_shard REMOVE #claimed_at, #job_name',
+                'ConditionExpression': '#status = :claimed AND #job_name = :job_name',
+                'ExpressionAttributeNames': {
+                    '#status': 'status',
+                    '#status_shard': 'status_shard',
+                    '#claimed_at': 'claimed_at',
+                    '#job_name': 'batch_job_name'
+                },
+                'ExpressionAttributeValues': {
+                    ':pending': PENDING_EMBEDDING_BATCH_STATUS,
+                    ':status_shard': registry.status_shard(job_item['id'], PENDING_EMBEDDING_BATCH_STATUS, registry.record_owner(job_item)),
+                    ':claimed': CLAIMED_EMBEDDING_BATCH_STATUS,
+                    ':job_name': job_name
+                }
+            }
+        },
+        slot_ledger.release_slot(table, registry.record_owner(job_item))
+    ])
+
+def mark_submitted(job_item, job_name, job_arn):
+    """Record the job ARN on a claimed record, unless the monitor got there first."""
+    try:
+        clients.registry_table().update_item(
+            Key={'id': job_item['id']},
+            UpdateExpression='SET #status = :status, #status_shard = :status_shard, #job_arn = :arn, #created_dt = :created_dt',
+            ConditionExpression='#status = :claimed AND #job_name = :job_name',
+            ExpressionAttributeNames={
+                '#status': 'status',
+                '#status_shard': 'status_shard',
+                '#job_arn': 'batch_job_arn',
+                '#created_dt': 'created_dt',
+                '#job_name': 'batch_job_name'
+            },
+            ExpressionAttributeValues={
+                ':status': SUBMITTED_EMBEDDING_BATCH_STATUS,
+                ':status_shard': registry.status_shard(job_item['id'], SUBMITTED_EMBEDDING_BATCH_STATUS, registry.record_owner(job_item)),
+                ':arn': job_arn,
+                ':created_dt': datetime.now(timezone.utc).isoformat(),
+                ':claimed': CLAIMED_EMBEDDING_BATCH_STATUS,
+                ':job_name': job_name
+            }
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
 
 def create_batch_job(job_item):
-    """Create a Bedrock batch inference job."""
+    """Claim a pending record and create a Bedrock batch inference job for it."""
+    job_name = f"{BATCH_JOB_NAME_PREFIX}-{str(uuid.uuid4())[:12]}"
     try:
-        current_time = datetime.now(timezone.utc).isoformat()
-        job_name = f"{BATCH_JOB_NAME_PREFIX}-{str(uuid.uuid4())[:12]}"
-        
-        response = bedrock.create_model_invocation_job(
+        with metrics.timer('ClaimLatency'):
+            claimed = claim_batch_record(job_item, job_name)
+        if not claimed:
+            metrics.put('ClaimsLost', 1)
+            print(f"Batch {job_item['id']} was claimed by another runner or no slot is free, skipping")
+            return False
+    except Exception as e:
+        metrics.put('ClaimErrors', 1)
+        print(f"Error claiming batch {job_item['id']}: {str(e)}")
+        return False
+
+    submission_started = datetime.now(timezone.utc).timestamp()
+    try:
+        with metrics.timer('SubmissionLatency'):
+            response = clients.client('bedrock').create_model_invocation_job(
             modelId=MODEL_ID,
             jobName=job_name,
+            # same token for every retry of this claim, so a retried call
+            # can't create a second job
+            clientRequestToken=job_name,
             inputDataConfig={
                 "s3InputDataConfig": {
                     "s3Uri": job_item['data_s3_uri']
@@ -82,41 +270,67 @@ def create_batch_job(job_item):
             },
             roleArn=IAM_ROLE_ARN
         )
-        time.sleep(10)
-
-        job_arn = response['jobArn']
-        
-        
-        # Update DynamoDB with the job ARN and status
-        table.update_item(
-            Key={'id': job_item['id']},
-            UpdateExpression='SET #status = :status, #job_arn = :arn, #created_dt = :created_dt',
-            ExpressionAttributeNames={
-                '#status': 'status',
-                '#job_arn': 'batch_job_arn',
-                '#created_dt': 'created_dt'
-            },
-            ExpressionAttributeValues={
-                ':status': 'SUMMITTED',
-                ':arn': job_arn,
-                ':created_dt': current_time
-            }
-        )
-        
-        return True
     except Exception as e:
+        metrics.put('SubmissionErrors', 1)
         print(f"Error creating batch job: {str(e)}")
+        try:
+            release_claim(job_item, job_name)
+        except Exception as e:
+            # the claim is left to recover_stale_claims, once it times out
+            print(f"Error releasing claim on batch {job_item['id']}: {str(e)}")
         return False
 
+    # Update DynamoDB with the job ARN and status
+    try:
+        mark_submitted(job_item, job_name, response['jobArn'])
+    except Exception as e:
+        # the job runs and keeps its slot; recover_stale_claims finds it by
+        # name and records the ARN once the claim times out
+        metrics.put('SubmissionErrors', 1)
+        print(f"Error recording job {response['jobArn']} for batch {job_item['id']}: {str(e)}")
+    metrics.put('JobsSubmitted', 1)
+    metrics.put('QueueWait', submission_started - registry.registered_at(job_item), 'Seconds')
+    return True
+
+def find_job_by_name(job_name):
+    res = clients.client('bedrock').list_model_invocation_jobs(nameContains=job_name)
+    for summary in res.get("invocationJobSummaries", []):
+        if summary.get("jobName") == job_name:
+            return summary
+    return None
+
+def recover_stale_claims():
+    """
+    Resolve claims left behind by a runner that died mid-submission: if the job
+    was created, record it, otherwise put the record back to Pending.
+    """
+    now = datetime.now(timezone.utc)
+    for item in get_claimed_embedding_batch_records():
+        claimed_at = datetime.fromisoformat(item['claimed_at'])
+        if (now - claimed_at).total_seconds() < CLAIM_TIMEOUT_SECONDS:
+            continue
+        job = find_job_by_name(item['batch_job_name'])
+        if job is not None:
+            metrics.put('StaleClaimsRecovered', 1)
+            print(f"Recovered job {job['jobArn']} for stale claim on batch {item['id']}")
+            mark_submitted(item, item['batch_job_name'], job['jobArn'])
+        else:
+            metrics.put('StaleClaimsReleased', 1)
+            print(f"Releasing stale claim on batch {item['id']}")
+            release_claim(item, item['batch_job_name'])
+
+@metrics.emitting
 def handler(event, context):
     """
     Lambda handler to monitor and manage batch inference jobs.
     """
     print("Starting batch job runner")
-    print(f"Event: {event}")
+    print(f"Triggered by: {event.get('source', 'unknown')}")
+    recover_stale_claims()
+
     # Get current active jobs
-    active_jobs = get_batch_inference_jobs()
-    active_job_count = len(active_jobs)
+    active_job_count, active_by_owner = get_active_slots()
+    metrics.put('ActiveSlots', active_job_count)
     
     print(f"Current active jobs: {active_job_count}")
     
@@ -132,21 +346,29 @@ def handler(event, context):
     jobs_to_start = MAX_CONCURRENT_JOBS - active_job_count
     print(f"Can start {jobs_to_start} new jobs")
     
-    # Get pending jobs from DynamoDB
-    pending_jobs = get_pending_embedding_batch_records()
+    # Get the head of every owner's pending queue, no longer than there are free slots
+    with metrics.timer('PendingQueryLatency'):
+        pending_jobs = get_pending_embedding_batch_records(jobs_to_start)
+    # only the head of each queue is read, so this counts up to
+    # jobs_to_start batches per owner, not the whole backlog
+    queue_heads = [item for items in pending_jobs.values() for item in items]
+    metrics.put('PendingQueueHeads', len(queue_heads))
+    if queue_heads:
+        now = datetime.now(timezone.utc).timestamp()
+        metrics.put('OldestPendingAge', max(now - registry.registered_at(item) for item in queue_heads), 'Seconds')
     
-    if not pending_jobs:
+    if not queue_heads:
         print("No pending jobs found")
         return {
             'statusCode': 200,
             'body': 'No pending jobs to process'
         }
     
-    # Start new batch jobs
-    jobs_started = 0
-    for job in pending_jobs[:jobs_to_start]:
-        if create_batch_job(job):
-            jobs_started += 1
+    # Share the free slots between owners, then start the new batch jobs
+    # concurrently; each one is guarded by its own claim
+    to_start = fair_share.allocate(pending_jobs, active_by_owner, jobs_to_start, OWNER_WEIGHTS)
+    with ThreadPoolExecutor(max_workers=len(to_start)) as executor:
+        jobs_started = sum(executor.map(create_batch_job, to_start))
     
     print(f"Started {jobs_started} new batch jobs. Active jobs: {active_job_count}")
     return {
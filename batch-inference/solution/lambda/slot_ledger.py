@@ -0,0 +1,138 @@
+"""
+Active job slot ledger, kept as a single item in the batch registry table.
+
+The runner takes a slot in the same transaction that claims a batch and the
+monitor gives it back in the same transaction that records a terminal job
+status, so the count stays exact without listing the job history. The
+runner periodically overwrites it with a fresh count to repair any drift.
+
+Next to the total, `active_jobs#<owner>` counts the slots held by each
+owner, for fair-share scheduling.
+"""
+import random
+import time
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+SLOT_LEDGER_ID = "__active_slots__"
+OWNER_COUNTER_PREFIX = "active_jobs#"
+# a transaction cancelled by a concurrent one on the ledger item is retried this often
+MAX_TRANSACTION_ATTEMPTS = 8
+TRANSACTION_MAX_BACKOFF_SECONDS = 2.0
+
+
+def owner_active(ledger: dict) -> dict:
+    """Slots held per owner, from a ledger item."""
+    return {
+        name[len(OWNER_COUNTER_PREFIX):]: int(count)
+        for name, count in ledger.items() if name.startswith(OWNER_COUNTER_PREFIX)
+    }
+
+
+def acquire_slot(table, max_slots: int, owner: str) -> dict:
+    """Transaction item taking a slot for `owner`, failing if all `max_slots` are in use."""
+    return {
+        'Update': {
+            'TableName': table.name,
+            'Key': {'id': SLOT_LEDGER_ID},
+            'UpdateExpression': 'ADD #active_jobs :one, #owner_active :one',
+            'ConditionExpression': 'attribute_not_exists(#active_jobs) OR #active_jobs < :max_slots',
+            'ExpressionAttributeNames': {
+                '#active_jobs': 'active_jobs',
+                '#owner_active': OWNER_COUNTER_PREFIX + owner
+            },
+            'ExpressionAttributeValues': {':one': 1, ':max_slots': max_slots}
+        }
+    }
+
+
+def release_slot(table, owner: str) -> dict:
+    """Transaction item giving a slot held by `owner` back."""
+    return {
+        'Update': {
+            'TableName': table.name,
+            'Key': {'id': SLOT_LEDGER_ID},
+            'UpdateExpression': 'ADD #active_jobs :minus_one, #owner_active :minus_one',
+            'ExpressionAttributeNames': {
+                '#active_jobs': 'active_jobs',
+                '#owner_active': OWNER_COUNTER_PREFIX + owner
+            },
+            'ExpressionAttributeValues': {':minus_one': -1}
+        }
+    }
+
+
+def transact(table, items: list) -> bool:
+    """
+    Run a write transaction, returning False if one of its conditions failed.
+
+    Transactions writing the ledger item at the same time cancel each other
+    with TransactionConflict; those are retried with jittered backoff, as
+    they say nothing about the conditions. Any other cancellation is raised.
+    """
+    for attempt in range(MAX_TRANSACTION_ATTEMPTS):
+        try:
+            table.meta.client.transact_write_items(TransactItems=items)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])} - {'None', None}
+            if 'ConditionalCheckFailed' in reasons:
+                return False
+            if reasons != {'TransactionConflict'} or attempt == MAX_TRANSACTION_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, min(TRANSACTION_MAX_BACKOFF_SECONDS, 0.05 * 2 ** attempt)))
+
+
+def read_ledger(table) -> dict:
+    response = table.get_item(Key={'id': SLOT_LEDGER_ID}, ConsistentRead=True)
+    return response.get('Item', {})
+
+
+def reconcile(table, active_jobs: int, owner_active_jobs: dict, previous_reconciled_at: str = None,
+              seen_active_jobs: int = None) -> bool:
+    """
+    Overwrite the slot counts with authoritative ones.
+
+    Conditional on nobody else having reconciled since `previous_reconciled_at`,
+    so overlapping runners don't fight over it, and on the total still being
+    `seen_active_jobs` (None for no total yet), so a slot taken or given back
+    while the counts were taken isn't overwritten.
+    """
+    if previous_reconciled_at is None:
+        condition = 'attribute_not_exists(#reconciled_at)'
+        values = {}
+    else:
+        condition = '#reconciled_at = :previous'
+        values = {':previous': previous_reconciled_at}
+    if seen_active_jobs is None:
+        condition += ' AND attribute_not_exists(#active_jobs)'
+    else:
+        condition += ' AND #active_jobs = :seen'
+        values[':seen'] = seen_active_jobs
+    owners = sorted(owner_active_jobs)
+    owner_updates = ''.join(f', #owner{i} = :owner{i}' for i in range(len(owners)))
+    try:
+        table.update_item(
+            Key={'id': SLOT_LEDGER_ID},
+            UpdateExpression='SET #active_jobs = :active_jobs, #reconciled_at = :reconciled_at' + owner_updates,
+            ConditionExpression=condition,
+            ExpressionAttributeNames={
+                '#active_jobs': 'active_jobs',
+                '#reconciled_at': 'reconciled_at',
+                **{f'#owner{i}': OWNER_COUNTER_PREFIX + owner for i, owner in enumerate(owners)}
+            },
+            ExpressionAttributeValues={
+                ':active_jobs': active_jobs,
+                ':reconciled_at': datetime.now(timezone.utc).isoformat(),
+                **{f':owner{i}': owner_active_jobs[owner] for i, owner in enumerate(owners)},
+                **values
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
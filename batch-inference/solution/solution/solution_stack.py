@@ -9,12 +9,17 @@ from aws_cdk import (
     # aws_sqs as sqs,
     RemovalPolicy,
     aws_s3 as s3,
-    CfnOutput
+    CfnOutput,
+    Size
 )
 from constructs import Construct
 
 from aws_cdk import Duration
 
+# number of write shards per status in the batch registry's status-shard-index;
+# the ingestion tool must use the same value
+STATUS_SHARDS = "10"
+
 class SolutionStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -32,17 +37,40 @@ class SolutionStack(Stack):
         )
 
         # Add Global Secondary Indexes
+        # new stacks only get status-shard-index. DynamoDB adds or removes a
+        # single GSI per table update, so a stack deployed with the former
+        # status-index keeps it with `cdk deploy -c retire_status_index=false`
+        # until its records are backfilled (ingestion/backfill_status_shard.py),
+        # then drops it with a plain `cdk deploy`
+        if str(self.node.try_get_context("retire_status_index")).lower() == "false":
+            table.add_global_secondary_index(
+                index_name="status-index",
+                partition_key=dynamodb.Attribute(
+                    name="status",
+                    type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name="created_dt",
+                    type=dynamodb.AttributeType.STRING
+                ),
+                projection_type=dynamodb.ProjectionType.ALL
+            )
+
+        # status_shard is "<status>#<owner>#<n>", spreading each owner's records
+        # of a status over STATUS_SHARDS partitions, sorted in queue order by
+        # queue_position; only what the runner reads is projected
         table.add_global_secondary_index(
-            index_name="status-index",
+            index_name="status-shard-index",
             partition_key=dynamodb.Attribute(
-                name="status",
+                name="status_shard",
                 type=dynamodb.AttributeType.STRING
             ),
             sort_key=dynamodb.Attribute(
-                name="created_dt",
-                type=dynamodb.AttributeType.STRING
+                name="queue_position",
+                type=dynamodb.AttributeType.NUMBER
             ),
-            projection_type=dynamodb.ProjectionType.ALL
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["status", "data_s3_uri", "claimed_at", "batch_job_name", "owner", "priority"]
         )
 
         table.add_global_secondary_index(
@@ -58,6 +86,20 @@ class SolutionStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL
         )
 
+        # Fingerprints of the model inputs already registered, for the
+        # ingestion tool's --dedup; written in bursts of a whole input file,
+        # hence billed on demand
+        text_index = dynamodb.Table(
+            self, "EmbeddingTextIndex",
+            table_name="embedding-text-index",
+            partition_key=dynamodb.Attribute(
+                name="fingerprint",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,  # For development - change for production
+        )
+
         # Create a S3 bucket for the batch inference job input & output
         bucket = s3.Bucket(
             self, "EmbeddingBatchJobBucket",
@@ -115,7 +157,10 @@ class SolutionStack(Stack):
                 "BATCH_JOB_S3_OUTPUT_URI": batch_job_s3_output_uri,
                 "IAM_ROLE_ARN": iam_role_arn,
                 "MAX_CONCURRENT_JOBS": "20",
-                "BATCH_JOB_NAME_PREFIX": "embedding-batch-job"
+                "BATCH_JOB_NAME_PREFIX": "embedding-batch-job",
+                "STATUS_SHARDS": STATUS_SHARDS,
+                # relative slot shares per owner, e.g. "search=4,backfill=1"
+                "OWNER_WEIGHTS": ""
             }
         )
 
@@ -138,15 +183,46 @@ class SolutionStack(Stack):
             ],
             resources=[iam_role_arn]
         ))
-        # Create EventBridge rule to trigger Lambda every 1 minute
+        # Create EventBridge rule to trigger Lambda every 5 minutes; the status
+        # monitor invokes it as soon as a job finishes, so this is a safety net
         rule = events.Rule(
             self, "ScheduleRule",
-            schedule=events.Schedule.rate(Duration.minutes(1))
+            schedule=events.Schedule.rate(Duration.minutes(5))
         )
 
         # Add Lambda as target for the EventBridge rule
         rule.add_target(targets.LambdaFunction(batch_processor))
 
+        # Create Post-processing Lambda function, converting the output of
+        # successful jobs into float32 embedding shards
+        output_postprocessor = lambda_.Function(
+            self, "BatchOutputPostProcessor",
+            function_name="batch-output-postprocessor",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            handler="postprocess.handler",
+            code=lambda_.Code.from_asset("lambda"),
+            layers=[boto3_layer],
+            timeout=Duration.minutes(15),
+            memory_size=2048,
+            ephemeral_storage_size=Size.gibibytes(4),
+            environment={
+                "TABLE_NAME": table.table_name,
+                "EMBEDDINGS_S3_URI": f"s3://{bucket.bucket_name}/embeddings/",
+                "RESUBMIT_S3_URI": f"s3://{bucket.bucket_name}/input/",
+                # duplicates sidecars written by the ingestion tool's --dedup
+                "DUPLICATES_S3_URI": f"s3://{bucket.bucket_name}/duplicates/",
+                "STATUS_SHARDS": STATUS_SHARDS
+            }
+        )
+
+        table.grant_read_write_data(output_postprocessor)
+        bucket.grant_read_write(output_postprocessor)
+
+        # the runner records the terminal status of jobs whose state change
+        # event was missed, which starts their post-processing
+        batch_processor.add_environment("POSTPROCESS_FUNCTION_NAME", output_postprocessor.function_name)
+        output_postprocessor.grant_invoke(batch_processor)
+
         # Create Status Monitor Lambda function
         status_monitor = lambda_.Function(
             self, "BatchInferenceStatusMonitor",
@@ -156,13 +232,28 @@ class SolutionStack(Stack):
             code=lambda_.Code.from_asset("lambda"),
             layers=[boto3_layer],
             environment={
-                "TABLE_NAME": table.table_name
+                "TABLE_NAME": table.table_name,
+                "RUNNER_FUNCTION_NAME": batch_processor.function_name,
+                "POSTPROCESS_FUNCTION_NAME": output_postprocessor.function_name,
+                "STATUS_SHARDS": STATUS_SHARDS
             }
         )
 
+        # Let the Status Monitor refill freed slots by invoking the runner
+        batch_processor.grant_invoke(status_monitor)
+        output_postprocessor.grant_invoke(status_monitor)
+
         # Grant Status Monitor Lambda permissions to access DynamoDB
         table.grant_read_write_data(status_monitor)
 
+        # Grant Status Monitor Lambda permissions to read the job output location
+        status_monitor.add_to_role_policy(iam.PolicyStatement(
+            actions=[
+                "bedrock:GetModelInvocationJob",
+            ],
+            resources=["*"]
+        ))
+
         # Create EventBridge rule for Bedrock Job status changes
         bedrock_status_rule = events.Rule(
             self, "BedrockStatusRule",
@@ -181,4 +272,6 @@ class SolutionStack(Stack):
         
         CfnOutput(self, "BatchInferenceRoleArn", value=bedrock_role.role_arn)
         CfnOutput(self, "DataS3BucketName", value=bucket.bucket_name)
-        CfnOutput(self, "BatchRegistryTableName", value=table.table_name)
\ No newline at end of file
+        CfnOutput(self, "BatchRegistryTableName", value=table.table_name)
+        CfnOutput(self, "TextIndexTableName", value=text_index.table_name)
+        CfnOutput(self, "PostProcessFunctionName", value=output_postprocessor.function_name)
\ No newline at end of file
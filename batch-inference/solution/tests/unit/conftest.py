@@ -0,0 +1,8 @@
+import os
+import sys
+
+SOLUTION_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the Lambda handlers are flat modules, imported from lambda/ as in the runtime,
+# and the modules their layer gets from the on-demand tools from there
+sys.path.insert(0, os.path.join(SOLUTION_DIR, "lambda"))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(SOLUTION_DIR)), "on-demand-invocation"))
@@ -0,0 +1,43 @@
+import fair_share
+
+
+def queue(owner, count, start=0):
+    return [{'id': f"{owner}-{i}", 'owner': owner, 'queue_position': start + i} for i in range(count)]
+
+
+def owners(selected):
+    return [item['owner'] for item in selected]
+
+
+def test_parse_weights():
+    assert fair_share.parse_weights(" search=4, backfill=1,,") == {"search": 4.0, "backfill": 1.0}
+    assert fair_share.parse_weights("") == {}
+
+
+def test_slots_are_shared_by_weight():
+    selected = fair_share.allocate({"search": queue("search", 20), "backfill": queue("backfill", 20)},
+                                   {}, 8, {"search": 3})
+    assert owners(selected).count("search") == 6
+    assert owners(selected).count("backfill") == 2
+
+
+def test_active_slots_count_against_the_share():
+    selected = fair_share.allocate({"search": queue("search", 20), "backfill": queue("backfill", 20)},
+                                   {"backfill": 4}, 6)
+    assert owners(selected) == ["search"] * 4 + ["backfill", "search"]
+
+
+def test_idle_owners_get_no_slots():
+    # an owner with running jobs but nothing queued doesn't hold slots back
+    selected = fair_share.allocate({"search": queue("search", 10), "backfill": []}, {"backfill": 1}, 5)
+    assert owners(selected) == ["search"] * 5
+
+
+def test_leftover_slots_stay_free_when_queues_run_out():
+    selected = fair_share.allocate({"search": queue("search", 2), "backfill": queue("backfill", 1)}, {}, 10)
+    assert len(selected) == 3
+
+
+def test_each_owner_is_served_in_queue_order_and_ties_go_to_the_earliest_batch():
+    selected = fair_share.allocate({"search": queue("search", 3, start=100), "backfill": queue("backfill", 3)}, {}, 4)
+    assert [item['id'] for item in selected] == ["backfill-0", "search-0", "backfill-1", "search-1"]
@@ -0,0 +1,125 @@
+import importlib
+import json
+from array import array
+
+import pytest
+
+import clients
+from npy_format import NPY_HEADER_SIZE, npy_shape
+
+BUCKET = "embedding-bucket"
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "EMBEDDINGS_S3_URI": f"s3://{BUCKET}/embeddings/",
+    "RESUBMIT_S3_URI": f"s3://{BUCKET}/resubmit/",
+    "DUPLICATES_S3_URI": f"s3://{BUCKET}/duplicates/",
+}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        table = boto3.resource("dynamodb").create_table(
+            TableName="embedding-batch-registry",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(clients, "client", lambda service_name: s3)
+        monkeypatch.setattr(clients, "registry_table", lambda: table)
+        yield importlib.import_module("postprocess"), s3, table
+
+
+def output_line(record_id, embedding=None):
+    record = {'recordId': record_id, 'modelInput': {'inputText': f"text of {record_id}"}}
+    if embedding is None:
+        record['error'] = {'errorCode': 400, 'errorMessage': 'Malformed input'}
+    else:
+        record['modelOutput'] = {'embedding': embedding}
+    return json.dumps(record) + '\n'
+
+
+def put_lines(s3, key, lines):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=''.join(lines).encode('utf-8'))
+
+
+def read_shard(s3, key):
+    """`(rows, {recordId: vector})` of an embedding shard and its index."""
+    data = s3.get_object(Bucket=BUCKET, Key=key + '.npy')['Body'].read()
+    rows, dimensions = npy_shape(data[:NPY_HEADER_SIZE])
+    vectors = array('f', data[NPY_HEADER_SIZE:])
+    index = s3.get_object(Bucket=BUCKET, Key=key + '.index.jsonl')['Body'].read().decode('utf-8').splitlines()
+    record_ids = [json.loads(line)['recordId'] for line in index]
+    return rows, {record_id: list(vectors[i * dimensions:(i + 1) * dimensions]) for i, record_id in enumerate(record_ids)}
+
+
+def register(table, batch_id, **attributes):
+    item = {'id': batch_id, 'owner': 'search', 'priority': 0, 'queue_position': 1000,
+            'output_data_s3_uri': f"s3://{BUCKET}/output/{batch_id}/", **attributes}
+    table.put_item(Item=item)
+    return item
+
+
+def test_output_objects_become_npy_shards(aws):
+    postprocess, s3, table = aws
+    register(table, 'batch-1')
+    put_lines(s3, 'output/batch-1/job/a.jsonl.out', [output_line('r1', [1.0, 2.0]), output_line('r2', [3.0, 4.0])])
+    put_lines(s3, 'output/batch-1/job/b.jsonl.out', [output_line('r3', [5.0, 6.0]), output_line('r4')])
+    put_lines(s3, 'output/batch-1/job/manifest.json.out', ['{}'])
+
+    postprocess.handler({'id': 'batch-1'}, None)
+
+    assert read_shard(s3, 'embeddings/batch-1/part-00000') == (2, {'r1': [1.0, 2.0], 'r2': [3.0, 4.0]})
+    assert read_shard(s3, 'embeddings/batch-1/part-00001') == (1, {'r3': [5.0, 6.0]})
+    item = table.get_item(Key={'id': 'batch-1'})['Item']
+    assert (item['embedded_count'], item['failed_count']) == (3, 1)
+    # too few failed records for a batch job: written out, not queued
+    assert 'Item' not in table.get_item(Key={'id': 'batch-1-r'})
+    failed = s3.get_object(Bucket=BUCKET, Key='resubmit/batch-1-r/data.jsonl')['Body'].read().decode('utf-8')
+    assert [json.loads(line) for line in failed.splitlines()] == [{'recordId': 'r4', 'modelInput': {'inputText': 'text of r4'}}]
+
+
+def test_failed_records_are_queued_once_as_a_resubmission(aws):
+    postprocess, s3, table = aws
+    item = register(table, 'batch-1', priority=2, queue_position=500)
+    failed = [{'recordId': f"r{i}", 'modelInput': {'inputText': 'text'}} for i in range(postprocess.MIN_RECORDS_PER_JOB)]
+
+    data_s3_uri = postprocess.register_resubmission(item, failed)
+    queued = table.get_item(Key={'id': 'batch-1-r'})['Item']
+    assert queued['data_s3_uri'] == data_s3_uri == f"s3://{BUCKET}/resubmit/batch-1-r/data.jsonl"
+    assert (queued['status'], queued['owner'], queued['retry_of']) == ('Pending', 'search', 'batch-1')
+    # the retry keeps the original place in the queue
+    assert (queued['queue_position'], queued['priority']) == (500, 2)
+
+    table.update_item(Key={'id': 'batch-1-r'}, UpdateExpression='SET #status = :s',
+                      ExpressionAttributeNames={'#status': 'status'}, ExpressionAttributeValues={':s': 'SUMMITTED'})
+    postprocess.register_resubmission(item, failed)
+    assert table.get_item(Key={'id': 'batch-1-r'})['Item']['status'] == 'SUMMITTED'
+    assert postprocess.root_batch_id('batch-1-r-r') == 'batch-1'
+
+
+def test_duplicates_get_the_vectors_of_their_canonical_records(aws):
+    postprocess, s3, table = aws
+    register(table, 'batch-1')
+    put_lines(s3, 'output/batch-1/job/a.jsonl.out', [output_line('r1', [1.0, 2.0]), output_line('r2')])
+    put_lines(s3, 'duplicates/batch-1/run-a.jsonl', [
+        json.dumps({'recordId': 'd1', 'canonicalRecordId': 'r1'}) + '\n',
+        json.dumps({'recordId': 'd2', 'canonicalRecordId': 'r2'}) + '\n',
+    ])
+    postprocess.handler({'id': 'batch-1'}, None)
+    assert read_shard(s3, 'embeddings/batch-1/dup-run-a') == (1, {'d1': [1.0, 2.0]})
+
+    # once the resubmission embeds r2, a rerun of the fan-out fills in d2
+    register(table, 'batch-1-r')
+    put_lines(s3, 'output/batch-1-r/job/a.jsonl.out', [output_line('r2', [3.0, 4.0])])
+    postprocess.handler({'id': 'batch-1-r'}, None)
+    assert read_shard(s3, 'embeddings/batch-1/dup-run-a') == (2, {'d1': [1.0, 2.0], 'd2': [3.0, 4.0]})
+    assert postprocess.fan_out_duplicates('batch-1') == (2, 0)
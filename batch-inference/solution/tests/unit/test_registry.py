@@ -0,0 +1,72 @@
+import registry
+
+
+class ShardedTable:
+    """Answers status-shard-index queries from a list of items, two per page."""
+
+    page_size = 2
+
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def query(self, IndexName, KeyConditionExpression, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None):
+        assert IndexName == registry.STATUS_SHARD_INDEX
+        shard_key = KeyConditionExpression.get_expression()['values'][1]
+        self.queries.append(shard_key)
+        items = sorted((item for item in self.items if item['status_shard'] == shard_key),
+                       key=lambda item: item['queue_position'], reverse=not ScanIndexForward)
+        start = ExclusiveStartKey['index'] if ExclusiveStartKey else 0
+        end = start + min(self.page_size, Limit or self.page_size)
+        response = {'Items': items[start:end]}
+        if end < len(items):
+            response['LastEvaluatedKey'] = {'index': end}
+        return response
+
+
+def record(record_id, status="Pending", owner=registry.DEFAULT_OWNER, registered=0, priority=0):
+    return {
+        'id': record_id,
+        'status': status,
+        'owner': owner,
+        'priority': priority,
+        'status_shard': registry.status_shard(record_id, status, owner),
+        'queue_position': registered - priority * registry.PRIORITY_BOOST_SECONDS,
+    }
+
+
+def test_status_shard_is_stable_and_within_range():
+    shards = {registry.status_shard(f"batch-{i}", "Pending", "search") for i in range(200)}
+    assert shards == {f"Pending#search#{n}" for n in range(registry.STATUS_SHARDS)}
+    assert registry.status_shard("batch-1", "Pending") == registry.status_shard("batch-1", "Pending")
+    assert registry.status_shard("batch-1", "Claimed").startswith("Claimed#default#")
+
+
+def test_query_status_merges_shards_in_queue_order():
+    items = [record(f"batch-{i}", registered=1000 + (i * 37) % 50) for i in range(50)]
+    items += [record("claimed", status="Claimed", registered=0)]
+    result = registry.query_status(ShardedTable(items), "Pending", {registry.DEFAULT_OWNER})
+    positions = [item['queue_position'] for item in result[registry.DEFAULT_OWNER]]
+    assert len(positions) == 50
+    assert positions == sorted(positions)
+
+
+def test_query_status_reads_at_most_limit_per_shard_and_owner():
+    items = [record(f"s-{i}", owner="search", registered=i) for i in range(40)]
+    items += [record(f"b-{i}", owner="backfill", registered=i) for i in range(40)]
+    result = registry.query_status(ShardedTable(items), "Pending", {"search", "backfill"}, limit=3)
+    assert [item['id'] for item in result["search"]] == ["s-0", "s-1", "s-2"]
+    assert [item['id'] for item in result["backfill"]] == ["b-0", "b-1", "b-2"]
+
+
+def test_priority_moves_a_batch_ahead_without_changing_its_registration_time():
+    items = [record("old", registered=10_000), record("urgent", registered=12_000, priority=1)]
+    queue = registry.query_status(ShardedTable(items), "Pending", {registry.DEFAULT_OWNER})[registry.DEFAULT_OWNER]
+    assert [item['id'] for item in queue] == ["urgent", "old"]
+    assert registry.registered_at(queue[0]) == 12_000
+
+
+def test_query_status_with_no_free_slot_reads_nothing():
+    table = ShardedTable([record("batch-1")])
+    assert registry.query_status(table, "Pending", {"search"}, limit=0) == {"search": []}
+    assert table.queries == []
@@ -0,0 +1,107 @@
+import importlib
+
+import pytest
+from botocore.exceptions import ClientError
+
+import clients
+import metrics
+import slot_ledger
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "TABLE_NAME": "embedding-batch-registry",
+    "MODEL_ID": "amazon.titan-embed-text-v2:0",
+    "BATCH_JOB_S3_OUTPUT_URI": "s3://bucket/output/",
+    "IAM_ROLE_ARN": "arn:aws:iam::123456789012:role/batch",
+}
+
+
+class StubBedrock:
+    """Creates jobs, or raises `error` from create_model_invocation_job."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.job_names = []
+
+    def create_model_invocation_job(self, jobName, **kwargs):
+        self.job_names.append(jobName)
+        if self.error is not None:
+            raise self.error
+        return {'jobArn': f"arn:aws:bedrock:us-east-1:123456789012:model-invocation-job/{jobName}"}
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        table = boto3.resource("dynamodb").create_table(
+            TableName=ENVIRONMENT["TABLE_NAME"],
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table.put_item(Item={'id': 'batch-1', 'status': 'Pending', 'owner': 'search',
+                             'data_s3_uri': 's3://bucket/input/batch-1.jsonl', 'queue_position': 1000})
+        monkeypatch.setattr(clients, "registry_table", lambda: table)
+        monkeypatch.setattr(metrics, "_values", {})
+        yield importlib.import_module("runner"), table
+
+
+def use_bedrock(monkeypatch, bedrock):
+    monkeypatch.setattr(clients, "client", lambda service_name: bedrock)
+
+
+def throttling(operation):
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+
+def test_created_job_is_recorded_on_its_claim(runner, monkeypatch):
+    runner, table = runner
+    bedrock = StubBedrock()
+    use_bedrock(monkeypatch, bedrock)
+    assert runner.create_batch_job(table.get_item(Key={'id': 'batch-1'})['Item'])
+    item = table.get_item(Key={'id': 'batch-1'})['Item']
+    assert item['status'] == runner.SUBMITTED_EMBEDDING_BATCH_STATUS
+    assert item['batch_job_name'] == bedrock.job_names[0]
+    assert item['batch_job_arn'].endswith(bedrock.job_names[0])
+    assert slot_ledger.owner_active(slot_ledger.read_ledger(table)) == {"search": 1}
+
+
+def test_failed_creation_releases_the_claim_and_its_slot(runner, monkeypatch):
+    runner, table = runner
+    use_bedrock(monkeypatch, StubBedrock(throttling('CreateModelInvocationJob')))
+    assert not runner.create_batch_job(table.get_item(Key={'id': 'batch-1'})['Item'])
+    item = table.get_item(Key={'id': 'batch-1'})['Item']
+    assert item['status'] == runner.PENDING_EMBEDDING_BATCH_STATUS
+    assert 'batch_job_name' not in item
+    assert slot_ledger.read_ledger(table)['active_jobs'] == 0
+    assert metrics._values['SubmissionErrors'][1] == [1]
+
+
+def test_failed_release_is_left_to_stale_claim_recovery(runner, monkeypatch):
+    runner, table = runner
+    use_bedrock(monkeypatch, StubBedrock(throttling('CreateModelInvocationJob')))
+
+    def release_claim(job_item, job_name):
+        raise throttling('TransactWriteItems')
+    monkeypatch.setattr(runner, "release_claim", release_claim)
+    assert not runner.create_batch_job(table.get_item(Key={'id': 'batch-1'})['Item'])
+    assert table.get_item(Key={'id': 'batch-1'})['Item']['status'] == runner.CLAIMED_EMBEDDING_BATCH_STATUS
+
+
+def test_failed_mark_counts_as_a_submission_error(runner, monkeypatch):
+    runner, table = runner
+    use_bedrock(monkeypatch, StubBedrock())
+
+    def mark_submitted(job_item, job_name, job_arn):
+        raise throttling('UpdateItem')
+    monkeypatch.setattr(runner, "mark_submitted", mark_submitted)
+    # the job was created, so it is started whether or not its ARN is recorded
+    assert runner.create_batch_job(table.get_item(Key={'id': 'batch-1'})['Item'])
+    assert table.get_item(Key={'id': 'batch-1'})['Item']['status'] == runner.CLAIMED_EMBEDDING_BATCH_STATUS
+    assert metrics._values['SubmissionErrors'][1] == [1]
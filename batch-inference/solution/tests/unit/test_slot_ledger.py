@@ -0,0 +1,139 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import slot_ledger
+
+
+def cancellation(*codes):
+    return ClientError({
+        'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+        'CancellationReasons': [{'Code': code} for code in codes],
+    }, 'TransactWriteItems')
+
+
+class StubClient:
+    """Raises the queued errors from transact_write_items, then succeeds."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def transact_write_items(self, TransactItems):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+class StubTable:
+    name = 'registry'
+
+    def __init__(self, errors=()):
+        self.meta = type('Meta', (), {'client': StubClient(errors)})()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(slot_ledger.time, 'sleep', lambda seconds: None)
+
+
+def test_transact_retries_conflicts():
+    table = StubTable([cancellation('None', 'TransactionConflict'), cancellation('TransactionConflict', 'None')])
+    assert slot_ledger.transact(table, [])
+    assert table.meta.client.calls == 3
+
+
+def test_transact_returns_false_on_failed_condition():
+    table = StubTable([cancellation('None', 'ConditionalCheckFailed')])
+    assert not slot_ledger.transact(table, [])
+    assert table.meta.client.calls == 1
+
+
+def test_transact_raises_other_cancellations():
+    table = StubTable([cancellation('None', 'ThrottlingError')])
+    with pytest.raises(ClientError):
+        slot_ledger.transact(table, [])
+
+
+def test_transact_gives_up_on_persistent_conflicts():
+    table = StubTable([cancellation('TransactionConflict')] * slot_ledger.MAX_TRANSACTION_ATTEMPTS)
+    with pytest.raises(ClientError):
+        slot_ledger.transact(table, [])
+    assert table.meta.client.calls == slot_ledger.MAX_TRANSACTION_ATTEMPTS
+
+
+@pytest.fixture
+def registry_table(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in (("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "testing"),
+                        ("AWS_SECRET_ACCESS_KEY", "testing")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        yield boto3.resource("dynamodb").create_table(
+            TableName="embedding-batch-registry",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+def claim(table, record_id):
+    """The runner's Pending -> Claimed update, as a transaction item."""
+    return {'Update': {
+        'TableName': table.name,
+        'Key': {'id': record_id},
+        'UpdateExpression': 'SET #status = :claimed',
+        'ConditionExpression': '#status = :pending',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {':claimed': 'Claimed', ':pending': 'Pending'},
+    }}
+
+
+def test_acquire_stops_at_max_slots(registry_table):
+    acquired = [slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 3, owner)])
+                for owner in ("search", "search", "backfill", "backfill")]
+    assert acquired == [True, True, True, False]
+    ledger = slot_ledger.read_ledger(registry_table)
+    assert ledger['active_jobs'] == 3
+    assert slot_ledger.owner_active(ledger) == {"search": 2, "backfill": 1}
+
+
+def test_release_frees_a_slot_for_the_next_acquire(registry_table):
+    for _ in range(2):
+        slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 2, "search")])
+    assert slot_ledger.transact(registry_table, [slot_ledger.release_slot(registry_table, "search")])
+    assert slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 2, "backfill")])
+    assert slot_ledger.owner_active(slot_ledger.read_ledger(registry_table)) == {"search": 1, "backfill": 1}
+
+
+def test_slot_is_not_taken_when_the_claim_fails(registry_table):
+    registry_table.put_item(Item={'id': 'batch-1', 'status': 'Claimed'})
+    assert not slot_ledger.transact(registry_table, [claim(registry_table, 'batch-1'),
+                                                     slot_ledger.acquire_slot(registry_table, 3, "search")])
+    assert slot_ledger.read_ledger(registry_table) == {}
+
+
+def test_claim_is_not_made_when_no_slot_is_free(registry_table):
+    registry_table.put_item(Item={'id': 'batch-1', 'status': 'Pending'})
+    slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 1, "search")])
+    assert not slot_ledger.transact(registry_table, [claim(registry_table, 'batch-1'),
+                                                     slot_ledger.acquire_slot(registry_table, 1, "search")])
+    assert registry_table.get_item(Key={'id': 'batch-1'})['Item']['status'] == 'Pending'
+
+
+def test_reconcile_is_conditional_on_the_previous_reconciliation(registry_table):
+    assert slot_ledger.reconcile(registry_table, 2, {"search": 2})
+    reconciled_at = slot_ledger.read_ledger(registry_table)['reconciled_at']
+    assert not slot_ledger.reconcile(registry_table, 5, {"search": 5})
+    assert slot_ledger.reconcile(registry_table, 1, {"search": 1}, reconciled_at, 2)
+    assert slot_ledger.read_ledger(registry_table)['active_jobs'] == 1
+
+
+def test_reconcile_is_skipped_when_a_slot_was_taken_meanwhile(registry_table):
+    slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 3, "search")])
+    ledger = slot_ledger.read_ledger(registry_table)
+    # counted from the registry before the second slot's claim was visible
+    slot_ledger.transact(registry_table, [slot_ledger.acquire_slot(registry_table, 3, "search")])
+    assert not slot_ledger.reconcile(registry_table, 1, {"search": 1}, ledger.get('reconciled_at'),
+                                     ledger['active_jobs'])
+    assert slot_ledger.read_ledger(registry_table)['active_jobs'] == 2
@@ -13,3 +13,20 @@ def test_sqs_queue_created():
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+def registry_indexes(context=None):
+    app = core.App(context=context)
+    template = assertions.Template.from_stack(SolutionStack(app, "solution"))
+    [table] = template.find_resources("AWS::DynamoDB::Table", {
+        "Properties": {"TableName": "embedding-batch-registry"}
+    }).values()
+    return sorted(index["IndexName"] for index in table["Properties"]["GlobalSecondaryIndexes"])
+
+
+def test_new_stack_has_no_former_status_index():
+    assert registry_indexes() == ["batch-job-arn-index", "status-shard-index"]
+
+
+def test_upgrade_keeps_the_former_status_index():
+    assert registry_indexes({"retire_status_index": "false"}) == ["batch-job-arn-index", "status-index", "status-shard-index"]
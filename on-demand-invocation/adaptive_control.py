@@ -0,0 +1,216 @@
+import asyncio
+import multiprocessing
+import random
+import time
+from time import monotonic
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceQuotaExceededException",
+}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+}
+
+# botocore retries internally by default, which hides throttles from the
+# controller; clients used with it should be built with this config.
+NO_SDK_RETRIES = Config(retries={'total_max_attempts': 1, 'mode': 'standard'})
+
+
+def is_throttling_error(e: Exception) -> bool:
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_retryable_error(e: Exception) -> bool:
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in RETRYABLE_ERROR_CODES
+    return isinstance(e, (ConnectionError, HTTPClientError))
+
+
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 20.0) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class AdaptiveController:
+    """
+    AIMD concurrency controller driven by throttling and latency feedback.
+
+    Every call holds a slot while it is in flight. Each success grows the limit
+    by `increase / limit` (about +`increase` per round of requests), while a
+    throttle multiplies it by `decrease`, at most once per `cooldown` seconds.
+    So does a sustained rise in latency: a short EWMA (`ewma_alpha`) above
+    `latency_tolerance` times a slowly decaying baseline EWMA (`baseline_alpha`).
+    The baseline follows the latency the service settles at, so normal
+    variation never trips it, unlike the best latency ever seen would. The
+    state lives in shared memory, so a single controller can be handed to
+    every worker process through a pool `initargs`.
+    """
+
+    # indexes into the shared state array
+    _LIMIT, _IN_FLIGHT, _LAST_DECREASE, _LATENCY_EWMA, _LATENCY_BASELINE = range(5)
+
+    def __init__(self, initial_limit: float, min_limit: float = 1, max_limit: float = 512,
+                 increase: float = 1.0, decrease: float = 0.5, latency_tolerance: float = 2.0,
+                 cooldown: float = 1.0, ewma_alpha: float = 0.1, baseline_alpha: float = 0.01):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.baseline_alpha = baseline_alpha
+        self._state = multiprocessing.Array('d', [min(max(initial_limit, min_limit), max_limit), 0, 0, 0, 0])
+        self._condition = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_condition'] = None
+        return state
+
+    @property
+    def limit(self) -> float:
+        return self._state[self._LIMIT]
+
+    @property
+    def in_flight(self) -> int:
+        return int(self._state[self._IN_FLIGHT])
+
+    def try_acquire(self) -> bool:
+        with self._state.get_lock():
+            if self._state[self._IN_FLIGHT] + 1 > max(self.min_limit, int(self._state[self._LIMIT])):
+                return False
+            self._state[self._IN_FLIGHT] += 1
+            return True
+
+    def acquire(self, poll_interval: float = 0.01):
+        while not self.try_acquire():
+            time.sleep(poll_interval)
+
+    async def acquire_async(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(self.try_acquire)
+
+    def _decrease(self, now):
+        if now - self._state[self._LAST_DECREASE] >= self.cooldown:
+            self._state[self._LIMIT] = max(self.min_limit, self._state[self._LIMIT] * self.decrease)
+            self._state[self._LAST_DECREASE] = now
+
+    def release(self, latency: float = None, throttled: bool = False):
+        """Free a slot and feed the outcome of the call back into the limit."""
+        now = monotonic()
+        with self._state.get_lock():
+            self._state[self._IN_FLIGHT] -= 1
+            if throttled:
+                self._decrease(now)
+            elif latency is not None:
+                ewma = self._state[self._LATENCY_EWMA]
+                ewma = latency if ewma == 0 else ewma + self.ewma_alpha * (latency - ewma)
+                self._state[self._LATENCY_EWMA] = ewma
+                baseline = self._state[self._LATENCY_BASELINE]
+                baseline = latency if baseline == 0 else baseline + self.baseline_alpha * (latency - baseline)
+                self._state[self._LATENCY_BASELINE] = baseline
+                if ewma > self.latency_tolerance * baseline:
+                    self._decrease(now)
+                else:
+                    limit = self._state[self._LIMIT]
+                    self._state[self._LIMIT] = min(self.max_limit, limit + self.increase / limit)
+
+    async def release_async(self, latency: float = None, throttled: bool = False):
+        self.release(latency, throttled)
+        if self._condition is not None:
+            async with self._condition:
+                self._condition.notify_all()
+
+
+def record_failure(metrics, e: Exception, retrying: bool):
+    if metrics is None:
+        return
+    if is_throttling_error(e):
+        metrics.incr("throttles")
+    metrics.incr("retries" if retrying else "errors")
+
+
+def call_with_retries(fn, controller: AdaptiveController = None, acquire=None,
+                      max_attempts: int = 6, base_delay: float = 0.5, max_delay: float = 20.0,
+                      metrics=None):
+    """
+    Call `fn()` holding a controller slot, retrying retryable errors with backoff.
+
+    Each attempt also calls `acquire()`, when given, to wait for rate limit
+    budget after the slot is taken, so the measured latency excludes that wait.
+    With `metrics`, attempts, throttles, retries, final errors and the latency
+    of successful attempts (`invoke_latency_ms`) are recorded.
+    """
+    for attempt in range(max_attempts):
+        if controller is not None:
+            controller.acquire()
+        latency, error = None, None
+        try:
+            if acquire is not None:
+                acquire()
+            start = monotonic()
+            if metrics is not None:
+                metrics.incr("requests")
+            result = fn()
+            latency = monotonic() - start
+        except Exception as e:
+            error = e
+        finally:
+            # also runs on KeyboardInterrupt, so the slot is never leaked
+            if controller is not None:
+                controller.release(latency=latency, throttled=error is not None and is_throttling_error(error))
+        if error is not None:
+            retrying = is_retryable_error(error) and attempt < max_attempts - 1
+            record_failure(metrics, error, retrying)
+            if not retrying:
+                raise error
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            continue
+        if metrics is not None:
+            metrics.observe("invoke_latency_ms", latency * 1000)
+        return result
+
+
+async def call_with_retries_async(fn, controller: AdaptiveController = None, acquire=None,
+                                  max_attempts: int = 6, base_delay: float = 0.5, max_delay: float = 20.0,
+                                  metrics=None):
+    """Async version of call_with_retries, `fn` and `acquire` being coroutine functions."""
+    for attempt in range(max_attempts):
+        if controller is not None:
+            await controller.acquire_async()
+        latency, error = None, None
+        try:
+            if acquire is not None:
+                await acquire()
+            start = monotonic()
+            if metrics is not None:
+                metrics.incr("requests")
+            result = await fn()
+            latency = monotonic() - start
+        except Exception as e:
+            error = e
+        finally:
+            # also runs when the task is cancelled, so the slot is never leaked
+            if controller is not None:
+                await controller.release_async(latency=latency, throttled=error is not None and is_throttling_error(error))
+        if error is not None:
+            retrying = is_retryable_error(error) and attempt < max_attempts - 1
+            record_failure(metrics, error, retrying)
+            if not retrying:
+                raise error
+            await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay))
+            continue
+        if metrics is not None:
+            metrics.observe("invoke_latency_ms", latency * 1000)
+        return result
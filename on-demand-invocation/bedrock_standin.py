@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INVOKE_PATH = re.compile(r"^/model/(?P<model_id>[^/]+)/invoke$")
+
+
+class StandInConfig:
+    """
+    Behaviour of the stand-in.
+
+    Latency is log-normal around `latency_ms` (its median) with shape
+    `latency_sigma`, after waiting for one of `capacity` concurrent service
+    slots, so an overloaded stand-in queues like a real endpoint. Requests
+    beyond `max_rps` (0 for no limit), plus a random `throttle_rate` share,
+    get a ThrottlingException; an `error_rate` share fails with `error_code`.
+    """
+
+    def __init__(self, latency_ms: float = 50.0, latency_sigma: float = 0.3, capacity: int = 512,
+                 max_rps: float = 0, throttle_rate: float = 0.0, error_rate: float = 0.0,
+                 error_code: str = "ServiceUnavailableException", seed: int = None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.capacity = capacity
+        self.max_rps = max_rps
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.seed = seed
+
+
+ERROR_STATUS = {
+    "ThrottlingException": 429,
+    "ServiceUnavailableException": 503,
+    "InternalServerException": 500,
+    "ModelTimeoutException": 408,
+    "ValidationException": 400,
+}
+
+
+def fake_embedding(text: str, dimensions: int, normalize: bool = True):
+    """Deterministic pseudo embedding, so identical texts get identical vectors."""
+    rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    if normalize:
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        vector = [v / norm for v in vector]
+    return vector
+
+
+class BedrockStandIn(ThreadingHTTPServer):
+    """
+    Local HTTP server answering bedrock-runtime InvokeModel for embedding models.
+
+    Point a client at it with `endpoint_url`, or with the
+    `AWS_ENDPOINT_URL_BEDROCK_RUNTIME` environment variable for code that
+    builds its own clients. Counters are available from `stats()` and from
+    `GET /stats`.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=("127.0.0.1", 0), config: StandInConfig = None):
+        super().__init__(address, StandInHandler)
+        self.config = config or StandInConfig()
+        self._random = random.Random(self.config.seed)
+        self._slots = threading.BoundedSemaphore(self.config.capacity)
+        self._lock = threading.Lock()
+        self._tokens = self.config.max_rps
+        self._updated = time.monotonic()
+        self._counts = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0}
+        self._latencies = []
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _outcome(self) -> str:
+        """'ok', or the error code to answer with; consumes rate budget."""
+        with self._lock:
+            self._counts["requests"] += 1
+            if self.config.max_rps:
+                now = time.monotonic()
+                self._tokens = min(self.config.max_rps, self._tokens + (now - self._updated) * self.config.max_rps)
+                self._updated = now
+                if self._tokens < 1:
+                    return "ThrottlingException"
+                self._tokens -= 1
+            draw = self._random.random()
+            if draw < self.config.throttle_rate:
+                return "ThrottlingException"
+            if draw < self.config.throttle_rate + self.config.error_rate:
+                return self.config.error_code
+            return "ok"
+
+    def _latency(self) -> float:
+        with self._lock:
+            return self.config.latency_ms / 1000 * math.exp(self._random.gauss(0, self.config.latency_sigma))
+
+    def _record(self, outcome: str, latency: float):
+        with self._lock:
+            if outcome == "ok":
+                self._counts["ok"] += 1
+                self._latencies.append(latency)
+            elif outcome == "ThrottlingException":
+                self._counts["throttled"] += 1
+            else:
+                self._counts["errors"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, service_latencies_ms=[l * 1000 for l in self._latencies])
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real endpoint, so botocore reuses its connections
+    protocol_version = "HTTP/1.1"
+    # buffer the headers and the body into a single send, flushed after each
+    # request; written separately, Nagle and delayed ACKs stall every
+    # keep-alive response by ~40 ms
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def do_POST(self):
+        start = time.monotonic()
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not INVOKE_PATH.match(self.path):
+            self._send_json(404, {"message": f"unknown path {self.path}"})
+            return
+
+        outcome = self.server._outcome()
+        if outcome != "ok":
+            self.server._record(outcome, time.monotonic() - start)
+            self._send_json(ERROR_STATUS.get(outcome, 500), {"message": f"stand-in {outcome}"},
+                            {"x-amzn-ErrorType": outcome})
+            return
+
+        with self.server._slots:
+            time.sleep(self.server._latency())
+        text = request.get("inputText", "")
+        response = {
+            "embedding": fake_embedding(text, int(request.get("dimensions", 1024)), request.get("normalize", True)),
+            # roughly what the Titan tokenizer gives for English text
+            "inputTextTokenCount": max(1, len(text) // 4),
+        }
+        self.server._record(outcome, time.monotonic() - start)
+        self._send_json(200, response)
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Median service latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Log-normal shape of the latency")
+    parser.add_argument("--capacity", type=int, default=512, help="Requests served concurrently, the rest queue")
+    parser.add_argument("--max-rps", type=float, default=0, help="Requests per second before throttling, 0 for no limit")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests throttled at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with --error-code")
+    parser.add_argument("--error-code", choices=sorted(ERROR_STATUS), default="ServiceUnavailableException")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the latency and fault draws")
+
+
+def config_from_args(args) -> StandInConfig:
+    return StandInConfig(args.latency_ms, args.latency_sigma, args.capacity, args.max_rps,
+                         args.throttle_rate, args.error_rate, args.error_code, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for bedrock-runtime InvokeModel")
+    parser.add_argument("--port", type=int, default=8099)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = BedrockStandIn(("127.0.0.1", args.port), config_from_args(args))
+    print(f"Serving on {server.endpoint_url}, export AWS_ENDPOINT_URL_BEDROCK_RUNTIME={server.endpoint_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,215 @@
+"""
+Offline throughput benchmark of the on-demand invokers.
+
+Each mode runs the real command line (embedding_inferencing.py or
+multiprocessor.py) over a synthetic dataset against a local
+`bedrock_standin.BedrockStandIn`, reached through
+AWS_ENDPOINT_URL_BEDROCK_RUNTIME with fake credentials, so no AWS account
+is needed and runs are repeatable. Per mode it reports:
+
+* records/s and requests/s (requests include retried attempts)
+* p50/p95/p99 latency of the InvokeModel calls as seen by the client
+* throttled and failed calls
+* peak RSS of the largest process of the run (main or worker)
+
+Client latencies are collected by a `sitecustomize` hook timing
+`BaseClient._make_api_call` in every process, worker processes included.
+Pass `--min-records-per-second`, `--max-p99-ms` or `--max-rss-mb` to exit
+with 1 when a mode misses its budget, e.g. in CI.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter as time
+
+from bedrock_standin import BedrockStandIn, add_config_arguments, config_from_args
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# mode -> command line, relative to this directory
+MODES = {
+    "async-batch": ["embedding_inferencing.py"],
+    "async-stream": ["embedding_inferencing.py", "--stream"],
+    "multiprocess-batch": ["multiprocessor.py"],
+    "multiprocess-stream": ["multiprocessor.py", "--stream"],
+}
+
+FAKE_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+}
+
+# loaded at startup by every Python process of a run, it appends
+# "<outcome> <latency ms>" for each Bedrock call to a per process file; a
+# streaming response body is read inside the timed call, as InvokeModel
+# returns before its body has arrived
+LATENCY_HOOK = """
+import io
+import os
+from time import perf_counter
+
+import botocore.client
+import botocore.response
+
+_make_api_call = botocore.client.BaseClient._make_api_call
+_files = {}
+
+
+def _record(line):
+    pid = os.getpid()
+    if pid not in _files:
+        path = os.path.join(os.environ['BENCHMARK_LATENCY_DIR'], f'calls-{pid}.log')
+        _files[pid] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.write(_files[pid], line.encode())
+
+
+def _timed_api_call(self, operation_name, api_params):
+    start = perf_counter()
+    outcome = 'ok'
+    try:
+        response = _make_api_call(self, operation_name, api_params)
+        body = response.get('body')
+        if isinstance(body, botocore.response.StreamingBody):
+            data = body.read()
+            response['body'] = botocore.response.StreamingBody(io.BytesIO(data), len(data))
+        return response
+    except botocore.client.ClientError as e:
+        outcome = e.response.get('Error', {}).get('Code', 'Unknown')
+        raise
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        _record(f'{outcome} {(perf_counter() - start) * 1000:.3f}\\n')
+
+
+botocore.client.BaseClient._make_api_call = _timed_api_call
+"""
+
+WORDS = ("embedding vector model token latency throughput region quota batch stream "
+         "record dataset index search query document retrieval semantic similarity cluster").split()
+
+
+def write_dataset(path, records, words_per_record, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(records):
+            text = " ".join(rng.choice(WORDS) for _ in range(max(1, int(rng.gauss(words_per_record, words_per_record / 4)))))
+            f.write(json.dumps({"recordId": f"{i:08d}", "modelInput": {"inputText": text}}) + "\n")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+
+def read_calls(latency_dir):
+    outcomes, latencies = {}, []
+    for path in glob.glob(os.path.join(latency_dir, "calls-*.log")):
+        with open(path) as f:
+            for line in f:
+                outcome, latency_ms = line.split()
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if outcome == 'ok':
+                    latencies.append(float(latency_ms))
+    return outcomes, latencies
+
+
+def run_mode(mode, data_file, records, standin_config, extra_args, work_dir):
+    latency_dir = tempfile.mkdtemp(dir=work_dir)
+    hook_dir = tempfile.mkdtemp(dir=work_dir)
+    with open(os.path.join(hook_dir, "sitecustomize.py"), 'w') as f:
+        f.write(LATENCY_HOOK)
+
+    standin = BedrockStandIn(config=standin_config).start()
+    env = dict(os.environ, **FAKE_ENVIRONMENT)
+    env["AWS_ENDPOINT_URL_BEDROCK_RUNTIME"] = standin.endpoint_url
+    env["BENCHMARK_LATENCY_DIR"] = latency_dir
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [hook_dir, SCRIPT_DIR, env.get("PYTHONPATH")]))
+    command = [sys.executable, *MODES[mode], data_file, "--output", os.path.join(work_dir, f"{mode}.jsonl"), *extra_args]
+
+    start = time()
+    process = subprocess.Popen(command, cwd=SCRIPT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the peak RSS of this run only (the process or its largest worker)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time() - start
+    standin.stop()
+
+    outcomes, latencies = read_calls(latency_dir)
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        print(f"[WARNING] {mode} exited with {exit_code}:\n{stderr.decode(errors='replace')[-2000:]}")
+    return {
+        "exit_code": exit_code,
+        "seconds": elapsed,
+        "records_per_second": records / elapsed,
+        "requests_per_second": sum(outcomes.values()) / elapsed,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "throttled": outcomes.get("ThrottlingException", 0),
+        "failed": sum(count for outcome, count in outcomes.items() if outcome not in ("ok", "ThrottlingException")),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "standin": {key: value for key, value in standin.stats().items() if key != "service_latencies_ms"},
+    }
+
+
+def format_ms(value):
+    return f"{value:.1f}ms" if value is not None else "-"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the on-demand invokers against a local Bedrock stand-in")
+    parser.add_argument("--modes", type=str, default=",".join(MODES), help="Comma separated modes to run")
+    parser.add_argument("--records", type=int, default=2000, help="Synthetic records per run")
+    parser.add_argument("--words-per-record", type=int, default=60, help="Mean words of a synthetic record")
+    parser.add_argument("--rpm", type=int, default=0, help="--rpm passed to the invokers, 0 to rely on the adaptive controller")
+    parser.add_argument("--tpm", type=int, default=0, help="--tpm passed to the invokers")
+    parser.add_argument("--args", type=str, default="", help="Extra arguments for every mode, e.g. '--output-format npy'")
+    add_config_arguments(parser)
+    parser.add_argument("--min-records-per-second", type=float, default=None, help="Fail if a mode is slower")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="Fail if a mode's p99 call latency is higher")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="Fail if a mode's peak RSS is higher")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    extra_args = ["--rpm", str(args.rpm), "--tpm", str(args.tpm), *args.args.split()]
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_file = os.path.join(work_dir, "data.jsonl")
+        write_dataset(data_file, args.records, args.words_per_record)
+        for mode in modes:
+            results[mode] = run_mode(mode, data_file, args.records, config_from_args(args), extra_args, work_dir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<20} {'records/s':>10} {'requests/s':>11} {'p50':>9} {'p95':>9} {'p99':>9} "
+              f"{'throttled':>10} {'failed':>7} {'peak RSS':>10}")
+        for mode, r in results.items():
+            print(f"{mode:<20} {r['records_per_second']:>10.1f} {r['requests_per_second']:>11.1f} "
+                  f"{format_ms(r['p50_ms']):>9} {format_ms(r['p95_ms']):>9} {format_ms(r['p99_ms']):>9} "
+                  f"{r['throttled']:>10} {r['failed']:>7} {r['peak_rss_mb']:>8.1f}MB")
+
+    over_budget = [f"{mode} exited with {r['exit_code']}" for mode, r in results.items() if r["exit_code"] != 0]
+    for mode, r in results.items():
+        if args.min_records_per_second is not None and r["records_per_second"] < args.min_records_per_second:
+            over_budget.append(f"{mode} {r['records_per_second']:.1f} records/s < {args.min_records_per_second}")
+        if args.max_p99_ms is not None and (r["p99_ms"] or 0) > args.max_p99_ms:
+            over_budget.append(f"{mode} p99 {r['p99_ms']:.1f}ms > {args.max_p99_ms}ms")
+        if args.max_rss_mb is not None and r["peak_rss_mb"] > args.max_rss_mb:
+            over_budget.append(f"{mode} peak RSS {r['peak_rss_mb']:.1f}MB > {args.max_rss_mb}MB")
+    if over_budget:
+        print("Over budget: " + ", ".join(over_budget))
+        sys.exit(1)
@@ -0,0 +1,110 @@
+import json
+import os
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from record_io import open_result_writer
+
+
+def journal_path(output_file: str) -> str:
+    return output_file + '.journal'
+
+
+class CompletionJournal:
+    """
+    Append-only log of the recordIds whose results are safely in the output.
+
+    The journal is only ever appended after the output has been flushed, so
+    its length is the number of output rows that can be trusted on restart.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.resume = resume
+        self.completed = set()
+        self.rows = 0
+        self._f = None
+
+    def __enter__(self):
+        if self.resume and os.path.exists(self.path):
+            committed_size = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    # a trailing partial line was never committed
+                    if not line.endswith(b'\n'):
+                        break
+                    self.completed.add(json.loads(line))
+                    self.rows += 1
+                    committed_size += len(line)
+            with open(self.path, 'r+b') as f:
+                f.truncate(committed_size)
+            self._f = open(self.path, 'a')
+        else:
+            self._f = open(self.path, 'w')
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+    def record(self, record_ids: Iterable):
+        for record_id in record_ids:
+            self._f.write(json.dumps(record_id) + '\n')
+            self.rows += 1
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def pending(self, records: Iterable[dict]) -> Iterator[dict]:
+        """Skip the records completed by a previous run."""
+        for record in records:
+            if record['recordId'] not in self.completed:
+                yield record
+
+
+class CheckpointedWriter:
+    """
+    Result writer wrapper that journals recordIds as results land.
+
+    Ids are buffered and only journaled after the wrapped writer has flushed
+    the matching rows, so the journal never runs ahead of the output.
+    """
+
+    def __init__(self, writer, journal: CompletionJournal, commit_every: int = 100):
+        self.writer = writer
+        self.journal = journal
+        self.commit_every = commit_every
+        self._uncommitted = []
+
+    @property
+    def count(self) -> int:
+        return self.writer.count
+
+    def write(self, record_id, input_text, embeddings):
+        self.writer.write(record_id, input_text, embeddings)
+        self._uncommitted.append(record_id)
+        if len(self._uncommitted) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.writer.flush()
+        self.journal.record(self._uncommitted)
+        self._uncommitted = []
+
+
+@contextmanager
+def checkpointed_writer(output_file: str, output_format: str = 'jsonl', include_text: bool = False,
+                        resume: bool = False):
+    """
+    Open a result writer journaled to `<output_file>.journal`.
+
+    With `resume`, the output is cut back to the rows recorded in the journal
+    and appended to; use `journal.pending()` to skip the completed records.
+    Yields `(writer, journal)`.
+    """
+    with CompletionJournal(journal_path(output_file), resume=resume) as journal:
+        with open_result_writer(output_file, output_format, include_text, resume_rows=journal.rows) as writer:
+            checkpointed = CheckpointedWriter(writer, journal)
+            try:
+                yield checkpointed, journal
+            finally:
+                # also runs on Ctrl-C, so everything written so far is kept
+                checkpointed.commit()
@@ -0,0 +1,162 @@
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+# Titan Text Embeddings V2 takes up to 8,192 tokens (50,000 characters); at
+# the worst case of about 2.5 characters per token that is 20,000 characters
+MAX_CHUNK_CHARS = 20000
+CHUNK_OVERLAP_CHARS = 1000
+POOLING_METHODS = ("mean", "weighted")
+# completed records pooled together in one batch of NumPy operations
+POOL_BATCH_SIZE = 256
+
+# joins "<recordId>", chunk index, chunk count and start offset into the
+# recordId of a chunk, so chunks pass through the invokers like any record
+CHUNK_SEPARATOR = "\x1f"
+
+
+def split_text(text: str, max_chars: int = MAX_CHUNK_CHARS, overlap: int = CHUNK_OVERLAP_CHARS) -> List[Tuple[int, str]]:
+    """
+    Split `text` into `(start, chunk)` pieces of at most `max_chars` characters,
+    each repeating the last ~`overlap` characters of the previous one. Cuts are
+    moved back to the nearest whitespace when there is one in the second half
+    of the chunk, so words aren't split.
+    """
+    if len(text) <= max_chars:
+        return [(0, text)]
+    if not 0 <= overlap < max_chars // 2:
+        raise ValueError(f"overlap must be between 0 and half of max_chars, got {overlap}")
+    chunks = []
+    start = 0
+    while True:
+        end = min(start + max_chars, len(text))
+        if end < len(text):
+            cut = max(text.rfind(" ", start + max_chars // 2, end), text.rfind("\n", start + max_chars // 2, end))
+            if cut > start:
+                end = cut + 1
+        chunks.append((start, text[start:end]))
+        if end == len(text):
+            return chunks
+        start = end - overlap
+
+
+def chunk_records(records: Iterable[dict], max_chars: int = MAX_CHUNK_CHARS,
+                  overlap: int = CHUNK_OVERLAP_CHARS) -> Iterator[dict]:
+    """Pass records through lazily, replacing those over `max_chars` by their chunks."""
+    for record in records:
+        text = record['modelInput.inputText']
+        if len(text) <= max_chars:
+            yield record
+            continue
+        chunks = split_text(text, max_chars, overlap)
+        for index, (start, chunk) in enumerate(chunks):
+            yield dict(record, **{
+                "recordId": CHUNK_SEPARATOR.join([record["recordId"], str(index), str(len(chunks)), str(start)]),
+                "modelInput.inputText": chunk,
+            })
+
+
+def parse_chunk_id(record_id: str):
+    """`(recordId, index, count, start)` of a chunk's recordId, or None for a whole record."""
+    if CHUNK_SEPARATOR not in record_id:
+        return None
+    parent, index, count, start = record_id.rsplit(CHUNK_SEPARATOR, 3)
+    return parent, int(index), int(count), int(start)
+
+
+def pool_embeddings(vectors: np.ndarray, offsets: np.ndarray, weights: np.ndarray = None,
+                    normalize: bool = True) -> np.ndarray:
+    """
+    Pool consecutive groups of rows of `vectors` into one row each.
+
+    Group `i` spans rows `offsets[i]` to `offsets[i + 1]`. Rows are averaged,
+    weighted by `weights` when given, and the result L2 re-normalized. Every
+    group is pooled by the same few array operations, however many there are.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if weights is None:
+        pooled = np.add.reduceat(vectors, offsets, axis=0)
+        pooled /= np.diff(offsets, append=len(vectors))[:, None]
+    else:
+        weights = np.asarray(weights, dtype=np.float32)
+        pooled = np.add.reduceat(vectors * weights[:, None], offsets, axis=0)
+        pooled /= np.add.reduceat(weights, offsets)[:, None]
+    if normalize:
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        pooled /= np.where(norms == 0, 1, norms)
+    return pooled
+
+
+class ChunkPooler:
+    """
+    Result writer that reassembles chunked records in front of another writer.
+
+    Whole records are written through straight away. Chunk results are held
+    until every chunk of their record has arrived, then pooled into one
+    vector per recordId, `POOL_BATCH_SIZE` records at a time, and written with
+    the original text rebuilt from the chunks. Use it as a context manager,
+    or call `flush()` once the invoker is done.
+    """
+
+    def __init__(self, writer, method: str = "mean", normalize: bool = True, batch_size: int = POOL_BATCH_SIZE):
+        if method not in POOLING_METHODS:
+            raise ValueError(f"Unknown pooling method {method}, expected one of {POOLING_METHODS}")
+        self.writer = writer
+        self.method = method
+        self.normalize = normalize
+        self.batch_size = batch_size
+        # recordId -> {index: (start, text, embeddings)} of records still missing chunks
+        self._partial = {}
+        self._complete = []
+
+    @property
+    def count(self) -> int:
+        return self.writer.count
+
+    @property
+    def partial(self) -> int:
+        """Records with some, but not all, of their chunks embedded."""
+        return len(self._partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, record_id, input_text, embeddings):
+        chunk = parse_chunk_id(record_id)
+        if chunk is None:
+            self.writer.write(record_id, input_text, embeddings)
+            return
+        parent, index, count, start = chunk
+        chunks = self._partial.setdefault(parent, {})
+        chunks[index] = (start, input_text, embeddings)
+        if len(chunks) == count:
+            del self._partial[parent]
+            self._complete.append((parent, [chunks[i] for i in range(count)]))
+            if len(self._complete) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Pool and write the records whose chunks are all in."""
+        if not self._complete:
+            return
+        complete, self._complete = self._complete, []
+        sizes = np.array([len(chunks) for _, chunks in complete])
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        vectors = np.array([embeddings for _, chunks in complete for _, _, embeddings in chunks], dtype=np.float32)
+        weights = None
+        if self.method == "weighted":
+            weights = np.array([len(text) for _, chunks in complete for _, text, _ in chunks], dtype=np.float32)
+        pooled = pool_embeddings(vectors, offsets, weights, self.normalize)
+        for (parent, chunks), vector in zip(complete, pooled):
+            self.writer.write(parent, join_chunks(chunks), vector.tolist())
+
+
+def join_chunks(chunks) -> str:
+    """The original text of ordered `(start, text, ...)` chunks, dropping the overlaps."""
+    text = ""
+    for start, chunk, *_ in chunks:
+        text += chunk[len(text) - start:]
+    return text
@@ -0,0 +1,91 @@
+import multiprocessing
+import random
+from typing import Callable, List, NamedTuple, Optional
+
+import boto3
+from botocore.config import Config
+
+from adaptive_control import NO_SDK_RETRIES
+
+
+class Target(NamedTuple):
+    """A region and the model id or inference profile to call there."""
+    region: Optional[str]
+    model_id: str
+    weight: float = 1.0
+
+
+def parse_targets(spec: str, default_model_id: str) -> List[Target]:
+    """
+    Parse a comma separated `REGION[=MODEL_ID][*WEIGHT]` list, e.g.
+    `us-east-1,us-west-2=us.amazon.titan-embed-text-v2:0*2`.
+    """
+    targets = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        weight = 1.0
+        if '*' in entry:
+            entry, weight = entry.rsplit('*', 1)
+            weight = float(weight)
+        region, _, model_id = entry.partition('=')
+        targets.append(Target(region or None, model_id or default_model_id, weight))
+    return targets
+
+
+class ClientPool:
+    """
+    Bedrock runtime clients spread over several regions or model ids.
+
+    Each target has its own botocore connection pool and its own rate budget
+    (built by `limiter_factory(weight)`, e.g. a DualRateLimiter scaled by the
+    target weight). `checkout()` routes a call to the target with the fewest
+    calls in flight relative to its weight. In-flight counts live in shared
+    memory, so the pool can be handed to worker processes; clients are not
+    pickled and each process builds its own with `connect()`.
+    """
+
+    def __init__(self, targets: List[Target], limiter_factory: Callable = None,
+                 max_pool_connections: int = 10):
+        if not targets:
+            raise ValueError("ClientPool needs at least one target")
+        self.targets = targets
+        self.max_pool_connections = max_pool_connections
+        self.limiters = [limiter_factory(t.weight) if limiter_factory else None for t in targets]
+        self._in_flight = multiprocessing.Array('i', len(targets))
+        self._clients = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_clients'] = None
+        return state
+
+    def connect(self):
+        self._clients = [
+            boto3.client(
+                'bedrock-runtime',
+                config=Config(region_name=t.region, max_pool_connections=self.max_pool_connections).merge(NO_SDK_RETRIES)
+            )
+            for t in self.targets
+        ]
+        return self
+
+    def client(self, index: int):
+        if self._clients is None:
+            self.connect()
+        return self._clients[index]
+
+    def checkout(self) -> int:
+        """Pick the least loaded target, weighted, and count a call against it."""
+        with self._in_flight.get_lock():
+            # random starting point so ties don't always go to the first target
+            offset = random.randrange(len(self.targets))
+            order = [(offset + i) % len(self.targets) for i in range(len(self.targets))]
+            index = min(order, key=lambda i: self._in_flight[i] / self.targets[i].weight)
+            self._in_flight[index] += 1
+        return index
+
+    def checkin(self, index: int):
+        with self._in_flight.get_lock():
+            self._in_flight[index] -= 1
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import sqlite3
+from array import array
+from contextlib import contextmanager
+from time import time
+from typing import List, Optional
+
+
+def cache_key(model_id: str, dimensions: int, normalize: bool, input_text: str) -> str:
+    """Content address of an embedding request."""
+    payload = json.dumps([model_id, dimensions, normalize, input_text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# layout of the stored vectors; files written with another one are emptied
+SCHEMA_VERSION = 2  # float32 vectors
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache backed by a local SQLite file.
+
+    Entries are keyed by `cache_key()` and evicted least recently used first
+    once the stored vectors exceed `max_bytes`. SQLite handles locking, so
+    every worker process can open its own `EmbeddingCache` on the same file.
+
+    Vectors are stored as float32, the precision the model returns. New
+    entries and access times are buffered and written in one transaction
+    every `flush_every` changes or `flush_seconds`, and on `close()`, so a
+    hit or a miss doesn't commit on its own. The access time of an entry is
+    only refreshed once it is `touch_seconds` old, which is all LRU needs.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30, evict_every: int = 1000, flush_every: int = 256,
+                 flush_seconds: float = 5.0, touch_seconds: float = 60.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.touch_seconds = touch_seconds
+        self._puts = 0
+        # key -> (float32 bytes, time) not written yet, and key -> access time to record
+        self._pending = {}
+        self._touched = {}
+        self._flushed_at = time()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # one transaction, so workers opening the file together agree on its layout
+        with self._transaction():
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS embeddings")
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " vector BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def get(self, key: str) -> Optional[List[float]]:
+        pending = self._pending.get(key)
+        if pending is not None:
+            return array('f', pending[0]).tolist()
+        row = self._conn.execute("SELECT vector, last_access FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._maybe_flush()
+            return None
+        now = time()
+        if now - row[1] >= self.touch_seconds:
+            self._touched[key] = now
+        self._maybe_flush()
+        return array('f', row[0]).tolist()
+
+    def put(self, key: str, embedding: List[float]):
+        self._pending[key] = (array('f', embedding).tobytes(), time())
+        self._touched.pop(key, None)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        buffered = len(self._pending) + len(self._touched)
+        if buffered >= self.flush_every or (buffered and time() - self._flushed_at >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entries and access times in a single transaction."""
+        self._flushed_at = time()
+        if not self._pending and not self._touched:
+            return
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                [(key, vector, len(vector), at) for key, (vector, at) in self._pending.items()]
+            )
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(at, key) for key, at in self._touched.items()]
+            )
+        puts = self._puts + len(self._pending)
+        self._pending.clear()
+        self._touched.clear()
+        if puts // self.evict_every > self._puts // self.evict_every:
+            self.evict()
+        self._puts = puts
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits in `max_bytes`."""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_access"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        with self._transaction():
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", stale)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -2,79 +2,307 @@ import asyncio
 import os
 import sys
 import argparse
-import pandas as pd
 import json
 from time import perf_counter as time
-from pyrate_limiter import Duration, Limiter, Rate
-from pyrate_limiter.buckets.in_memory_bucket import InMemoryBucket
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 
-rates = [Rate(1900, Duration.MINUTE)]
-# basic_bucket = InMemoryBucket(rates)
+from embedding_cache import EmbeddingCache, cache_key
+from adaptive_control import AdaptiveController, call_with_retries_async
+from client_pool import ClientPool, Target, parse_targets
+from rate_limiting import AsyncRateLimiter, DualRateLimiter
+from checkpoint import checkpointed_writer
+from record_io import read_records, read_dataframe, dataframe_records, OUTPUT_FORMATS, ListResultWriter
+from chunking import chunk_records, ChunkPooler, MAX_CHUNK_CHARS, CHUNK_OVERLAP_CHARS, POOLING_METHODS
+from metrics import Metrics, MetricsReporter, METRICS_FORMATS
 
-limiter = Limiter(rates, max_delay=1000*60*60)
+RATE_LIMIT_CALLS = 1900  # calls
+RATE_LIMIT_TOKENS = 300000  # input tokens, check the account quota for the model
+RATE_LIMIT_PERIOD = 60  # seconds
 
-bedrock_runtime = boto3.client('bedrock-runtime')
+# max number of requests kept open at once, bounded by the executor threads
+# and the botocore connection pool. The adaptive controller starts from
+# INITIAL_IN_FLIGHT and moves between 1 and this cap from throttling feedback.
+MAX_IN_FLIGHT = 256
+INITIAL_IN_FLIGHT = 32
 
 MODEL_ID = 'amazon.titan-embed-text-v2:0'
 DIMENSIONS = 256
+NORMALIZE = True
 
-async def limited_function(row, start_time):
-    limiter.try_acquire(row['recordId'])
+def make_limiter_factory(rpm, tpm):
+    """Per-target request and token ceilings, scaled by the target weight; 0 disables one."""
+    def factory(weight):
+        return DualRateLimiter(
+            AsyncRateLimiter(rpm * weight, RATE_LIMIT_PERIOD) if rpm > 0 else None,
+            AsyncRateLimiter(tpm * weight, RATE_LIMIT_PERIOD) if tpm > 0 else None
+        )
+    return factory
 
+# one target per region / model id, each with its own connection pool and rate
+# budget on top of the adaptive controller, built from the arguments in
+# __main__. Clients don't retry on their own, so throttles reach the controller.
+client_pool = None
+
+# optional persistent EmbeddingCache, and the requests currently in flight
+# keyed by cache_key() so identical texts share a single call
+cache = None
+in_flight = {}
+metrics = Metrics()
+
+def invoke_model(target_index, input_text):
+    """Blocking Bedrock call, executed on the executor threads."""
     sample_input = {
-        "inputText": row['modelInput.inputText'],
+        "inputText": input_text,
         "dimensions": DIMENSIONS,
+        "normalize": NORMALIZE,
     }
     body = json.dumps(sample_input)
-    response = bedrock_runtime.invoke_model(
-        modelId=MODEL_ID,
+    response = client_pool.client(target_index).invoke_model(
+        modelId=client_pool.targets[target_index].model_id,
         body=body,
         accept='application/json',
         contentType='application/json'
     )
 
     response_body = json.loads(response.get('body').read())
-    embeddings = response_body['embedding']    
-    print(f"t + {time() - start_time:.5f}")
+    return response_body['embedding'], response_body.get('inputTextTokenCount')
+
+async def invoke_with_budget(input_text, controller):
+    """
+    Call Bedrock with retries, settling the token budget against the real token count.
+
+    Every attempt is routed to the least loaded target of the client pool, so a
+    retry after a throttle can land on another region.
+    """
+    loop = asyncio.get_running_loop()
+    attempt = {}
+
+    async def acquire():
+        index = client_pool.checkout()
+        attempt['index'] = index
+        limiter = client_pool.limiters[index]
+        try:
+            attempt['reserved'] = await limiter.acquire_async(input_text) if limiter is not None else 0.0
+        except BaseException:
+            client_pool.checkin(index)
+            raise
+
+    async def call():
+        index = attempt['index']
+        try:
+            return await loop.run_in_executor(None, invoke_model, index, input_text)
+        except Exception:
+            # settle the failed attempt on its own target before a retry moves on
+            limiter = client_pool.limiters[index]
+            if limiter is not None:
+                limiter.refund(attempt['reserved'])
+            raise
+        finally:
+            client_pool.checkin(index)
+
+    embeddings, token_count = await call_with_retries_async(call, controller=controller, acquire=acquire,
+                                                            metrics=metrics)
+    metrics.incr("input_tokens", token_count or 0)
+    limiter = client_pool.limiters[attempt['index']]
+    if limiter is not None:
+        limiter.settle(input_text, attempt['reserved'], token_count)
+    return embeddings
+
+async def embed_text(input_text, controller):
+    """Embed a text via the cache, an identical in-flight request, or Bedrock."""
+    key = cache_key(MODEL_ID, DIMENSIONS, NORMALIZE, input_text)
+    if cache is not None:
+        embeddings = cache.get(key)
+        if embeddings is not None:
+            metrics.incr("cache_hits")
+            return embeddings
+
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(invoke_with_budget(input_text, controller))
+        in_flight[key] = task
+
+        def on_done(t):
+            del in_flight[key]
+            if cache is not None and not t.cancelled() and t.exception() is None:
+                cache.put(key, t.result())
+        task.add_done_callback(on_done)
+    else:
+        metrics.incr("deduplicated")
+
+    # shield so one waiter being cancelled doesn't cancel the shared request
+    return await asyncio.shield(task)
+
+async def limited_function(row, controller):
+    start = time()
+    embeddings = await embed_text(row['modelInput.inputText'], controller)
+    metrics.incr("records")
+    metrics.observe("record_latency_ms", (time() - start) * 1000)
     return row["recordId"], embeddings
 
-async def invoke_model_with_ratelimit(df):
+def report_controller(controller):
+    """Sample the concurrency state every time the metrics are reported."""
+    metrics.gauge("in_flight", lambda: controller.in_flight)
+    metrics.gauge("concurrency_limit", lambda: controller.limit)
+    # distinct texts waiting for a slot or in flight
+    metrics.gauge("open_requests", lambda: len(in_flight))
+
+async def invoke_model_with_ratelimit(df, max_in_flight=MAX_IN_FLIGHT, max_chunk_chars=MAX_CHUNK_CHARS,
+                                      chunk_overlap=CHUNK_OVERLAP_CHARS, pooling="mean"):
+    # run the blocking boto3 calls on a pool sized to the in-flight cap, so the
+    # event loop stays free to keep `max_in_flight` requests open at once.
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_in_flight))
+    controller = AdaptiveController(min(INITIAL_IN_FLIGHT, max_in_flight), max_limit=max_in_flight)
+    report_controller(controller)
+
     start_time = time()
-    tasks = [asyncio.create_task(limited_function(row, start_time)) for _, row in df.iterrows()]
+    records = dataframe_records(df)
+    if max_chunk_chars:
+        records = chunk_records(records, max_chunk_chars, chunk_overlap)
+    tasks = [(row, asyncio.create_task(limited_function(row, controller))) for row in records]
 
     # wait for all tasks to complete
-    await asyncio.wait(tasks)
+    await asyncio.wait([t for _, t in tasks])
 
     # Check status of each task
-    completed = sum(1 for t in tasks if t.done() and not t.exception())
-    errors = sum(1 for t in tasks if t.done() and t.exception())
+    completed = sum(1 for _, t in tasks if t.done() and not t.exception())
+    errors = sum(1 for _, t in tasks if t.done() and t.exception())
     
     print(f"Completed: {completed}, Errors: {errors}")    
-    print(f"Ran {len(df)} requests in {time() - start_time:.5f} seconds")
+    print(f"Ran {len(tasks)} requests in {time() - start_time:.5f} seconds")
+    print(f"Final concurrency limit: {controller.limit:.1f}")
 
-    results = [t.result()[0] for t in tasks if t.done() and not t.exception()]
+    # chunks of long texts are pooled back into one result per record
+    collected = ListResultWriter()
+    with ChunkPooler(collected, pooling, NORMALIZE) as pooler:
+        for row, t in tasks:
+            if t.done() and not t.exception():
+                record_id, embeddings = t.result()
+                pooler.write(record_id, row['modelInput.inputText'], embeddings)
+    results = [record_id for record_id, _, _ in collected.results]
     print(results)
 
+async def invoke_model_streaming(records, writer, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Pull records lazily from `records` and write each result as it completes.
+
+    Only `max_in_flight` workers exist at any time, so memory stays flat no
+    matter how large the input is.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_in_flight))
+    controller = AdaptiveController(min(INITIAL_IN_FLIGHT, max_in_flight), max_limit=max_in_flight)
+    report_controller(controller)
+
+    start_time = time()
+    completed = 0
+    errors = 0
+
+    async def worker():
+        nonlocal completed, errors
+        for row in records:
+            try:
+                record_id, embeddings = await limited_function(row, controller)
+            except Exception as e:
+                print(f"Error processing record {row['recordId']}: {str(e)}")
+                errors += 1
+                continue
+            writer.write(record_id, row['modelInput.inputText'], embeddings)
+            completed += 1
+
+    await asyncio.gather(*(worker() for _ in range(max_in_flight)))
+
+    print(f"Completed: {completed}, Errors: {errors}")
+    print(f"Ran {completed + errors} requests in {time() - start_time:.5f} seconds")
+    print(f"Final concurrency limit: {controller.limit:.1f}")
+
 
 if __name__ == "__main__":
     # validate the input argument must be an existing file
     # use argparse to get the input argument
     parser = argparse.ArgumentParser()
-    parser.add_argument("data_file", type=str, help="The input file to process")
+    parser.add_argument("data_file", type=str, help="The JSONL or Parquet file to process")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help="Max number of concurrent Bedrock requests")
+    parser.add_argument("--rpm", type=int, default=RATE_LIMIT_CALLS,
+                        help="Requests per minute ceiling per target, 0 to let the adaptive controller find the rate")
+    parser.add_argument("--tpm", type=int, default=RATE_LIMIT_TOKENS,
+                        help="Input tokens per minute ceiling per target, 0 to disable")
+    parser.add_argument("--targets", type=str, default=None,
+                        help="Comma separated REGION[=MODEL_ID][*WEIGHT] list to spread requests over, "
+                             "e.g. us-east-1,us-west-2. Defaults to the configured region")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the input lazily and write results to --output as they complete")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue a previous --stream run, skipping the records in <output>.journal (implies --stream)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="The output file used in --stream mode, ./output.<format> by default")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="jsonl",
+                        help="jsonl, or npy for a float32 matrix plus a <output>.index.jsonl recordId index")
+    parser.add_argument("--include-text", action="store_true",
+                        help="Keep the input text in the npy index (always kept in jsonl)")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path of a persistent embedding cache (SQLite), disabled by default")
+    parser.add_argument("--cache-max-mb", type=int, default=1024,
+                        help="Size of the embedding cache before LRU eviction")
+    parser.add_argument("--max-chunk-chars", type=int, default=MAX_CHUNK_CHARS,
+                        help="Split longer texts into overlapping chunks and pool their embeddings, 0 to disable")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP_CHARS,
+                        help="Characters repeated at the start of each chunk from the previous one")
+    parser.add_argument("--pooling", choices=POOLING_METHODS, default="mean",
+                        help="mean of the chunk embeddings, or weighted by chunk length")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="File to append metrics to every --metrics-interval seconds, - for stdout")
+    parser.add_argument("--metrics-format", choices=METRICS_FORMATS, default="jsonl",
+                        help="jsonl, or emf for CloudWatch Embedded Metric Format")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="Seconds between two metrics reports")
     args = parser.parse_args()
     if not os.path.exists(args.data_file):
         print(f"Error: {args.data_file} is not an existing file")
         sys.exit(1)
+    if args.output is None:
+        args.output = f"./output.{args.output_format}"
+
+    targets = parse_targets(args.targets, MODEL_ID) if args.targets else [Target(None, MODEL_ID)]
+    client_pool = ClientPool(
+        targets,
+        make_limiter_factory(args.rpm, args.tpm),
+        max_pool_connections=args.max_in_flight
+    ).connect()
+    if args.cache:
+        cache = EmbeddingCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024)
+    reporter = MetricsReporter(metrics, args.metrics, args.metrics_format, args.metrics_interval,
+                               {"Invoker": "embedding_inferencing"}).start()
+
+    if args.stream or args.resume:
+        # results are journaled as they land, so a crash or Ctrl-C can be resumed
+        with checkpointed_writer(args.output, args.output_format, args.include_text,
+                                 resume=args.resume) as (writer, journal):
+            if journal.rows:
+                print(f"Resuming, skipping {journal.rows} completed records")
+            records = journal.pending(read_records(args.data_file))
+            if args.max_chunk_chars:
+                records = chunk_records(records, args.max_chunk_chars, args.chunk_overlap)
+            # chunks are pooled before the journal sees them, so a record
+            # is only checkpointed once all its chunks are embedded
+            with ChunkPooler(writer, args.pooling, NORMALIZE) as pooler:
+                asyncio.run(invoke_model_streaming(records, pooler, max_in_flight=args.max_in_flight))
+            if pooler.partial:
+                print(f"[WARNING] {pooler.partial} chunked records are missing chunks and were not written")
+        if cache is not None:
+            cache.close()
+        reporter.close()
+        sys.exit(0)
     
     # read the data file
-    data = []
-    with open(args.data_file) as f:
-        for line in f:
-            data.append(json.loads(line))
-    df = pd.json_normalize(data, max_level=1)
-    df = df.reset_index(drop=True)
+    df = read_dataframe(args.data_file)
     print(df.head())
     print(df.columns)
     
-    asyncio.run(invoke_model_with_ratelimit(df))
\ No newline at end of file
+    asyncio.run(invoke_model_with_ratelimit(df, max_in_flight=args.max_in_flight, max_chunk_chars=args.max_chunk_chars,
+                                            chunk_overlap=args.chunk_overlap, pooling=args.pooling))
+    if cache is not None:
+        cache.close()
+    reporter.close()
@@ -0,0 +1,344 @@
+"""
+Route an embedding workload to on-demand invocation, batch inference, or both.
+
+Given an input file and a deadline, estimates when the records would be
+embedded on each path:
+
+* on-demand: requests and tokens of the input, chunking included, against
+  the account's requests and tokens per minute, less what the model was
+  used for over the last minutes (CloudWatch `AWS/Bedrock` metrics)
+* batch: the jobs queued and running in the batch registry table, played
+  through the job slots with the median duration of recent jobs
+
+then picks the cheapest split of the records that meets the deadline, the
+fastest one if none does. The first records of the file go on-demand
+through multiprocessor.py --stream, the rest are registered as batches by
+the batch-inference ingestion tool; both run at the same time.
+"""
+import argparse
+import heapq
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+from chunking import split_text, MAX_CHUNK_CHARS, CHUNK_OVERLAP_CHARS
+from multiprocessor import RATE_LIMIT_CALLS, RATE_LIMIT_TOKENS, MODEL_ID
+from record_io import read_records
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARD_AND_REGISTER = os.path.join(SCRIPT_DIR, "..", "batch-inference", "ingestion", "shard_and_register.py")
+
+# initial estimate of the rate limiters
+CHARS_PER_TOKEN = 4.0
+# on-demand usage of the model by others is averaged over this window
+USAGE_WINDOW_MINUTES = 15
+
+# batch inference limits and defaults, must match the ingestion tool and the stack
+MAX_RECORDS_PER_JOB = 50000
+MIN_RECORDS_PER_JOB = 100
+MAX_CONCURRENT_JOBS = 20
+STATUS_SHARDS = 10
+STATUS_SHARD_INDEX = "status-shard-index"
+OWNERS_ID = "__owners__"
+SLOT_LEDGER_ID = "__active_slots__"
+QUEUED_STATUSES = ("Pending", "Claimed")
+FINISHED_STATUSES = ("Completed", "PartiallyCompleted")
+# most recently finished jobs the job duration is learned from
+HISTORY_JOBS = 50
+# job duration when no job finished yet
+DEFAULT_JOB_SECONDS = 24 * 3600
+
+# Titan Text Embeddings V2, check the current pricing; only their ratio matters to the choice
+ON_DEMAND_PRICE_PER_1K_TOKENS = 0.00002
+BATCH_PRICE_PER_1K_TOKENS = 0.00001
+# fractions of the records tried for the on-demand part
+SPLIT_STEPS = 100
+
+
+def get_stack_output(stack_name, output_key):
+    response = boto3.client("cloudformation").describe_stacks(StackName=stack_name)
+    for output in response["Stacks"][0]["Outputs"]:
+        if output["OutputKey"] == output_key:
+            return output["OutputValue"]
+    return None
+
+
+def parse_deadline(value: str, now: datetime) -> float:
+    """Seconds from `now` to a deadline given as a duration (`90m`, `6h`, `2d`) or an ISO 8601 time."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1:] in units and value[:-1].replace(".", "", 1).isdigit():
+        return float(value[:-1]) * units[value[-1]]
+    deadline = datetime.fromisoformat(value)
+    if deadline.tzinfo is None:
+        deadline = deadline.astimezone()
+    return (deadline - now).total_seconds()
+
+
+def profile_workload(data_file: str, max_chunk_chars: int = MAX_CHUNK_CHARS, chunk_overlap: int = CHUNK_OVERLAP_CHARS) -> dict:
+    """Records, InvokeModel requests (one per chunk) and estimated input tokens of the input file."""
+    records, requests, chars = 0, 0, 0
+    for record in read_records(data_file):
+        text = record["modelInput.inputText"]
+        records += 1
+        chars += len(text)
+        if max_chunk_chars and len(text) > max_chunk_chars:
+            requests += len(split_text(text, max_chunk_chars, chunk_overlap))
+        else:
+            requests += 1
+    return {"records": records, "requests": requests, "tokens": chars / CHARS_PER_TOKEN}
+
+
+def on_demand_usage(model_id: str, minutes: int = USAGE_WINDOW_MINUTES) -> tuple:
+    """Average requests and input tokens per minute sent to `model_id` over the last `minutes`."""
+    cloudwatch = boto3.client("cloudwatch")
+    end = datetime.now(timezone.utc)
+    usage = []
+    for metric in ("Invocations", "InputTokenCount"):
+        datapoints = cloudwatch.get_metric_statistics(
+            Namespace="AWS/Bedrock",
+            MetricName=metric,
+            Dimensions=[{"Name": "ModelId", "Value": model_id}],
+            StartTime=end - timedelta(minutes=minutes),
+            EndTime=end,
+            Period=60,
+            Statistics=["Sum"],
+        )["Datapoints"]
+        usage.append(sum(point["Sum"] for point in datapoints) / minutes)
+    return tuple(usage)
+
+
+def on_demand_seconds(requests: float, tokens: float, rpm: float = None, tpm: float = None) -> float:
+    """Time to send `requests` and `tokens` at the given per minute budgets, None meaning unlimited."""
+    if not requests:
+        return 0.0
+    minutes = 0.0
+    for amount, budget in ((requests, rpm), (tokens, tpm)):
+        if budget is not None:
+            minutes = max(minutes, amount / budget if budget > 0 else math.inf)
+    return minutes * 60
+
+
+def budget_argument(budget: float = None) -> str:
+    """A per minute budget of the plan as a multiprocessor.py argument, where 0 disables the limit."""
+    return "0" if budget is None else str(max(int(budget), 1))
+
+
+def batch_backlog(table_name: str) -> tuple:
+    """`(active jobs, queued jobs)` of the batch registry, every owner included."""
+    table = boto3.resource("dynamodb").Table(table_name)
+    owners = set(table.get_item(Key={"id": OWNERS_ID}).get("Item", {}).get("owners", set())) | {"default"}
+    active = int(table.get_item(Key={"id": SLOT_LEDGER_ID}).get("Item", {}).get("active_jobs", 0))
+    queued = 0
+    for owner in owners:
+        for status in QUEUED_STATUSES:
+            for n in range(STATUS_SHARDS):
+                kwargs = {
+                    "IndexName": STATUS_SHARD_INDEX,
+                    "KeyConditionExpression": Key("status_shard").eq(f"{status}#{owner}#{n}"),
+                    "Select": "COUNT",
+                }
+                while True:
+                    response = table.query(**kwargs)
+                    queued += response["Count"]
+                    if "LastEvaluatedKey" not in response:
+                        break
+                    kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return active, queued
+
+
+def job_durations(table_name: str) -> list:
+    """
+    Seconds from submission to the terminal status of the HISTORY_JOBS most
+    recently finished jobs, latest first.
+
+    The status shards are ordered by queue position, not completion, so the
+    ids of every finished job are read, then their timestamps, and the jobs
+    are ordered by `updated_at`, when the monitor recorded their status.
+    """
+    dynamodb = boto3.resource("dynamodb")
+    table = dynamodb.Table(table_name)
+    owners = set(table.get_item(Key={"id": OWNERS_ID}).get("Item", {}).get("owners", set())) | {"default"}
+    ids = []
+    for owner in owners:
+        for status in FINISHED_STATUSES:
+            for n in range(STATUS_SHARDS):
+                kwargs = {
+                    "IndexName": STATUS_SHARD_INDEX,
+                    "KeyConditionExpression": Key("status_shard").eq(f"{status}#{owner}#{n}"),
+                    "ProjectionExpression": "id",
+                }
+                while True:
+                    response = table.query(**kwargs)
+                    ids.extend(item["id"] for item in response["Items"])
+                    if "LastEvaluatedKey" not in response:
+                        break
+                    kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    finished = []
+    for i in range(0, len(ids), 100):
+        request = {table_name: {"Keys": [{"id": id_} for id_ in ids[i:i + 100]],
+                                "ProjectionExpression": "created_dt, updated_at"}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(table_name, []):
+                if "created_dt" in item and "updated_at" in item:
+                    finished_at = datetime.fromisoformat(item["updated_at"])
+                    finished.append((finished_at, (finished_at - datetime.fromisoformat(item["created_dt"])).total_seconds()))
+            request = response.get("UnprocessedKeys")
+    finished.sort(key=lambda job: job[0], reverse=True)
+    return [duration for _, duration in finished[:HISTORY_JOBS]]
+
+
+def batch_seconds(records: int, active: int, queued: int, slots: int, job_seconds: float) -> float:
+    """
+    Time until the last of the jobs of `records` finishes, queued behind the
+    backlog: running jobs are taken to be halfway through, and every job
+    starts on the first free slot and takes `job_seconds`.
+    """
+    if not records:
+        return 0.0
+    free_at = [job_seconds / 2] * min(active, slots) + [0.0] * max(slots - active, 0)
+    heapq.heapify(free_at)
+    for _ in range(queued):
+        heapq.heappush(free_at, heapq.heappop(free_at) + job_seconds)
+    finish = 0.0
+    for _ in range(math.ceil(records / MAX_RECORDS_PER_JOB)):
+        finish = heapq.heappop(free_at) + job_seconds
+        heapq.heappush(free_at, finish)
+    return finish
+
+
+def plan_split(profile: dict, deadline: float, rpm: float, tpm: float, batch_eta) -> dict:
+    """
+    Number of records to send on-demand, the others going to batch.
+
+    Tries SPLIT_STEPS fractions of the records and keeps the cheapest one
+    finishing by `deadline`, or the fastest one when none does.
+    `batch_eta(records)` estimates the batch path.
+    """
+    records = profile["records"]
+    candidates = []
+    for step in range(SPLIT_STEPS + 1):
+        on_demand = round(records * step / SPLIT_STEPS)
+        batch = records - on_demand
+        if 0 < batch < MIN_RECORDS_PER_JOB:
+            continue
+        share = on_demand / records if records else 0
+        on_demand_eta = on_demand_seconds(profile["requests"] * share, profile["tokens"] * share, rpm, tpm)
+        eta = max(on_demand_eta, batch_eta(batch))
+        cost = (profile["tokens"] * share * ON_DEMAND_PRICE_PER_1K_TOKENS
+                + profile["tokens"] * (1 - share) * BATCH_PRICE_PER_1K_TOKENS) / 1000
+        candidates.append({"on_demand": on_demand, "batch": batch, "eta": eta, "cost": cost,
+                           "on_demand_eta": on_demand_eta, "batch_eta": batch_eta(batch)})
+    on_time = [c for c in candidates if c["eta"] <= deadline]
+    if on_time:
+        return min(on_time, key=lambda c: (c["cost"], c["eta"]))
+    return min(candidates, key=lambda c: (c["eta"], c["cost"]))
+
+
+def write_parts(data_file: str, on_demand: int, on_demand_path: str, batch_path: str):
+    """Write the first `on_demand` records and the rest as two batch inference style JSONL files."""
+    with open(on_demand_path, "w") as first, open(batch_path, "w") as rest:
+        for i, record in enumerate(read_records(data_file)):
+            line = json.dumps({"recordId": record["recordId"],
+                               "modelInput": {"inputText": record["modelInput.inputText"]}})
+            (first if i < on_demand else rest).write(line + "\n")
+
+
+def format_seconds(seconds: float) -> str:
+    if math.isinf(seconds):
+        return "never"
+    return str(timedelta(seconds=round(seconds)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed a file on-demand, with batch inference, or split between both, to meet a deadline")
+    parser.add_argument("data_file", type=str, help="The JSONL or Parquet file to process")
+    parser.add_argument("--deadline", type=str, required=True,
+                        help="When the embeddings are needed, a duration like 90m, 6h or 2d, or an ISO 8601 time")
+    parser.add_argument("--output", type=str, default="./output.jsonl",
+                        help="Output of the on-demand part; batch results land under the stack's embeddings prefix")
+    parser.add_argument("--rpm", type=int, default=RATE_LIMIT_CALLS,
+                        help="Account requests per minute quota of the model, 0 for unlimited")
+    parser.add_argument("--tpm", type=int, default=RATE_LIMIT_TOKENS,
+                        help="Account input tokens per minute quota of the model, 0 for unlimited")
+    parser.add_argument("--ignore-usage", action="store_true",
+                        help="Don't deduct the model's recent on-demand usage, read from CloudWatch, from the quotas")
+    parser.add_argument("--max-chunk-chars", type=int, default=MAX_CHUNK_CHARS,
+                        help="Chunk size of the on-demand invoker, longer texts take several requests")
+    parser.add_argument("--stack-name", type=str, default="SolutionStack",
+                        help="Batch inference stack to read the registry table from")
+    parser.add_argument("--table", type=str, default=None, help="Batch registry table, read from the stack when not given")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=MAX_CONCURRENT_JOBS,
+                        help="MAX_CONCURRENT_JOBS of the batch job runner")
+    parser.add_argument("--job-hours", type=float, default=None,
+                        help="Duration of a batch job, the median of recent jobs by default")
+    parser.add_argument("--owner", type=str, default=None, help="Owner of the batches, see shard_and_register.py")
+    parser.add_argument("--priority", type=int, default=None, help="Priority of the batches, see shard_and_register.py")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the plan")
+    args = parser.parse_args()
+    if not os.path.exists(args.data_file):
+        print(f"Error: {args.data_file} is not an existing file")
+        sys.exit(1)
+
+    deadline = parse_deadline(args.deadline, datetime.now(timezone.utc))
+    profile = profile_workload(args.data_file, args.max_chunk_chars)
+    print(f"{profile['records']} records, {profile['requests']} requests, ~{profile['tokens']:.0f} input tokens")
+
+    # 0 disables a budget, as in multiprocessor.py
+    rpm, tpm = args.rpm or None, args.tpm or None
+    if not args.ignore_usage:
+        used_rpm, used_tpm = on_demand_usage(MODEL_ID)
+        rpm = max(rpm - used_rpm, 0) if rpm is not None else None
+        tpm = max(tpm - used_tpm, 0) if tpm is not None else None
+        print(f"On-demand: {used_rpm:.0f} requests and {used_tpm:.0f} tokens per minute already used by the model")
+
+    args.table = args.table or get_stack_output(args.stack_name, "BatchRegistryTableName")
+    active, queued = batch_backlog(args.table)
+    if args.job_hours is not None:
+        job_seconds = args.job_hours * 3600
+    else:
+        durations = job_durations(args.table)
+        job_seconds = statistics.median(durations) if durations else DEFAULT_JOB_SECONDS
+        print(f"Batch: median duration {format_seconds(job_seconds)} over {len(durations)} recent jobs")
+    print(f"Batch: {active} jobs running and {queued} queued for {args.max_concurrent_jobs} slots")
+
+    plan = plan_split(profile, deadline, rpm, tpm,
+                      lambda records: batch_seconds(records, active, queued, args.max_concurrent_jobs, job_seconds))
+    print(f"Plan: {plan['on_demand']} records on-demand (done in {format_seconds(plan['on_demand_eta'])}), "
+          f"{plan['batch']} in batch (done in {format_seconds(plan['batch_eta'])}), "
+          f"about ${plan['cost']:.2f}")
+    if plan["eta"] > deadline:
+        print(f"[WARNING] the deadline is in {format_seconds(max(deadline, 0))}, "
+              f"the fastest plan takes {format_seconds(plan['eta'])}")
+    if args.dry_run:
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        on_demand_path = os.path.join(work_dir, "on-demand.jsonl")
+        batch_path = os.path.join(work_dir, "batch.jsonl")
+        write_parts(args.data_file, plan["on_demand"], on_demand_path, batch_path)
+        processes = []
+        if plan["batch"]:
+            command = [sys.executable, SHARD_AND_REGISTER, batch_path, "--stack-name", args.stack_name, "--table", args.table]
+            if args.owner is not None:
+                command += ["--owner", args.owner]
+            if args.priority is not None:
+                command += ["--priority", str(args.priority)]
+            processes.append(subprocess.Popen(command))
+        if plan["on_demand"]:
+            # the on-demand part runs within the headroom it was planned with,
+            # not the full budget other callers of the model already use part of
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(SCRIPT_DIR, "multiprocessor.py"), on_demand_path, "--stream",
+                 "--output", args.output, "--rpm", budget_argument(rpm), "--tpm", budget_argument(tpm),
+                 "--max-chunk-chars", str(args.max_chunk_chars)]
+            ))
+        sys.exit(max((process.wait() for process in processes), default=0))
@@ -0,0 +1,211 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+# histogram buckets per doubling, i.e. about 9% relative precision
+BUCKETS_PER_DOUBLING = 8
+METRICS_FORMATS = ["jsonl", "emf"]
+EMF_NAMESPACE = "BedrockEmbeddings/OnDemand"
+
+
+class Histogram:
+    """Log-bucketed histogram, constant time to record and cheap to merge across processes."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value: float):
+        bucket = math.floor(math.log2(value) * BUCKETS_PER_DOUBLING) if value > 0 else -1 << 16
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile, clipped to the observed range."""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING), self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """
+    In-process counters, gauges and latency histograms.
+
+    Recording is a dict update under an uncontended lock. Gauges are functions
+    sampled when the metrics are reported, so they cost nothing per call.
+    `drain()` hands the counters and histograms collected since the last
+    drain to a `MetricsReporter`, or to a parent process through `merge()`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(value)
+
+    def gauge(self, name: str, fn):
+        """Report `fn()` as `name` every time the metrics are reported."""
+        self._gauges[name] = fn
+
+    def sample_gauges(self) -> dict:
+        return {name: fn() for name, fn in self._gauges.items()}
+
+    def drain(self) -> tuple:
+        """The (counters, histograms) recorded since the previous drain."""
+        with self._lock:
+            drained = (self._counters, self._histograms)
+            self._counters, self._histograms = {}, {}
+        return drained
+
+    def merge(self, drained: tuple):
+        counters, histograms = drained
+        with self._lock:
+            for name, value in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for name, histogram in histograms.items():
+                self._histograms.setdefault(name, Histogram()).merge(histogram)
+
+
+def emf_document(counters: dict, histograms: dict, gauges: dict, dimensions: dict, timestamp: float) -> dict:
+    """CloudWatch Embedded Metric Format record, histograms reported as percentiles in milliseconds."""
+    values, definitions = {}, []
+    for name, value in counters.items():
+        values[name] = value
+        definitions.append({"Name": name, "Unit": "Count"})
+    for name, value in gauges.items():
+        values[name] = value
+        definitions.append({"Name": name, "Unit": "None"})
+    for name, histogram in histograms.items():
+        for stat, value in histogram.summary().items():
+            values[f"{name}.{stat}"] = value
+            definitions.append({"Name": f"{name}.{stat}", "Unit": "Count" if stat == "count" else "Milliseconds"})
+    return {
+        "_aws": {
+            "Timestamp": int(timestamp * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": EMF_NAMESPACE,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": definitions,
+            }],
+        },
+        **dimensions,
+        **values,
+    }
+
+
+class MetricsReporter:
+    """
+    Drains `metrics` every `interval` seconds on a background thread.
+
+    Each window is appended to `path` ("-" for stdout) as one JSON line,
+    plain or in CloudWatch Embedded Metric Format, so a CloudWatch agent or
+    Lambda log group can pick it up. Without a path nothing is written and
+    the windows only add up to the run totals printed by `close()`.
+    """
+
+    def __init__(self, metrics: Metrics, path: str = None, fmt: str = "jsonl", interval: float = 10.0,
+                 dimensions: dict = None):
+        self.metrics = metrics
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.dimensions = dimensions or {}
+        self.totals = Metrics()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        counters, histograms = drained = self.metrics.drain()
+        gauges = self.metrics.sample_gauges()
+        self.totals.merge(drained)
+        if self.path is None:
+            return
+        now = time.time()
+        if self.fmt == "emf":
+            record = emf_document(counters, histograms, gauges, self.dimensions, now)
+        else:
+            record = {
+                "timestamp": now,
+                "pid": os.getpid(),
+                **self.dimensions,
+                "counters": counters,
+                "gauges": gauges,
+                "histograms": {name: histogram.summary() for name, histogram in histograms.items()},
+            }
+        line = json.dumps(record) + "\n"
+        if self.path == "-":
+            sys.stdout.write(line)
+        else:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def close(self):
+        """Stop the thread, report the last window and print the run totals."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.report()
+        counters, histograms = self.totals.drain()
+        print("Metrics: " + ", ".join(f"{name} {value:g}" for name, value in sorted(counters.items())))
+        for name, histogram in sorted(histograms.items()):
+            summary = histogram.summary()
+            if summary["count"]:
+                print(f"  {name}: p50 {summary['p50']:.1f}, p95 {summary['p95']:.1f}, "
+                      f"p99 {summary['p99']:.1f}, max {summary['max']:.1f} over {summary['count']}")
@@ -5,111 +5,338 @@ import sys
 import json
 import argparse
 import pandas as pd
-from typing import List, Any
-from dataclasses import dataclass
+from typing import List, Any, Iterable, Iterator
 import boto3
 import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
-import time as time_module  # Renamed to avoid conflict with perf_counter
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-bedrock_runtime = boto3.client('bedrock-runtime')
+from embedding_cache import EmbeddingCache, cache_key
+from adaptive_control import AdaptiveController, call_with_retries
+from client_pool import ClientPool, Target, parse_targets
+from rate_limiting import DualRateLimiter, SharedRateLimiter
+from checkpoint import checkpointed_writer
+from record_io import read_records, read_dataframe, dataframe_records, JsonlResultWriter, OUTPUT_FORMATS, open_result_writer, ListResultWriter
+from chunking import chunk_records, ChunkPooler, MAX_CHUNK_CHARS, CHUNK_OVERLAP_CHARS, POOLING_METHODS
+from metrics import Metrics, MetricsReporter, METRICS_FORMATS
 
-start_time = time()
+# set per worker process in init_worker()
+client_pool = None
+controller = None
+cache = None
+# per process; workers hand theirs to the parent with every chunk
+metrics = Metrics()
 
-# Add rate limiting constants
+# Add rate limiting constants, enforced globally across all worker processes
 RATE_LIMIT_CALLS = 2000  # calls
+RATE_LIMIT_TOKENS = 300000  # input tokens, check the account quota for the model
 RATE_LIMIT_PERIOD = 60  # seconds
-# CALL_DELAY = RATE_LIMIT_PERIOD / (RATE_LIMIT_CALLS) * 3   # seconds per call
-
-CALL_DELAY = RATE_LIMIT_PERIOD / RATE_LIMIT_CALLS * 0.1
-# CALL_DELAY -= 0.100
 
 MODEL_ID = 'amazon.titan-embed-text-v2:0'
 DIMENSIONS = 256
+NORMALIZE = True
+
+# records sent to a worker per task, and tasks queued per worker
+CHUNK_SIZE = 16
+CHUNKS_PER_WORKER = 4
 
 def process_item_sync(item: Any) -> dict:
     """Synchronous version of process_item for multiprocessing."""
+    start = time()
     input_text = item['modelInput.inputText']
+    key = cache_key(MODEL_ID, DIMENSIONS, NORMALIZE, input_text)
+    if cache is not None:
+        embeddings = cache.get(key)
+        if embeddings is not None:
+            metrics.incr("cache_hits")
+            return item["recordId"], input_text, embeddings
+
     sample_input = {
         "inputText": input_text,
         "dimensions": DIMENSIONS,
+        "normalize": NORMALIZE,
     }
     body = json.dumps(sample_input)
     
-    # Add rate limiting delay
-    # time_module.sleep(CALL_DELAY)
-    
-    response = bedrock_runtime.invoke_model(
-        modelId=MODEL_ID,
-        body=body,
-        accept='application/json',
-        contentType='application/json'
-    )
+    # retry with backoff, routing each attempt to the least loaded target and
+    # reserving its request and token budget, shared by all workers, plus a
+    # slot from the shared adaptive controller
+    attempt = {}
+
+    def acquire():
+        index = client_pool.checkout()
+        attempt['index'] = index
+        limiter = client_pool.limiters[index]
+        try:
+            attempt['reserved'] = limiter.acquire(input_text) if limiter is not None else 0.0
+        except BaseException:
+            client_pool.checkin(index)
+            raise
+
+    def call():
+        index = attempt['index']
+        try:
+            return client_pool.client(index).invoke_model(
+                modelId=client_pool.targets[index].model_id,
+                body=body,
+                accept='application/json',
+                contentType='application/json'
+            )
+        except Exception:
+            # settle the failed attempt on its own target before a retry moves on
+            limiter = client_pool.limiters[index]
+            if limiter is not None:
+                limiter.refund(attempt['reserved'])
+            raise
+        finally:
+            client_pool.checkin(index)
+
+    response = call_with_retries(call, controller=controller, acquire=acquire, metrics=metrics)
 
     response_body = json.loads(response.get('body').read())
     embeddings = response_body['embedding']    
-    print(f"t + {time() - start_time:.5f}")
+    limiter = client_pool.limiters[attempt['index']]
+    if limiter is not None:
+        limiter.settle(input_text, attempt['reserved'], response_body.get('inputTextTokenCount'))
+    if cache is not None:
+        cache.put(key, embeddings)
+    metrics.incr("input_tokens", response_body.get('inputTextTokenCount') or 0)
+    metrics.incr("records")
+    metrics.observe("record_latency_ms", (time() - start) * 1000)
     return item["recordId"], input_text, embeddings
 
-def process_batch(dataframe: pd.DataFrame, batch_size: int = 2000) -> List[dict]:
-    """Process items concurrently with rate limiting and multiple processors."""
-    
+def init_worker(shared_client_pool: ClientPool, shared_controller: AdaptiveController = None,
+                cache_path: str = None, cache_max_bytes: int = 1 << 30):
+    """Pool initializer: build one Bedrock client per target per worker process and reuse them."""
+    global client_pool, controller, cache, metrics
+    # rate budgets and in-flight counts are shared, the clients are built here;
+    # they don't retry on their own, so throttles reach the controller
+    client_pool = shared_client_pool.connect()
+    controller = shared_controller
+    # every worker opens its own connection on the shared cache file
+    cache = EmbeddingCache(cache_path, max_bytes=cache_max_bytes) if cache_path else None
+    if cache is not None:
+        # write the entries it still buffers when the pool shuts the worker down
+        multiprocessing.util.Finalize(cache, cache.close, exitpriority=10)
+    # a forked worker inherits the parent's metrics, and maybe its lock held
+    metrics = Metrics()
+
+def process_chunk(items: List[Any]) -> tuple:
+    """
+    Process a chunk of items in a worker, amortising the IPC round trip.
+
+    The worker's metrics since its previous chunk travel back with the
+    results, so nothing is lost when the pool shuts its workers down.
+    """
+    results = []
+    for item in items:
+        try:
+            results.append(process_item_sync(item))
+        except Exception as e:
+            # retries are exhausted, drop the item rather than the whole chunk
+            print(f"Error processing record {item['recordId']}: {str(e)}")
+    return results, metrics.drain()
+
+def process_records(records: Iterable[dict], chunksize: int = CHUNK_SIZE,
+                    rate_limit_calls: int = RATE_LIMIT_CALLS, rate_limit_tokens: int = RATE_LIMIT_TOKENS,
+                    targets: List[Target] = None, cache_path: str = None,
+                    cache_max_bytes: int = 1 << 30) -> Iterator[tuple]:
+    """
+    Feed records continuously to a long-lived process pool, yielding results in
+    completion order.
+
+    A bounded number of chunks is kept queued per worker, so a slow request
+    only delays its own chunk and the input iterator is consumed lazily.
+    Records whose text is already queued are held back and answered from the
+    first copy's result, so identical texts cost a single request.
+    """
     # Calculate optimal number of processes (leave one core free)
     num_processes = max(1, multiprocessing.cpu_count() - 1)
-    
-    results = []
-    for i in range(0, len(dataframe), batch_size):
-        batch_df = dataframe.iloc[i:i + batch_size]
-        print(f"Processing batch {i // batch_size + 1} of {len(dataframe) // batch_size}")
-        
-        # Process the batch using multiple processes
-        with ProcessPoolExecutor(max_workers=num_processes) as executor:
-            batch_results = list(executor.map(
-                process_item_sync,
-                batch_df.to_dict(orient="records")
-            ))
-        results.extend(batch_results)
-    
-    return results
+    max_pending = num_processes * CHUNKS_PER_WORKER
+
+    # each target gets request and token buckets shared by all workers
+    def limiter_factory(weight):
+        return DualRateLimiter(
+            SharedRateLimiter(rate_limit_calls * weight, RATE_LIMIT_PERIOD) if rate_limit_calls > 0 else None,
+            SharedRateLimiter(rate_limit_tokens * weight, RATE_LIMIT_PERIOD) if rate_limit_tokens > 0 else None
+        )
+    shared_client_pool = ClientPool(targets or [Target(None, MODEL_ID)], limiter_factory)
+    # each worker has one request in flight, so the controller can only hold
+    # concurrency at or below the number of processes
+    shared_controller = AdaptiveController(num_processes, max_limit=num_processes)
+    metrics.gauge("in_flight", lambda: shared_controller.in_flight)
+    metrics.gauge("concurrency_limit", lambda: shared_controller.limit)
+
+    # cache key -> duplicate records waiting for the queued copy
+    duplicates = {}
+
+    def next_chunk():
+        chunk = []
+        for item in records:
+            key = cache_key(MODEL_ID, DIMENSIONS, NORMALIZE, item['modelInput.inputText'])
+            if key in duplicates:
+                duplicates[key].append(item)
+                continue
+            duplicates[key] = []
+            chunk.append((key, item))
+            if len(chunk) == chunksize:
+                break
+        return chunk
+
+    records = iter(records)
+    with ProcessPoolExecutor(max_workers=num_processes, initializer=init_worker,
+                             initargs=(shared_client_pool, shared_controller, cache_path, cache_max_bytes)) as executor:
+        pending = {}
+        metrics.gauge("queued_chunks", lambda: len(pending))
+        while True:
+            while len(pending) < max_pending:
+                chunk = next_chunk()
+                if not chunk:
+                    break
+                pending[executor.submit(process_chunk, [item for _, item in chunk])] = chunk
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                chunk_results, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                results = {result[0]: result for result in chunk_results}
+                for key, item in chunk:
+                    held = duplicates.pop(key)
+                    result = results.get(item["recordId"])
+                    if result is None:
+                        for dup in held:
+                            print(f"Error processing record {dup['recordId']}: duplicate of failed record {item['recordId']}")
+                        continue
+                    yield result
+                    metrics.incr("deduplicated", len(held))
+                    for dup in held:
+                        yield dup["recordId"], dup['modelInput.inputText'], result[2]
+
+def process_batch(dataframe: pd.DataFrame, max_chunk_chars: int = MAX_CHUNK_CHARS,
+                  chunk_overlap: int = CHUNK_OVERLAP_CHARS, pooling: str = "mean", **kwargs) -> List[dict]:
+    """
+    Process items concurrently with rate limiting and multiple processors.
+
+    Texts over `max_chunk_chars` are embedded in overlapping chunks whose
+    vectors are pooled back into one result per record.
+    """
+    collected = ListResultWriter()
+    process_stream(dataframe_records(dataframe), collected, max_chunk_chars, chunk_overlap, pooling, **kwargs)
+    return collected.results
+
+def process_stream(records: Iterable[dict], writer: JsonlResultWriter, max_chunk_chars: int = MAX_CHUNK_CHARS,
+                   chunk_overlap: int = CHUNK_OVERLAP_CHARS, pooling: str = "mean", **kwargs) -> int:
+    """
+    Streaming version of process_batch.
+
+    Results are written as soon as their chunk completes, so neither the input
+    nor the output is ever held in memory in full. Only the chunks of records
+    still being embedded are kept, for pooling.
+    """
+    if max_chunk_chars:
+        records = chunk_records(records, max_chunk_chars, chunk_overlap)
+    with ChunkPooler(writer, pooling, NORMALIZE) as pooler:
+        for record_id, input_text, embeddings in process_records(records, **kwargs):
+            pooler.write(record_id, input_text, embeddings)
+    if pooler.partial:
+        print(f"[WARNING] {pooler.partial} chunked records are missing chunks and were not written")
+
+    return writer.count
 
 async def main():
     # validate the input argument must be an existing file
     # use argparse to get the input argument
     parser = argparse.ArgumentParser()
-    parser.add_argument("data_file", type=str, help="The input file to process")
+    parser.add_argument("data_file", type=str, help="The JSONL or Parquet file to process")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the input lazily and write results to --output as they complete")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue a previous --stream run, skipping the records in <output>.journal (implies --stream)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="The output file to write, ./output.<format> by default")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="jsonl",
+                        help="jsonl, or npy for a float32 matrix plus a <output>.index.jsonl recordId index")
+    parser.add_argument("--include-text", action="store_true",
+                        help="Keep the input text in the npy index (always kept in jsonl)")
+    parser.add_argument("--rpm", type=int, default=RATE_LIMIT_CALLS,
+                        help="Requests per minute budget per target, shared by all workers, 0 to disable")
+    parser.add_argument("--tpm", type=int, default=RATE_LIMIT_TOKENS,
+                        help="Input tokens per minute budget per target, shared by all workers, 0 to disable")
+    parser.add_argument("--targets", type=str, default=None,
+                        help="Comma separated REGION[=MODEL_ID][*WEIGHT] list to spread requests over, "
+                             "e.g. us-east-1,us-west-2. Defaults to the configured region")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path of a persistent embedding cache (SQLite), disabled by default")
+    parser.add_argument("--cache-max-mb", type=int, default=1024,
+                        help="Size of the embedding cache before LRU eviction")
+    parser.add_argument("--max-chunk-chars", type=int, default=MAX_CHUNK_CHARS,
+                        help="Split longer texts into overlapping chunks and pool their embeddings, 0 to disable")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP_CHARS,
+                        help="Characters repeated at the start of each chunk from the previous one")
+    parser.add_argument("--pooling", choices=POOLING_METHODS, default="mean",
+                        help="mean of the chunk embeddings, or weighted by chunk length")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="File to append metrics to every --metrics-interval seconds, - for stdout")
+    parser.add_argument("--metrics-format", choices=METRICS_FORMATS, default="jsonl",
+                        help="jsonl, or emf for CloudWatch Embedded Metric Format")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="Seconds between two metrics reports")
     args = parser.parse_args()
     if not os.path.exists(args.data_file):
         print(f"Error: {args.data_file} is not an existing file")
         sys.exit(1)
+    if args.output is None:
+        args.output = f"./output.{args.output_format}"
+
+    pool_options = dict(
+        rate_limit_calls=args.rpm,
+        rate_limit_tokens=args.tpm,
+        targets=parse_targets(args.targets, MODEL_ID) if args.targets else None,
+        cache_path=args.cache,
+        cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+        max_chunk_chars=args.max_chunk_chars,
+        chunk_overlap=args.chunk_overlap,
+        pooling=args.pooling
+    )
+    reporter = MetricsReporter(metrics, args.metrics, args.metrics_format, args.metrics_interval,
+                               {"Invoker": "multiprocessor"}).start()
+
+    if args.stream or args.resume:
+        print("Starting streaming processing...")
+        start_time = time()
+        # results are journaled as they land, so a crash or Ctrl-C can be resumed
+        with checkpointed_writer(args.output, args.output_format, args.include_text,
+                                 resume=args.resume) as (writer, journal):
+            if journal.rows:
+                print(f"Resuming, skipping {journal.rows} completed records")
+            count = process_stream(journal.pending(read_records(args.data_file)), writer, **pool_options)
+        end_time = time()
+        print(f"Processed {count} items in {end_time - start_time:.2f} seconds")
+        print(f"Average rate: {count / (end_time - start_time):.2f} items/second")
+        reporter.close()
+        return
     
     # read the data file
-    data = []
-    with open(args.data_file) as f:
-        for line in f:
-            data.append(json.loads(line))
-    df = pd.json_normalize(data, max_level=1)
-    df = df.reset_index(drop=True)
+    df = read_dataframe(args.data_file)
 
 
     print("Starting processing...")
     start_time = time()
     
-    results = process_batch(df)
+    results = process_batch(df, **pool_options)
     
     end_time = time()
     print(f"Processed {len(results)} items in {end_time - start_time:.2f} seconds")
     print(f"Average rate: {len(results) / (end_time - start_time):.2f} items/second")
 
     
-    with open("./output.jsonl", 'w') as f:
+    with open_result_writer(args.output, args.output_format, args.include_text) as writer:
         for record_id, input_text, embeddings in results:
-            result_dict = {
-                'recordId': record_id,
-                'inputText': input_text,
-                'embeddings': embeddings
-            }
-            f.write(json.dumps(result_dict) + '\n')
+            writer.write(record_id, input_text, embeddings)
+    reporter.close()
             
 
 if __name__ == "__main__":
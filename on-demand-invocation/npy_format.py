@@ -0,0 +1,23 @@
+"""
+The float32 `.npy` layout of embedding matrices, shared with the batch
+inference post-processing Lambda, which gets this module through its layer
+(see batch-inference/solution/build_layer.py). Standard library only, so the
+Lambda doesn't need numpy to write or read it.
+"""
+import ast
+import struct
+
+# fixed size .npy header, so it can be rewritten in place with the final row
+# count once all vectors have been streamed to disk
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(rows: int, dimensions: int) -> bytes:
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dimensions)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def npy_shape(header: bytes) -> tuple:
+    """`(rows, dimensions)` of a header written by `npy_header`."""
+    return ast.literal_eval(header[10:NPY_HEADER_SIZE].decode('latin1'))['shape']
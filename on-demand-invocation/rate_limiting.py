@@ -0,0 +1,129 @@
+import asyncio
+import multiprocessing
+import time
+from time import monotonic
+
+
+class AsyncRateLimiter:
+    """
+    Awaitable token bucket allowing `calls` acquisitions per `period` seconds.
+
+    Tokens are reserved up front (the balance may go negative) and the caller
+    sleeps until its reservation is covered, so waiting tasks never block the
+    event loop and are released in FIFO order.
+    """
+
+    def __init__(self, calls: int, period: float = 60.0, burst: float = None):
+        self.rate = calls / period
+        # default to one second worth of tokens so a fresh limiter can't dump
+        # the whole per-minute budget in the first instant
+        self.capacity = burst if burst is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take `tokens` from the bucket and return how long to wait before using them."""
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate) - tokens
+        self._updated = now
+        return max(0.0, -self._tokens / self.rate)
+
+    def settle(self, reserved: float, actual: float):
+        """Correct an earlier reservation once the real cost is known."""
+        self._tokens = min(self.capacity, self._tokens + reserved - actual)
+
+    async def acquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SharedRateLimiter:
+    """
+    Token bucket shared by every process it is handed to.
+
+    The bucket state lives in shared memory, so N worker processes draw from
+    one global budget instead of each guessing its share. Pass it to workers at
+    process creation, e.g. through a pool `initargs`.
+    """
+
+    def __init__(self, calls: int, period: float = 60.0, burst: float = None):
+        self.rate = calls / period
+        self.capacity = burst if burst is not None else max(1.0, self.rate)
+        # [tokens, last update]; time.monotonic() is system wide, so it is
+        # comparable across processes
+        self._state = multiprocessing.Array('d', [self.capacity, monotonic()])
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take `tokens` from the bucket and return how long to wait before using them."""
+        with self._state.get_lock():
+            available, updated = self._state[0], self._state[1]
+            now = monotonic()
+            available = min(self.capacity, available + (now - updated) * self.rate) - tokens
+            self._state[0] = available
+            self._state[1] = now
+        return max(0.0, -available / self.rate)
+
+    def settle(self, reserved: float, actual: float):
+        """Correct an earlier reservation once the real cost is known."""
+        with self._state.get_lock():
+            self._state[0] = min(self.capacity, self._state[0] + reserved - actual)
+
+    def acquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DualRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets enforced together.
+
+    Each call reserves one request plus an estimate of its input tokens, then
+    `settle()` corrects the token bucket with the `inputTextTokenCount` from
+    the response. The characters-per-token ratio used for the estimate is
+    learned from those settlements. Works with either `AsyncRateLimiter` or
+    `SharedRateLimiter` buckets; either budget may be None to leave it
+    unlimited.
+    """
+
+    def __init__(self, requests=None, tokens=None, chars_per_token: float = 4.0, ewma_alpha: float = 0.05):
+        self.requests = requests
+        self.tokens = tokens
+        self.chars_per_token = chars_per_token
+        self.ewma_alpha = ewma_alpha
+
+    def estimate_tokens(self, input_text: str) -> float:
+        return max(1.0, len(input_text) / self.chars_per_token)
+
+    def reserve(self, input_text: str):
+        """Reserve budget for one call, returning `(delay, reserved_tokens)`."""
+        delay = self.requests.reserve(1) if self.requests is not None else 0.0
+        if self.tokens is None:
+            return delay, 0.0
+        reserved = self.estimate_tokens(input_text)
+        return max(delay, self.tokens.reserve(reserved)), reserved
+
+    def acquire(self, input_text: str) -> float:
+        delay, reserved = self.reserve(input_text)
+        if delay > 0:
+            time.sleep(delay)
+        return reserved
+
+    async def acquire_async(self, input_text: str) -> float:
+        delay, reserved = self.reserve(input_text)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return reserved
+
+    def refund(self, reserved: float):
+        """Give back the tokens reserved for a call that failed, which used none."""
+        if self.tokens is not None:
+            self.tokens.settle(reserved, 0)
+
+    def settle(self, input_text: str, reserved: float, actual_tokens: int):
+        if self.tokens is None or not actual_tokens:
+            return
+        self.tokens.settle(reserved, actual_tokens)
+        ratio = len(input_text) / actual_tokens
+        self.chars_per_token += self.ewma_alpha * (ratio - self.chars_per_token)
@@ -0,0 +1,319 @@
+import json
+import os
+from itertools import islice
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from npy_format import NPY_HEADER_SIZE, npy_header
+
+try:
+    import pyarrow as pa
+    import pyarrow.json as pa_json
+    import pyarrow.parquet as pq
+except ImportError:  # JSONL is then parsed line by line, and Parquet can't be read
+    pa = None
+
+# columns of a record, flattened the same way as `pd.json_normalize(max_level=1)`
+INPUT_COLUMNS = ("recordId", "modelInput.inputText")
+# bytes of JSONL parsed per Arrow block, i.e. per record batch; larger blocks
+# parse no faster and hold more memory in the reader's read-ahead
+JSONL_BLOCK_SIZE = 1 << 20
+PARQUET_BATCH_ROWS = 65536
+# Arrow types of a JSONL recordId, read as is and cast to string; Arrow
+# formats floats unlike Python, so those are parsed line by line
+JSONL_RECORD_ID_TYPES = {str: "string", int: "int64"}
+
+
+def is_parquet(data_file: str) -> bool:
+    return data_file.endswith((".parquet", ".pq"))
+
+
+def read_record_batches(data_file: str) -> Iterator["pa.RecordBatch"]:
+    """
+    Stream a batch inference style JSONL or Parquet file as Arrow record batches.
+
+    Only `recordId` and `modelInput.inputText` are read: other JSON fields are
+    skipped while parsing and other Parquet columns never leave the disk. JSONL
+    blocks are parsed on Arrow's thread pool. The batches have two string
+    columns, `recordId` and `inputText`, sliced from the parsed data without
+    copies.
+    """
+    if is_parquet(data_file):
+        parquet_file = pq.ParquetFile(data_file)
+        # a DataFrame saved by pandas has the flattened column names as is
+        if "modelInput.inputText" in parquet_file.schema_arrow.names:
+            for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=list(INPUT_COLUMNS)):
+                yield pa.RecordBatch.from_arrays(
+                    [batch.column(0).cast(pa.string()), batch.column(1).cast(pa.string())],
+                    names=["recordId", "inputText"],
+                )
+            return
+        batches = parquet_file.iter_batches(
+            batch_size=PARQUET_BATCH_ROWS, columns=["recordId", "modelInput.inputText"]
+        )
+    else:
+        yield from _read_jsonl_batches(data_file)
+        return
+    for batch in batches:
+        yield pa.RecordBatch.from_arrays(
+            [batch.column("recordId").cast(pa.string()), batch.column("modelInput").field("inputText")],
+            names=["recordId", "inputText"],
+        )
+
+
+def _first_record_id(data_file: str):
+    with open(data_file) as f:
+        for line in f:
+            if line.strip():
+                return json.loads(line).get("recordId")
+    return None
+
+
+def _read_jsonl_batches(data_file: str) -> Iterator["pa.RecordBatch"]:
+    """
+    JSONL blocks parsed by Arrow, with the Arrow type of the first record's
+    `recordId`, cast to string. From the first block with another type of
+    id, or for ids Arrow formats unlike Python (floats), the file is parsed
+    line by line instead.
+    """
+    record_id_type = JSONL_RECORD_ID_TYPES.get(type(_first_record_id(data_file)))
+    if record_id_type is None:
+        yield from _to_record_batches(_read_jsonl_records(data_file))
+        return
+    schema = pa.schema([
+        ("recordId", pa.type_for_alias(record_id_type)),
+        ("modelInput", pa.struct([("inputText", pa.string())])),
+    ])
+    rows = 0
+    try:
+        for batch in pa_json.open_json(
+            data_file,
+            read_options=pa_json.ReadOptions(block_size=JSONL_BLOCK_SIZE),
+            parse_options=pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore"),
+        ):
+            yield pa.RecordBatch.from_arrays(
+                [batch.column("recordId").cast(pa.string()), batch.column("modelInput").field("inputText")],
+                names=["recordId", "inputText"],
+            )
+            rows += batch.num_rows
+    except pa.ArrowInvalid:
+        yield from _to_record_batches(islice(_read_jsonl_records(data_file), rows, None))
+
+
+def _to_record_batches(records: Iterator[dict]) -> Iterator["pa.RecordBatch"]:
+    schema = pa.schema([("recordId", pa.string()), ("inputText", pa.string())])
+    while True:
+        chunk = list(islice(records, PARQUET_BATCH_ROWS))
+        if not chunk:
+            return
+        yield pa.RecordBatch.from_pydict({
+            "recordId": [record["recordId"] for record in chunk],
+            "inputText": [record["modelInput.inputText"] for record in chunk],
+        }, schema=schema)
+
+
+def _read_jsonl_records(data_file: str) -> Iterator[dict]:
+    with open(data_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {
+                # numeric ids are read as strings, like the Arrow readers do
+                "recordId": str(record["recordId"]),
+                "modelInput.inputText": record["modelInput"]["inputText"],
+            }
+
+
+def read_records(data_file: str) -> Iterator[dict]:
+    """
+    Lazily read a batch inference style JSONL or Parquet file, one record at a time.
+
+    Records are flattened the same way as `pd.json_normalize(max_level=1)`, i.e.
+    `{"recordId": ..., "modelInput.inputText": ...}`, so they can be passed to
+    the invokers unchanged. With pyarrow installed, the file is parsed in
+    blocks by `read_record_batches` and only the current batch is turned into
+    Python strings.
+    """
+    if pa is None:
+        if is_parquet(data_file):
+            raise ImportError(f"Reading {data_file} needs pyarrow")
+        yield from _read_jsonl_records(data_file)
+        return
+    for batch in read_record_batches(data_file):
+        for record_id, input_text in zip(batch.column(0).to_pylist(), batch.column(1).to_pylist()):
+            yield {"recordId": record_id, "modelInput.inputText": input_text}
+
+
+def read_dataframe(data_file: str) -> pd.DataFrame:
+    """All the records of a JSONL or Parquet file as a `recordId`, `modelInput.inputText` DataFrame."""
+    if pa is None:
+        return pd.DataFrame(list(read_records(data_file)), columns=list(INPUT_COLUMNS))
+    schema = pa.schema([("recordId", pa.string()), ("inputText", pa.string())])
+    table = pa.Table.from_batches(read_record_batches(data_file), schema=schema)
+    return table.rename_columns(list(INPUT_COLUMNS)).to_pandas()
+
+
+def dataframe_records(df: pd.DataFrame) -> list:
+    """The rows of a `read_dataframe` DataFrame as record dicts, much faster than `df.to_dict(orient="records")`."""
+    return [
+        {"recordId": record_id, "modelInput.inputText": input_text}
+        for record_id, input_text in zip(df["recordId"].tolist(), df["modelInput.inputText"].tolist())
+    ]
+
+
+def truncate_lines(path: str, rows: int):
+    """Keep only the first `rows` complete lines of a text file."""
+    with open(path, 'r+b') as f:
+        for _ in range(rows):
+            if not f.readline().endswith(b'\n'):
+                raise ValueError(f"{path} has fewer than {rows} complete lines")
+        f.truncate(f.tell())
+
+
+class JsonlResultWriter:
+    """
+    Append embedding results to a JSONL file as soon as they are produced.
+
+    With `resume_rows`, the existing file is cut back to its first
+    `resume_rows` lines and appended to instead of being overwritten.
+    """
+
+    def __init__(self, output_file: str, flush_every: int = 100, resume_rows: int = 0):
+        self.output_file = output_file
+        self.flush_every = flush_every
+        self.resume_rows = resume_rows
+        self.count = 0
+        self._f = None
+
+    def __enter__(self):
+        if self.resume_rows:
+            truncate_lines(self.output_file, self.resume_rows)
+            self._f = open(self.output_file, 'a')
+        else:
+            self._f = open(self.output_file, 'w')
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+    def flush(self):
+        self._f.flush()
+
+    def write(self, record_id, input_text, embeddings):
+        result_dict = {
+            'recordId': record_id,
+            'inputText': input_text,
+            'embeddings': embeddings
+        }
+        self._f.write(json.dumps(result_dict) + '\n')
+        self.count += 1
+        # flush regularly so downstream consumers can tail the output
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+
+def index_path(output_file: str) -> str:
+    """Path of the recordId index stored next to a .npy embedding matrix."""
+    return os.path.splitext(output_file)[0] + '.index.jsonl'
+
+
+class NpyEmbeddingWriter:
+    """
+    Write embeddings as a contiguous float32 `.npy` matrix plus a JSONL index.
+
+    Row `i` of the matrix belongs to line `i` of the index, which holds the
+    recordId and, with `include_text`, the input text. Vectors are appended as
+    they arrive and the header is patched on every flush, so the matrix can
+    later be memory-mapped with `load_embeddings`. With `resume_rows`, both
+    files are cut back to that many rows and appended to.
+    """
+
+    def __init__(self, output_file: str, include_text: bool = False, flush_every: int = 100,
+                 resume_rows: int = 0):
+        self.output_file = output_file
+        self.include_text = include_text
+        self.flush_every = flush_every
+        self.resume_rows = resume_rows
+        self.dimensions = None
+        self.count = 0
+        self._f = None
+        self._index = None
+
+    def __enter__(self):
+        if self.resume_rows:
+            self.dimensions = np.load(self.output_file, mmap_mode='r').shape[1]
+            self._f = open(self.output_file, 'r+b')
+            self._f.truncate(NPY_HEADER_SIZE + self.resume_rows * self.dimensions * 4)
+            self._f.seek(0, os.SEEK_END)
+            truncate_lines(index_path(self.output_file), self.resume_rows)
+            self._index = open(index_path(self.output_file), 'a')
+        else:
+            self._f = open(self.output_file, 'wb')
+            self._f.write(npy_header(0, 0))
+            self._index = open(index_path(self.output_file), 'w')
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        self._f.close()
+        self._index.close()
+
+    def flush(self):
+        # patch the header with the rows written so far, then go back to the end
+        self._f.seek(0)
+        self._f.write(npy_header(self.resume_rows + self.count, self.dimensions or 0))
+        self._f.seek(0, os.SEEK_END)
+        self._f.flush()
+        self._index.flush()
+
+    def write(self, record_id, input_text, embeddings):
+        vector = np.asarray(embeddings, dtype='<f4')
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+        elif len(vector) != self.dimensions:
+            raise ValueError(f"Record {record_id} has {len(vector)} dimensions, expected {self.dimensions}")
+        self._f.write(vector.tobytes())
+
+        entry = {'recordId': record_id}
+        if self.include_text:
+            entry['inputText'] = input_text
+        self._index.write(json.dumps(entry) + '\n')
+
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+
+def load_embeddings(output_file: str, mmap: bool = True):
+    """Load the recordIds and the (memory-mapped) vectors written by NpyEmbeddingWriter."""
+    with open(index_path(output_file)) as f:
+        record_ids = [json.loads(line)['recordId'] for line in f]
+    vectors = np.load(output_file, mmap_mode='r' if mmap else None)
+    return record_ids, vectors
+
+
+class ListResultWriter:
+    """Keep results in memory as `(recordId, inputText, embeddings)` tuples, for the batch modes."""
+
+    def __init__(self):
+        self.results = []
+
+    @property
+    def count(self) -> int:
+        return len(self.results)
+
+    def write(self, record_id, input_text, embeddings):
+        self.results.append((record_id, input_text, embeddings))
+
+
+OUTPUT_FORMATS = ('jsonl', 'npy')
+
+
+def open_result_writer(output_file: str, output_format: str = 'jsonl', include_text: bool = False,
+                       resume_rows: int = 0):
+    if output_format == 'npy':
+        return NpyEmbeddingWriter(output_file, include_text=include_text, resume_rows=resume_rows)
+    return JsonlResultWriter(output_file, resume_rows=resume_rows)
@@ -0,0 +1,77 @@
+import asyncio
+import random
+
+import pytest
+from botocore.exceptions import ClientError
+
+from adaptive_control import AdaptiveController, call_with_retries_async
+
+
+def throttle():
+    return ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel")
+
+
+def test_lognormal_latencies_do_not_shrink_the_limit():
+    random.seed(1)
+    controller = AdaptiveController(32, max_limit=256, cooldown=0)
+    for _ in range(2000):
+        controller.acquire()
+        controller.release(latency=0.05 * random.lognormvariate(0, 0.3))
+    assert controller.limit >= 32
+
+
+def test_sustained_latency_rise_shrinks_the_limit():
+    controller = AdaptiveController(64, max_limit=256, cooldown=0)
+    for _ in range(200):
+        controller.acquire()
+        controller.release(latency=0.05)
+    before = controller.limit
+    for _ in range(20):
+        controller.acquire()
+        controller.release(latency=0.5)
+    assert controller.limit < before / 2
+
+
+def test_throttle_halves_the_limit():
+    controller = AdaptiveController(32, cooldown=0)
+    controller.acquire()
+    controller.release(throttled=True)
+    assert controller.limit == 16
+    assert controller.in_flight == 0
+
+
+def test_cancelled_call_releases_its_slot():
+    controller = AdaptiveController(4)
+
+    async def run():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(3600)
+
+        task = asyncio.create_task(call_with_retries_async(hang, controller))
+        await started.wait()
+        assert controller.in_flight == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert controller.in_flight == 0
+
+
+def test_retries_release_every_attempt():
+    controller = AdaptiveController(4, cooldown=0)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise throttle()
+        return "ok"
+
+    result = asyncio.run(call_with_retries_async(flaky, controller, base_delay=0))
+    assert result == "ok"
+    assert len(calls) == 3
+    assert controller.in_flight == 0
@@ -0,0 +1,48 @@
+import json
+
+import numpy as np
+
+from checkpoint import checkpointed_writer, journal_path
+from record_io import load_embeddings
+
+RECORDS = [{"recordId": f"r{i}", "modelInput.inputText": f"text {i}"} for i in range(10)]
+
+
+def crash_after(output, output_format, rows):
+    """Write `rows` results, commit the first 4, then die with the rest unjournaled."""
+    with checkpointed_writer(output, output_format) as (writer, journal):
+        writer.commit_every = 4
+        for record in RECORDS[:rows]:
+            writer.write(record["recordId"], record["modelInput.inputText"], [float(record["recordId"][1:])] * 3)
+        # stop before the finally block journals the rest
+        writer.commit = lambda: None
+    with open(journal_path(output), "a") as f:
+        f.write('"r9')  # a journal line cut off mid-write
+
+
+def resume(output, output_format):
+    with checkpointed_writer(output, output_format, resume=True) as (writer, journal):
+        skipped = journal.rows
+        for record in journal.pending(RECORDS):
+            writer.write(record["recordId"], record["modelInput.inputText"], [float(record["recordId"][1:])] * 3)
+    return skipped
+
+
+def test_jsonl_resume_after_a_partial_journal(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+    crash_after(output, "jsonl", 7)
+    assert resume(output, "jsonl") == 4
+    with open(output) as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["recordId"] for row in rows] == [record["recordId"] for record in RECORDS]
+    with open(journal_path(output)) as f:
+        assert [json.loads(line) for line in f] == [record["recordId"] for record in RECORDS]
+
+
+def test_npy_resume_after_a_partial_journal(tmp_path):
+    output = str(tmp_path / "out.npy")
+    crash_after(output, "npy", 7)
+    assert resume(output, "npy") == 4
+    record_ids, vectors = load_embeddings(output)
+    assert record_ids == [record["recordId"] for record in RECORDS]
+    np.testing.assert_array_equal(vectors[:, 0], np.arange(10, dtype=np.float32))
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from chunking import ChunkPooler, chunk_records, join_chunks, parse_chunk_id, pool_embeddings, split_text
+from record_io import ListResultWriter
+
+
+def test_short_text_is_a_single_chunk():
+    assert split_text("hello world", max_chars=20, overlap=5) == [(0, "hello world")]
+
+
+def test_chunks_respect_the_size_and_overlap():
+    text = " ".join(f"word{i}" for i in range(500))
+    chunks = split_text(text, max_chars=100, overlap=20)
+    assert all(len(chunk) <= 100 for _, chunk in chunks)
+    for (start, chunk), (next_start, _) in zip(chunks, chunks[1:]):
+        # every chunk starts `overlap` characters before the previous one ended
+        assert next_start == start + len(chunk) - 20
+    assert join_chunks(chunks) == text
+
+
+def test_cuts_fall_on_whitespace():
+    text = " ".join(f"word{i}" for i in range(500))
+    for _, chunk in split_text(text, max_chars=100, overlap=0)[:-1]:
+        assert chunk.endswith(" ")
+
+
+def test_text_without_whitespace_is_cut_at_max_chars():
+    text = "x" * 250
+    chunks = split_text(text, max_chars=100, overlap=10)
+    assert [start for start, _ in chunks] == [0, 90, 180]
+    assert [len(chunk) for _, chunk in chunks] == [100, 100, 70]
+    assert join_chunks(chunks) == text
+
+
+def test_overlap_must_be_under_half_the_chunk():
+    with pytest.raises(ValueError):
+        split_text("x" * 250, max_chars=100, overlap=50)
+
+
+def test_chunk_ids_round_trip():
+    records = list(chunk_records([{"recordId": "doc", "modelInput.inputText": "x" * 250}], 100, 10))
+    assert [parse_chunk_id(record["recordId"]) for record in records] == [
+        ("doc", 0, 3, 0), ("doc", 1, 3, 90), ("doc", 2, 3, 180)
+    ]
+    assert parse_chunk_id("doc") is None
+
+
+def test_pooling_groups_of_uneven_size():
+    vectors = np.array([[1, 0], [3, 0], [0, 2], [0, 4], [0, 6], [5, 5]], dtype=np.float32)
+    offsets = np.array([0, 2, 5])
+    pooled = pool_embeddings(vectors, offsets, normalize=False)
+    np.testing.assert_allclose(pooled, [[2, 0], [0, 4], [5, 5]])
+
+
+def test_weighted_pooling_and_normalization():
+    vectors = np.array([[1, 0], [0, 1], [3, 4]], dtype=np.float32)
+    pooled = pool_embeddings(vectors, np.array([0, 2]), weights=np.array([3, 1, 7]), normalize=False)
+    np.testing.assert_allclose(pooled, [[0.75, 0.25], [3, 4]])
+    normalized = pool_embeddings(vectors, np.array([0, 2]), weights=np.array([3, 1, 7]))
+    np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), [1, 1], rtol=1e-6)
+
+
+def test_pooler_reassembles_records_from_chunks_in_any_order():
+    texts = {"a": "x" * 250, "b": "y" * 150, "c": "short"}
+    chunks = list(chunk_records(
+        [{"recordId": record_id, "modelInput.inputText": text} for record_id, text in texts.items()], 100, 10
+    ))
+    writer = ListResultWriter()
+    with ChunkPooler(writer, "mean", normalize=False, batch_size=1) as pooler:
+        for record in reversed(chunks):
+            index = parse_chunk_id(record["recordId"])
+            pooler.write(record["recordId"], record["modelInput.inputText"],
+                         [float(index[1]) if index else 9.0, 1.0])
+    results = {record_id: (text, vector) for record_id, text, vector in writer.results}
+    assert {record_id: text for record_id, (text, _) in results.items()} == texts
+    np.testing.assert_allclose(results["a"][1], [1.0, 1.0])
+    np.testing.assert_allclose(results["b"][1], [0.5, 1.0])
+    assert results["c"][1] == [9.0, 1.0]
+    assert pooler.partial == 0
+
+
+def test_pooler_holds_back_records_missing_chunks():
+    writer = ListResultWriter()
+    record = next(chunk_records([{"recordId": "a", "modelInput.inputText": "x" * 250}], 100, 10))
+    with ChunkPooler(writer) as pooler:
+        pooler.write(record["recordId"], record["modelInput.inputText"], [1.0, 0.0])
+    assert writer.results == []
+    assert pooler.partial == 1
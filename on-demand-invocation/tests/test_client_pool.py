@@ -0,0 +1,54 @@
+import pytest
+
+from client_pool import ClientPool, Target, parse_targets
+
+MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+
+def test_parse_targets():
+    assert parse_targets("us-east-1, us-west-2=us.amazon.titan-embed-text-v2:0*2,,", MODEL_ID) == [
+        Target("us-east-1", MODEL_ID, 1.0),
+        Target("us-west-2", "us.amazon.titan-embed-text-v2:0", 2.0),
+    ]
+
+
+def test_parse_targets_without_region():
+    # the model id after '=' and the weight after the last '*' are both optional
+    assert parse_targets("=custom-model*0.5", MODEL_ID) == [Target(None, "custom-model", 0.5)]
+    assert parse_targets("eu-west-1*3", MODEL_ID) == [Target("eu-west-1", MODEL_ID, 3.0)]
+
+
+def test_pool_needs_a_target():
+    with pytest.raises(ValueError):
+        ClientPool([])
+
+
+def test_checkout_follows_the_weights():
+    pool = ClientPool([Target("us-east-1", MODEL_ID, 1.0), Target("us-west-2", MODEL_ID, 3.0)])
+    indexes = [pool.checkout() for _ in range(8)]
+    # the least loaded relative to its weight gets the next call: 2 vs 6 in flight
+    assert indexes.count(0) == 2
+    assert indexes.count(1) == 6
+
+
+def test_checkin_frees_the_target():
+    pool = ClientPool([Target("us-east-1", MODEL_ID), Target("us-west-2", MODEL_ID)])
+    first, second = pool.checkout(), pool.checkout()
+    assert {first, second} == {0, 1}
+    pool.checkin(first)
+    assert pool.checkout() == first
+
+
+def test_limiters_are_built_per_target_weight():
+    pool = ClientPool([Target("us-east-1", MODEL_ID, 1.0), Target("us-west-2", MODEL_ID, 2.5)],
+                      limiter_factory=lambda weight: weight * 100)
+    assert pool.limiters == [100.0, 250.0]
+
+
+def test_pool_is_handed_to_workers_without_its_clients():
+    # the in-flight counts are shared memory, only picklable when a worker
+    # process is started, so the state handed over is checked directly
+    pool = ClientPool([Target("us-east-1", MODEL_ID)])
+    pool._clients = [object()]
+    assert pool.__getstate__()['_clients'] is None
+    assert pool._clients is not None
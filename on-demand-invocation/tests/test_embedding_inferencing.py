@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+
+import adaptive_control
+import embedding_inferencing
+from client_pool import ClientPool, Target
+from rate_limiting import AsyncRateLimiter, DualRateLimiter
+
+
+@pytest.fixture
+def two_targets(monkeypatch):
+    # a bucket that barely refills during the test, so reservations show
+    def factory(weight):
+        return DualRateLimiter(None, AsyncRateLimiter(60, 60, burst=1000))
+    pool = ClientPool([Target("us-east-1", "model"), Target("us-west-2", "model")], factory)
+    monkeypatch.setattr(embedding_inferencing, "client_pool", pool)
+    monkeypatch.setattr(adaptive_control, "backoff_delay", lambda *args: 0)
+    return pool
+
+
+def test_failed_attempts_give_their_tokens_back(two_targets, monkeypatch):
+    calls = []
+
+    def invoke_model(index, input_text):
+        calls.append(index)
+        if len(calls) == 1:
+            raise ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel")
+        return [0.1], 10
+
+    monkeypatch.setattr(embedding_inferencing, "invoke_model", invoke_model)
+    embeddings = asyncio.run(embedding_inferencing.invoke_with_budget("x" * 400, None))
+
+    assert embeddings == [0.1]
+    assert len(calls) == 2
+    # only the successful attempt's 10 tokens are spent, on whichever target it ran
+    spent = sum(limiter.tokens.capacity - limiter.tokens._tokens for limiter in two_targets.limiters)
+    assert spent == pytest.approx(10, abs=0.5)
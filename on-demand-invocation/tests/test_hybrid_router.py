@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import hybrid_router
+from hybrid_router import MAX_RECORDS_PER_JOB, MIN_RECORDS_PER_JOB, batch_seconds, plan_split
+
+HOUR = 3600.0
+
+
+def test_batch_seconds_with_free_slots():
+    assert batch_seconds(0, active=5, queued=5, slots=2, job_seconds=HOUR) == 0.0
+    assert batch_seconds(MAX_RECORDS_PER_JOB, active=0, queued=0, slots=2, job_seconds=HOUR) == HOUR
+    # two jobs run side by side, the third waits for the first slot
+    assert batch_seconds(2 * MAX_RECORDS_PER_JOB, active=0, queued=0, slots=2, job_seconds=HOUR) == HOUR
+    assert batch_seconds(2 * MAX_RECORDS_PER_JOB + 1, active=0, queued=0, slots=2, job_seconds=HOUR) == 2 * HOUR
+
+
+def test_batch_seconds_queues_behind_the_backlog():
+    # both slots busy until halfway, then the queued job takes one of them
+    assert batch_seconds(1, active=2, queued=1, slots=2, job_seconds=HOUR) == 1.5 * HOUR
+    assert batch_seconds(1, active=2, queued=2, slots=2, job_seconds=HOUR) == 2.5 * HOUR
+    # more running jobs than slots, e.g. after the limit was lowered
+    assert batch_seconds(1, active=5, queued=0, slots=2, job_seconds=HOUR) == 1.5 * HOUR
+
+
+def profile(records, tokens_per_record=100):
+    return {"records": records, "requests": records, "tokens": records * tokens_per_record}
+
+
+def test_plan_split_prefers_the_cheaper_batch_when_on_time():
+    plan = plan_split(profile(10000), deadline=2 * HOUR, rpm=600, tpm=None, batch_eta=lambda records: HOUR)
+    assert (plan["on_demand"], plan["batch"]) == (0, 10000)
+
+
+def test_plan_split_moves_records_on_demand_to_meet_the_deadline():
+    # 600 requests a minute: 5000 records take 500 s on-demand, batch takes an hour
+    plan = plan_split(profile(5000), deadline=HOUR / 2, rpm=600, tpm=None,
+                      batch_eta=lambda records: HOUR if records else 0.0)
+    assert (plan["on_demand"], plan["batch"]) == (5000, 0)
+    assert plan["eta"] == pytest.approx(500)
+
+
+def test_plan_split_takes_the_cheapest_on_time_split():
+    # 10000 records at 100 a minute on-demand: the deadline leaves time for 4000 of them
+    plan = plan_split(profile(10000), deadline=40 * 60, rpm=100, tpm=None,
+                      batch_eta=lambda records: 30 * 60 if records <= 6000 else 2 * HOUR)
+    assert (plan["on_demand"], plan["batch"]) == (4000, 6000)
+
+
+def test_plan_split_skips_batches_below_the_job_minimum():
+    # a batch of up to 60 records would be instant and make the deadline, but
+    # Bedrock refuses jobs that small, so everything goes on-demand, late
+    plan = plan_split(profile(150), deadline=100, rpm=60, tpm=None,
+                      batch_eta=lambda records: 0.0 if records <= 60 else float("inf"))
+    assert MIN_RECORDS_PER_JOB > 60
+    assert (plan["on_demand"], plan["batch"]) == (150, 0)
+
+
+def test_plan_split_returns_the_fastest_when_nothing_is_on_time():
+    # all on-demand takes 100 minutes, any batch an hour: the cheapest of the
+    # hour long plans is all batch
+    plan = plan_split(profile(10000), deadline=60, rpm=100, tpm=None,
+                      batch_eta=lambda records: HOUR if records else 0.0)
+    assert (plan["on_demand"], plan["batch"], plan["eta"]) == (0, 10000, HOUR)
+
+
+def test_job_durations_are_the_most_recently_finished(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in (("AWS_DEFAULT_REGION", "us-east-1"), ("AWS_ACCESS_KEY_ID", "testing"),
+                        ("AWS_SECRET_ACCESS_KEY", "testing")):
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(hybrid_router, "HISTORY_JOBS", 2)
+    with moto.mock_aws():
+        table = boto3.resource("dynamodb").create_table(
+            TableName="registry",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": attribute, "AttributeType": kind} for attribute, kind in
+                                  (("id", "S"), ("status_shard", "S"), ("queue_position", "N"))],
+            GlobalSecondaryIndexes=[{
+                "IndexName": hybrid_router.STATUS_SHARD_INDEX,
+                "KeySchema": [{"AttributeName": "status_shard", "KeyType": "HASH"},
+                              {"AttributeName": "queue_position", "KeyType": "RANGE"}],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        # (queue position, hours run, hours after start it finished): the job
+        # queued first finished last, after a long run
+        for i, (position, hours, finished) in enumerate([(1, 9, 10), (2, 1, 3), (3, 2, 5), (4, 1, 2)]):
+            table.put_item(Item={
+                "id": f"batch-{i}",
+                "status_shard": f"Completed#default#{i % hybrid_router.STATUS_SHARDS}",
+                "queue_position": position,
+                "created_dt": (start + timedelta(hours=finished - hours)).isoformat(),
+                "updated_at": (start + timedelta(hours=finished)).isoformat(),
+            })
+        assert hybrid_router.job_durations("registry") == [9 * HOUR, 2 * HOUR]
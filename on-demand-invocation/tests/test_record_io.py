@@ -0,0 +1,22 @@
+import numpy as np
+
+from record_io import NPY_HEADER_SIZE, NpyEmbeddingWriter, load_embeddings
+
+
+def test_npy_header_follows_appends(tmp_path):
+    output = str(tmp_path / "out.npy")
+    with NpyEmbeddingWriter(output, flush_every=2) as writer:
+        for i in range(3):
+            writer.write(f"r{i}", None, [i, i + 0.5])
+        # flushed after 2 rows, the third is still buffered
+        assert np.load(output, mmap_mode="r").shape == (2, 2)
+    assert np.load(output).shape == (3, 2)
+
+    with NpyEmbeddingWriter(output, include_text=True, resume_rows=2) as writer:
+        writer.write("r2", "text", [7, 8])
+        writer.write("r3", "text", [9, 10])
+    record_ids, vectors = load_embeddings(output)
+    assert record_ids == ["r0", "r1", "r2", "r3"]
+    np.testing.assert_array_equal(vectors, np.array([[0, 0.5], [1, 1.5], [7, 8], [9, 10]], dtype=np.float32))
+    with open(output, "rb") as f:
+        assert len(f.read()) == NPY_HEADER_SIZE + 4 * 2 * 4